@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+# Copyright (c) 2019 The Unit-e developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or https://opensource.org/licenses/MIT.
+"""Usage:
+  bench.py [--files=<n>] [--lines=<n>] [--density=<d>] [--repeat=<n>] [--jobs=<n>] [--output=<file>] [--compare=<file>]
+  bench.py -h | --help
+
+Benchmark the substitution hot paths of clonemachine on a generated corpus.
+The corpus consists of source and documentation files with lines of filler
+text, where the given fraction of lines contains bitcoin specific
+identifiers. Each benchmark is run `--repeat` times and the minimum and
+median wall time is reported. The results are written as JSON together with
+the clonemachine revision, so they can be compared between revisions.
+
+Options:
+  -h --help           Show this help
+  --files=<n>         Number of files in the corpus [default: 300]
+  --lines=<n>         Number of lines per file [default: 200]
+  --density=<d>       Fraction of lines containing identifiers [default: 0.05]
+  --repeat=<n>        Number of runs of each benchmark [default: 3]
+  --jobs=<n>          Number of processes used by the fork benchmark [default: 1]
+  --output=<file>     Write results to this file instead of
+                      `benchmarks/results/<revision>.json`
+  --compare=<file>    Show the ratio of the timings to the ones in an earlier
+                      results file
+"""
+from docopt import docopt
+from contextlib import contextmanager
+from pathlib import Path
+import datetime
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from os.path import dirname, abspath
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from fork import Fork, ForkConfig
+from processor import Processor
+
+IDENTIFIERS = [
+    "bitcoin", "Bitcoin", "BITCOIN", "bitcoind", "bitcoin-cli", "bitcoin-tx",
+    "Bitcoin Core", "bitcoin core", "BitcoinUnits", "BITCOIN_CONF", "BTC",
+    "8332", "8333", "18333", "testnet3", "COIN", "CENT", "bitcoin address",
+    "bitcoin.conf", "bitcoincore.org", "The Bitcoin Core developers",
+]
+
+WORDS = [
+    "block", "chain", "wallet", "node", "peer", "script", "key", "hash",
+    "value", "index", "return", "const", "std::string", "if", "for", "self",
+    "amount", "fee", "transaction", "header", "version", "network",
+]
+
+# Directories of the corpus, including paths which are excluded or moved
+DIRECTORIES = ["src", "src/wallet", "src/rpc", "src/bitcoin", "src/leveldb",
+               "test/functional", "doc", "contrib/bitcoin-cli"]
+
+EXTENSIONS = [".cpp", ".h", ".py", ".md"]
+
+class Corpus:
+    """
+    Generated files with a configurable density of bitcoin identifiers.
+    """
+
+    def __init__(self, files, lines, density, seed=0):
+        rng = random.Random(seed)
+        self.files = {}
+        for i in range(files):
+            directory = rng.choice(DIRECTORIES)
+            prefix = "bitcoin_" if rng.random() < 0.05 else "file_"
+            path = f"{directory}/{prefix}{i}{rng.choice(EXTENSIONS)}"
+            self.files[path] = "".join(self.line(rng, density) for _ in range(lines))
+
+    def line(self, rng, density):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(3, 12))]
+        if rng.random() < density:
+            words.insert(rng.randint(0, len(words)), rng.choice(IDENTIFIERS))
+        return " ".join(words) + "\n"
+
+    def size(self):
+        return sum(len(contents) for contents in self.files.values())
+
+    def write(self, path):
+        for name, contents in self.files.items():
+            file_name = path / name
+            file_name.parent.mkdir(parents=True, exist_ok=True)
+            with file_name.open("w") as file:
+                file.write(contents)
+
+def git(arguments, cwd):
+    subprocess.run(["git", "-c", "user.name=bench", "-c", "user.email=bench@example.com"] + arguments,
+                   cwd=cwd, stdout=subprocess.DEVNULL, check=True)
+
+def create_git_repo(path, corpus):
+    """
+    Create a repository with the corpus on the branch `upstream` and a
+    `master` branch with a `.clonemachine` configuration.
+    """
+    path.mkdir()
+    git(["init", "-q"], path)
+    git(["config", "user.name", "bench"], path)
+    git(["config", "user.email", "bench@example.com"], path)
+    corpus.write(path)
+    git(["add", "."], path)
+    git(["commit", "-q", "-m", "Corpus"], path)
+    git(["branch", "upstream"], path)
+    with (path / ".clonemachine").open("w") as file:
+        file.write("appropriated_files: []\nremoved_files: []\n")
+    with (path / "README.md").open("w") as file:
+        file.write("Unit-e\n")
+    git(["add", "."], path)
+    git(["commit", "-q", "-m", "Add clonemachine configuration"], path)
+
+@contextmanager
+def quiet():
+    """
+    Suppress output of the benchmarked code and its subprocesses.
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = os.dup(1), os.dup(2)
+    with open(os.devnull, "w") as devnull:
+        os.dup2(devnull.fileno(), 1)
+        os.dup2(devnull.fileno(), 2)
+        try:
+            yield
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved[0], 1)
+            os.dup2(saved[1], 2)
+            os.close(saved[0])
+            os.close(saved[1])
+
+@contextmanager
+def working_directory(path):
+    old_dir = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(old_dir)
+
+def measure(function, repeat, setup=None):
+    timings = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        with quiet():
+            function()
+        timings.append(time.perf_counter() - start)
+    return {"min": min(timings), "median": statistics.median(timings), "runs": timings}
+
+def bench_substitute(corpus, repeat):
+    processor = Processor(ForkConfig())
+    text = "".join(corpus.files.values())
+    return measure(lambda: processor.substitute(text, "bitcoin", processor.replace_bitcoin_identifier,
+                                                case_sensitive=False,
+                                                blacklist=processor.config.substitution_blacklist), repeat)
+
+def bench_substitute_bitcoin_identifier_in_file(corpus, repeat, tmp_path):
+    path = tmp_path / "files"
+    processor = Processor(ForkConfig())
+
+    def setup():
+        shutil.rmtree(path, ignore_errors=True)
+        corpus.write(path)
+
+    def run():
+        for name in corpus.files:
+            processor.substitute_bitcoin_identifier_in_file(str(path / name))
+
+    return measure(run, repeat, setup)
+
+def bench_replace_recursively(repo, repeat):
+    processor = Processor(ForkConfig())
+
+    def setup():
+        git(["checkout", "-q", "-f", "upstream"], repo)
+
+    def run():
+        with working_directory(repo):
+            processor.replace_recursively("8333", "7182")
+            processor.replace_recursively("bitcoind", "unit-e")
+            processor.replace_recursively("COIN", "UNIT")
+
+    return measure(run, repeat, setup)
+
+def bench_fork(repo, repeat, jobs, in_memory=False):
+    def setup():
+        git(["checkout", "-q", "-f", "-B", "fork", "upstream"], repo)
+
+    def run():
+        with working_directory(repo):
+            Fork("master", None, jobs, in_memory=in_memory).run()
+
+    return measure(run, repeat, setup)
+
+def clonemachine_revision():
+    path = dirname(dirname(abspath(__file__)))
+    result = subprocess.run(["git", "rev-parse", "HEAD"], cwd=path, stdout=subprocess.PIPE)
+    revision = result.stdout.decode("utf-8").strip()
+    if subprocess.run(["git", "diff-index", "--quiet", "HEAD"], cwd=path).returncode != 0:
+        revision += "+changes"
+    return revision
+
+def print_results(results, reference=None):
+    print(f"{'benchmark':<50} {'min':>9} {'median':>9}" + (f" {'ratio':>7}" if reference else ""))
+    for name, timing in results["benchmarks"].items():
+        line = f"{name:<50} {timing['min']:>8.3f}s {timing['median']:>8.3f}s"
+        if reference and name in reference["benchmarks"]:
+            line += f" {timing['median'] / reference['benchmarks'][name]['median']:>7.2f}"
+        print(line)
+
+def main():
+    arguments = docopt(__doc__)
+    repeat = int(arguments["--repeat"])
+    jobs = int(arguments["--jobs"])
+    corpus = Corpus(int(arguments["--files"]), int(arguments["--lines"]), float(arguments["--density"]))
+
+    results = {
+        "clonemachine_revision": clonemachine_revision(),
+        "date": datetime.datetime.utcnow().isoformat(timespec="seconds") + "Z",
+        "python_version": sys.version.split()[0],
+        "corpus": {
+            "files": len(corpus.files),
+            "lines": int(arguments["--lines"]),
+            "density": float(arguments["--density"]),
+            "bytes": corpus.size(),
+        },
+        "benchmarks": {},
+    }
+    benchmarks = results["benchmarks"]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_path = Path(tmp_dir)
+        repo = tmp_path / "repo"
+        create_git_repo(repo, corpus)
+        benchmarks["Processor.substitute"] = bench_substitute(corpus, repeat)
+        benchmarks["Processor.substitute_bitcoin_identifier_in_file"] = \
+            bench_substitute_bitcoin_identifier_in_file(corpus, repeat, tmp_path)
+        benchmarks["Processor.replace_recursively"] = bench_replace_recursively(repo, repeat)
+        benchmarks[f"Fork.run (jobs={jobs})"] = bench_fork(repo, repeat, jobs)
+        benchmarks[f"Fork.run (jobs={jobs}, in memory)"] = bench_fork(repo, repeat, jobs, in_memory=True)
+
+    if arguments["--output"]:
+        output = Path(arguments["--output"])
+    else:
+        output = Path(dirname(abspath(__file__))) / "results" / f"{results['clonemachine_revision']}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with output.open("w") as file:
+        json.dump(results, file, indent=2)
+        file.write("\n")
+
+    reference = None
+    if arguments["--compare"]:
+        with open(arguments["--compare"]) as file:
+            reference = json.load(file)
+    print_results(results, reference)
+    print(f"Results written to {output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# vim: ts=2 sw=2 sts=2 expandtab
+# Copyright (c) 2019 The Unit-e developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or https://opensource.org/licenses/MIT.
+
+import hashlib
+import mmap
+import os
+import tempfile
+from pathlib import Path
+from typing import *
+
+# Increase when the layout of the cache changes
+CACHE_FORMAT_VERSION = 1
+
+def default_cache_dir() -> Path:
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return Path(cache_home) / "clonemachine"
+
+def git_blob_hash(data: Union[bytes, mmap.mmap]) -> str:
+    """
+    Return the hash git uses for a blob with the given contents.
+    """
+    digest = hashlib.sha1(f"blob {len(data)}\0".encode('utf8'))
+    digest.update(data)
+    return digest.hexdigest()
+
+class ResultCache:
+    """
+    On-disk cache of transformed file contents. Entries are keyed by the git
+    blob hash of the input and a fingerprint of everything which determines
+    the output: the clonemachine code, the configuration and the
+    transformations applied to the file. So an entry can be reused in every
+    run which applies the same transformations to a file with the same
+    contents, independent of the path of the file or the branch.
+
+    The cache is bounded in size. `prune` removes the least recently used
+    entries, using the modification time of the entry files, which is
+    updated whenever an entry is used.
+    """
+
+    def __init__(self, path: Optional[Path] = None, max_size: int = 512 * 1024 * 1024):
+        self.path = path if path is not None else default_cache_dir()
+        self.max_size = max_size
+
+    def key(self, data: Union[bytes, mmap.mmap], parts: Sequence[Union[str, bytes]]) -> str:
+        """
+        Return the key of the result of processing `data` in a way which is
+        described by `parts`.
+        """
+        digest = hashlib.sha256(str(CACHE_FORMAT_VERSION).encode('utf8'))
+        digest.update(git_blob_hash(data).encode('utf8'))
+        for part in parts:
+            digest.update(b"\0")
+            digest.update(part.encode('utf8') if isinstance(part, str) else part)
+        return digest.hexdigest()
+
+    def entry_path(self, key: str) -> Path:
+        return self.path / key[:2] / key[2:]
+
+    def get(self, key: str) -> Optional[bytes]:
+        entry_path = self.entry_path(key)
+        try:
+            with open(entry_path, 'rb') as entry_file:
+                data = entry_file.read()
+            os.utime(entry_path)
+        except OSError:
+            return None
+        return data
+
+    def put(self, key: str, data: bytes):
+        """
+        Store an entry. The entry file is written under a temporary name and
+        then renamed, so concurrent readers never see partial entries.
+        """
+        entry_path = self.entry_path(key)
+        try:
+            entry_path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp_name = tempfile.mkstemp(dir=entry_path.parent, prefix=".tmp-")
+            with os.fdopen(fd, 'wb') as entry_file:
+                entry_file.write(data)
+            os.replace(tmp_name, entry_path)
+        except OSError:
+            # The cache is an optimization only, so don't fail the run
+            pass
+
+    def prune(self):
+        """
+        Remove the least recently used entries until the size of the cache
+        is within its limit.
+        """
+        entries = []
+        total_size = 0
+        for entry_path in self.path.glob("*/*"):
+            try:
+                stat = entry_path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry_path))
+            total_size += stat.st_size
+        entries.sort()
+        for mtime, size, entry_path in entries:
+            if total_size <= self.max_size:
+                break
+            try:
+                entry_path.unlink()
+            except OSError:
+                continue
+            total_size -= size
@@ -3,11 +3,18 @@
 # Distributed under the MIT software license, see the accompanying
 # file COPYING or https://opensource.org/licenses/MIT.
 """Usage:
-  clonemachine.py fork [--unit-e-branch=<name>]
+  clonemachine.py fork [--unit-e-branch=<name>] [--jobs=<n>] [--incremental=<branch>] [--no-cache]
+                       [--in-memory] [--trace=<file>] [--profile=<file>] [--dry-run]
+  clonemachine.py plan [--unit-e-branch=<name>] [--jobs=<n>] [--incremental=<branch>] [--no-cache]
+                       [--output=<file>]
   clonemachine.py file <filename>
-  clonemachine.py substitute-unit-e-naming
-  clonemachine.py substitute-unit-e-urls
-  clonemachine.py substitute-unit-e-executables
+  clonemachine.py batch [-z] [--no-cache]
+  clonemachine.py filter-process [--no-cache]
+  clonemachine.py merge-driver [--marker-size=<n>] [--no-cache] <ancestor> <current> <other> <pathname>
+  clonemachine.py convert-merge [--hook] [--jobs=<n>] [--no-cache]
+  clonemachine.py substitute-unit-e-naming [--jobs=<n>] [--no-cache]
+  clonemachine.py substitute-unit-e-urls [--jobs=<n>] [--no-cache]
+  clonemachine.py substitute-unit-e-executables [--jobs=<n>] [--no-cache]
   clonemachine.py show-upstream-diff --bitcoin-branch=<name>
   clonemachine.py -h | --help
 
@@ -15,9 +22,40 @@ Commands:
   fork                        Substitute all occurrences of bitcoin specific
                               identifiers by corresponding unit-e identifiers on
                               a fork. Processes files recursively and creates
-                              git commits with the changes.
+                              git commits with the changes. Every commit
+                              records the upstream revision it's based on in
+                              an `Upstream-revision` trailer. At the end a
+                              table of the time, subprocesses and file I/O
+                              used by each step and processor method is shown.
+  plan                        Run all steps of `fork` without changing the
+                              repository or the working tree and show what
+                              they would do as JSON: the files changed by each
+                              step, and for each substitution and file how
+                              many occurrences would be replaced, how many are
+                              blacklisted and how many don't match the
+                              context. Progress is shown on stderr.
   file                        Do subsitutions on one file. Don't traverse the
                               file tree and don't create git commits.
+  batch                       Do the substitutions of `file` on each file whose
+                              path is read from stdin, one path per line. For
+                              each file a line with `modified`, `unchanged` or
+                              `missing` and its path is written as soon as it
+                              is done. Files in excluded paths are left alone.
+  filter-process              Run as long-running git filter process, which
+                              does the substitutions of `file` on files when
+                              git checks them out. Files in excluded paths are
+                              left alone. See the README for how to set it up.
+  merge-driver                Run as git merge driver, which converts the
+                              upstream versions of a file git has to merge
+                              with all steps of `fork` and merges them into
+                              the unit-e version. The configuration is read
+                              from HEAD. See the README for how to set it up.
+  convert-merge               Convert the files which the merge in progress
+                              has taken over from upstream without calling
+                              the merge driver, because they have only
+                              changed upstream, with all steps of `fork`, and
+                              add them to the index. Files are moved and
+                              removed as in a fork.
   substitute-unit-e-naming    Substitute the old unit-e naming scheme by the new
                               one. To be used on the unit-e master branch before
                               merging with a bitcoin version processed through
@@ -42,35 +80,125 @@ Options:
   --bitcoin-branch=<name>     Name of bitcoin branch (e.g. bitcoin/master), when
                               this option is set, the diff of appropriated files
                               is shown
+  --jobs=<n>                  Number of processes used to process files in
+                              parallel [default: 1]
+  --incremental=<branch>      Only process files which have changed upstream
+                              since the fork on the given branch was created
+                              and carry over all other files from it. The fork
+                              must have been created with the same version and
+                              configuration of clonemachine.
+  --no-cache                  Don't use the cache of processed file contents.
+                              The cache is kept in `~/.cache/clonemachine` or
+                              `$XDG_CACHE_HOME/clonemachine` and its size is
+                              limited to 512 MB.
+  --in-memory                 Process the tree in memory and write commits
+                              directly to the object database. The working
+                              tree is only updated at the end. Works in bare
+                              repositories as well.
+  --trace=<file>              Write the time and resources used by each step
+                              and processor method in Chrome trace format
+  --profile=<file>            Profile the fork with cProfile, write the
+                              profile to the given file and show the functions
+                              with the highest cumulative time
+  --output=<file>             Write the JSON output of `plan` to a file
+                              instead of stdout
+  -z                          Paths on stdin and in the output of `batch` are
+                              separated by NUL bytes instead of newlines
+  --hook                      Exit with an error if `convert-merge` has
+                              changed files, so git doesn't commit the merge
+                              when it's run as `pre-merge-commit` hook
+  --marker-size=<n>           Length of conflict markers written by
+                              `merge-driver` [default: 7]
+  --dry-run                   Show the steps of the fork and the passes the
+                              substitution rules are compiled to, without
+                              changing anything
 """
 from docopt import docopt
+import contextlib
+import cProfile
+import json
+import pstats
 import sys
 
 from processor import Processor
+from cache import ResultCache
+from instrumentation import Instrumentation
 from fork import Fork
 from fork import ForkConfig
+from merge import merge_file, convert_merge
+from stream import FilterProcess, run_batch
 from unit_e_substituter import UnitESubstituter
 
 if __name__ == "__main__":
     arguments = docopt(__doc__)
-    processor = Processor(ForkConfig())
+    jobs = int(arguments["--jobs"])
+    cache = None if arguments["--no-cache"] else ResultCache()
+    processor = Processor(ForkConfig(), jobs, cache)
     unit_e_branch = arguments["--unit-e-branch"]
     bitcoin_branch = arguments["--bitcoin-branch"]
-    if arguments["fork"]:
-        Fork(unit_e_branch, bitcoin_branch).run()
+    if arguments["fork"] and arguments["--dry-run"]:
+        Fork(unit_e_branch, bitcoin_branch, jobs, arguments["--incremental"]).show_plan()
+    elif arguments["fork"]:
+        with Instrumentation() as instrumentation:
+            fork = Fork(unit_e_branch, bitcoin_branch, jobs, arguments["--incremental"], cache, instrumentation,
+                        arguments["--in-memory"])
+            if arguments["--profile"]:
+                profile = cProfile.Profile()
+                profile.runcall(fork.run)
+                profile.dump_stats(arguments["--profile"])
+                pstats.Stats(profile).sort_stats("cumulative").print_stats(25)
+            else:
+                fork.run()
+        print(instrumentation.summary())
+        if arguments["--trace"]:
+            instrumentation.write_trace(arguments["--trace"])
+    elif arguments["plan"]:
+        fork = Fork(unit_e_branch, bitcoin_branch, jobs, arguments["--incremental"], cache)
+        with contextlib.redirect_stdout(sys.stderr):
+            report = fork.plan()
+        if arguments["--output"]:
+            with open(arguments["--output"], "w") as file:
+                json.dump(report, file, indent=2)
+                file.write("\n")
+        else:
+            print(json.dumps(report, indent=2))
     elif arguments["file"]:
         filename = arguments["<filename>"]
         print(f"Substituting strings in file {filename}")
-        processor.substitute_bitcoin_core_identifier_in_file(filename)
-        processor.substitute_bitcoin_identifier_in_file(filename)
-        processor.replace_in_file(filename, "BTC", "UTE", match_before="$|[^a-bd-ln-tv-zA-Z]")
+        # The file is converted even if it's in an excluded path
+        processor.transform_file(filename, [transform._replace(paths=[filename])
+                                            for transform in processor.file_transforms])
+    elif arguments["batch"]:
+        run_batch(processor, sys.stdin.buffer, sys.stdout.buffer, b"\0" if arguments["-z"] else b"\n")
+    elif arguments["filter-process"]:
+        FilterProcess(processor, sys.stdin.buffer, sys.stdout.buffer).run()
+    elif arguments["merge-driver"]:
+        # Git runs the driver on the branch which is merged into
+        fork = Fork("HEAD", cache=cache)
+        if not merge_file(fork, arguments["<ancestor>"], arguments["<current>"], arguments["<other>"],
+                          arguments["<pathname>"], int(arguments["--marker-size"])):
+            sys.exit(1)
+    elif arguments["convert-merge"]:
+        fork = Fork("HEAD", jobs=jobs, cache=cache)
+        if convert_merge(fork) and arguments["--hook"]:
+            sys.exit("Not committing the merge, review the converted files and run `git commit`")
     elif arguments["substitute-unit-e-naming"]:
-        UnitESubstituter().substitute_naming(processor)
+        with processor.pipeline():
+            UnitESubstituter().substitute_naming(processor)
+        print(processor.reset_stats())
     elif arguments["substitute-unit-e-urls"]:
-        UnitESubstituter().substitute_urls(processor)
+        with processor.pipeline():
+            UnitESubstituter().substitute_urls(processor)
+        print(processor.reset_stats())
     elif arguments["substitute-unit-e-executables"]:
-        UnitESubstituter().substitute_executables(processor)
+        with processor.pipeline():
+            UnitESubstituter().substitute_executables(processor)
+        print(processor.reset_stats())
     elif arguments["show-upstream-diff"]:
         Fork(unit_e_branch, bitcoin_branch).show_upstream_diff()
     else:
         sys.exit("Unable to process command")
+    # The merge driver runs once for every file, the cache is pruned by the
+    # other commands
+    if cache is not None and not arguments["merge-driver"]:
+        cache.prune()
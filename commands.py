@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# vim: ts=2 sw=2 sts=2 expandtab
+# Copyright (c) 2019 The Unit-e developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or https://opensource.org/licenses/MIT.
+
+import asyncio
+import os
+import subprocess
+from typing import *
+
+class CommandResult(NamedTuple):
+    args: List[str]
+    returncode: int
+    stdout: bytes
+    stderr: bytes
+
+    def check_returncode(self):
+        if self.returncode != 0:
+            raise subprocess.CalledProcessError(self.returncode, self.args, self.stdout, self.stderr)
+
+async def run_command(args: List[str], semaphore: asyncio.Semaphore, cwd: Optional[str] = None) -> CommandResult:
+    async with semaphore:
+        process = await asyncio.create_subprocess_exec(*args, cwd=cwd, stdin=subprocess.DEVNULL,
+                                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = await process.communicate()
+    assert process.returncode is not None
+    return CommandResult(args, process.returncode, stdout, stderr)
+
+async def gather_commands(commands: Sequence[List[str]], jobs: int, cwd: Optional[str]) -> List[CommandResult]:
+    semaphore = asyncio.Semaphore(jobs)
+    return await asyncio.gather(*[run_command(args, semaphore, cwd) for args in commands])
+
+def run_commands(commands: Sequence[List[str]], jobs: Optional[int] = None, cwd: Optional[str] = None,
+                 check: bool = False) -> List[CommandResult]:
+    """
+    Run independent commands at the same time, at most `jobs` of them at
+    once, by default as many as there are CPUs. Their output is collected and
+    returned in the order of the commands, regardless of the order in which
+    they finish. If `check` is set, a `CalledProcessError` is raised for the
+    first command which failed, after all of them have finished.
+    """
+    if not commands:
+        return []
+    loop = asyncio.new_event_loop()
+    try:
+        # Subprocesses are watched through the event loop of the main thread
+        asyncio.set_event_loop(loop)
+        results = loop.run_until_complete(gather_commands(commands, jobs or os.cpu_count() or 1, cwd))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+    if check:
+        for result in results:
+            result.check_returncode()
+    return results
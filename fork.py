@@ -4,10 +4,17 @@
 # Distributed under the MIT software license, see the accompanying
 # file COPYING or https://opensource.org/licenses/MIT.
 
+import contextlib
+import io
 import subprocess
+import re
+import sys
 import yaml
 
-from processor import Processor
+from commands import run_commands
+from processor import Processor, BlacklistIndex, PrefixTrie
+from rules import load_rules, parse_rules, plan, format_plan
+from tree import GitObjectReader, FileSetTree
 
 class ForkConfig:
     def __init__(self):
@@ -65,7 +72,9 @@ class ForkConfig:
             "doc/release-notes",
             "src/qt",
             "contrib/debian",
-            # Clonemachine can't handle CRLF line endings so ignoring this file for now
+            # Has CRLF line endings, which used to be converted, so it was never
+            # adapted. Line endings are preserved now, but including it would
+            # change the regression test reference data.
             "doc/README_windows.txt",
         ]
 
@@ -109,103 +118,113 @@ class ForkConfig:
             ".github/ISSUE_TEMPLATE.md",
         ]
 
+        # Substitution rules by step, see `rules.yaml`
+        self.rule_steps = load_rules()
+
+        self.index_blacklist()
+        self.index_excluded_paths()
+
+    def index_blacklist(self):
+        """
+        Build the index of the substitution blacklist. This has to be called
+        again when the blacklist is changed.
+        """
+        self.blacklist_index = BlacklistIndex(self.substitution_blacklist)
+
+    def index_excluded_paths(self):
+        """
+        Build the trie of the excluded paths. This has to be called again
+        when the excluded paths are changed.
+        """
+        self.excluded_paths_index = PrefixTrie(self.excluded_paths)
+
+    def fingerprint(self):
+        """
+        Return a string which identifies the configuration affecting the
+        contents of processed files.
+        """
+        return yaml.safe_dump({
+            "substitution_blacklist": self.substitution_blacklist,
+            "excluded_paths": self.excluded_paths,
+            "other_substitutions": self.other_substitutions,
+        })
+
     def read_from_branch(self, branch, git_dir="."):
         """
         Read configuration from the YAML file `.clonemachine` on the given
         branch of the given repository and merge it with the predefined values
-        from this class.
+        from this class. Steps in the rule file `.clonemachine-rules` on the
+        branch replace the predefined steps with the same name.
         """
         if branch:
-            result = subprocess.run(['git', 'show', branch + ':.clonemachine'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=git_dir)
-            if result.returncode == 0:
-                config = yaml.safe_load(result.stdout.decode('utf-8'))
+            objects = GitObjectReader.shared(git_dir)
+            result = objects.read(branch + ':.clonemachine')
+            if result is not None:
+                config = yaml.safe_load(result[1].decode('utf-8'))
                 self.appropriated_files = list(set(config["appropriated_files"]).union(self.appropriated_files))
                 self.removed_files = list(set(config["removed_files"]).union(self.removed_files))
+            result = objects.read(branch + ':.clonemachine-rules')
+            if result is not None:
+                self.rule_steps.update(parse_rules(result[1].decode('utf-8')))
 
 class Fork:
-    def __init__(self, unit_e_branch = None, bitcoin_branch = None):
+    def __init__(self, unit_e_branch = None, bitcoin_branch = None, jobs = 1, previous_fork = None, cache = None,
+                 instrumentation = None, in_memory = False):
         self.unit_e_branch = unit_e_branch
         self.bitcoin_branch = bitcoin_branch
+        # Branch of an earlier fork from which the files which haven't changed
+        # upstream since then are taken
+        self.previous_fork = previous_fork
+        # Upstream revision the fork is based on, recorded in every commit
+        self.upstream_revision = None
 
         self.config = ForkConfig()
         self.config.read_from_branch(self.unit_e_branch)
 
-        self.processor = Processor(self.config)
+        self.instrumentation = instrumentation
+        self.processor = Processor(self.config, jobs, cache, instrumentation, in_memory)
 
     def show_upstream_diff(self):
+        objects = GitObjectReader.shared()
+        for branch in [self.bitcoin_branch, self.unit_e_branch]:
+            if objects.resolve(branch) is None:
+                sys.exit(f"fatal: unknown branch '{branch}'")
         result = subprocess.run(['git', 'merge-base', self.bitcoin_branch, self.unit_e_branch], stdout=subprocess.PIPE)
         merge_base = result.stdout.decode('utf-8').rstrip()
-        print("Changes of appropriated files since last merge:")
-        for file in self.config.appropriated_files:
-            subprocess.run(['git', 'log', '-p', merge_base + '..' + self.bitcoin_branch, file])
-        print("Changes of removed files since last merge:")
-        for file in self.config.removed_files:
-            subprocess.run(['git', 'log', '-p', merge_base + '..' + self.bitcoin_branch, file])
+        sections = [("appropriated", sorted(self.config.appropriated_files)),
+                    ("removed", sorted(self.config.removed_files))]
+        # The logs of the files are independent, so they are queried at the
+        # same time and printed in the order of the file names
+        results = run_commands([['git', 'log', '-p', merge_base + '..' + self.bitcoin_branch, '--', file]
+                                for kind, files in sections for file in files])
+        for kind, files in sections:
+            print(f"Changes of {kind} files since last merge:", flush=True)
+            for result in results[:len(files)]:
+                sys.stdout.buffer.write(result.stdout)
+                sys.stderr.buffer.write(result.stderr)
+            sys.stdout.buffer.flush()
+            results = results[len(files):]
 
     def commit(self, message):
-        subprocess.run(['git', 'commit', '-am', message])
+        self.processor.flush()
+        print(f"{message.splitlines()[0]}: {self.processor.reset_stats()}", flush=True)
+        if self.upstream_revision:
+            message = message.rstrip('\n') + f'\n\nUpstream-revision: {self.upstream_revision}\n'
+        self.processor.commit(message)
 
     def remove_files(self):
         self.processor.remove_files(self.unit_e_branch)
         self.commit('Remove files')
 
-    def replace_ports(self):
-        msg = 'Change ports\n\n'
-
-        self.processor.replace_recursively("8332", "7181")
-        msg += '* Change mainnet rpc port 8332 into 7181\n'
-
-        self.processor.replace_recursively("8333", "7182")
-        msg += '* Change mainnet port 8333 into 7182\n'
-
-        self.processor.replace_recursively("18332", "17181")
-        msg += '* Change testnet rpc port 18332 into 17181\n'
-
-        self.processor.replace_recursively("18333", "17182")
-        msg += '* Change testnet port 18333 into 17182\n'
-
-        self.processor.replace_recursively("18443", "17291")
-        msg += '* Change regtest rpc port 18443 into 17291\n'
-
-        self.processor.replace_recursively("18444", "17292")
-        msg += '* Change regtest port 18444 into 17292\n'
-
-        self.processor.replace_recursively("28332", "27181")
-        msg += '* Change ssl rpc proxy port 28332 into 27181\n'
-
-        self.commit(msg)
-
-    def replace_testnet3(self):
-        self.processor.replace_recursively("testnet3", "testnet")
-        self.commit('Change testnet directory name testnet3 to testnet')
-
-    def replace_currency_symbol(self):
-        msg = "Change currency symbol\n\n"
-
-        self.processor.replace_recursively("BTC", "UTE", match_before="$|[^a-bd-ln-tv-zA-Z]")
-        msg += "* Change currency token BTC to UTE\n"
-
-        self.processor.replace_in_file('src/test/fs_tests.cpp', '₿', 'U⋮')
-        self.processor.replace_in_file('test/functional/test_runner.py', '₿', 'U⋮')
-        msg += "* Change unicode symbol\n"
-
-        self.commit(msg)
+    def apply_rules(self, name):
+        step = self.config.rule_steps[name]
+        self.processor.apply_rules(step.rules)
+        self.commit(step.commit_message())
 
     def move_paths(self):
         self.processor.apply_recursively(lambda path: self.processor.git_move_file(path, "bitcoin", "unite"))
         self.commit('Move paths containing "bitcoin" to respective "unite" paths')
 
-    def adapt_urls(self):
-        # home page
-        self.processor.replace_recursively("www.bitcoin.org", "unit-e.io")
-        # git instructions
-        self.processor.replace_in_file("contrib/devtools/README.md", "bitcoin/bitcoin", "dtr-org/unit-e")
-        # links to p2p message documentation
-        self.processor.replace_in_file_regex("src/protocol.h",
-            r"https://bitcoin.org/en/developer-reference#(\w+)",
-            r"https://docs.unit-e.io/reference/p2p/\1.html")
-        self.commit('Adapt URLs')
-
     def replace_bitcoin_core_identifiers(self):
         # Identifier in copyright statement
         self.processor.replace_in_file('src/util.cpp', '.find("Bitcoin Core")', '.find("Unit-e")')
@@ -214,7 +233,7 @@ class Fork:
         self.processor.replace_in_file('configure.ac', 'COPYRIGHT_HOLDERS_SUBSTITUTION,[[Bitcoin Core]])',
                                         'COPYRIGHT_HOLDERS_SUBSTITUTION,[[Unit-e]])')
         # all other cases
-        self.processor.apply_recursively(self.processor.substitute_bitcoin_core_identifier_in_file, ['git', 'grep', '-il', 'bitcoin core'])
+        self.processor.substitute_bitcoin_core_identifiers_recursively()
         self.commit('Rename occurences of "bitcoin core" to "unit-e"')
 
     def adapt_executables(self):
@@ -251,44 +270,145 @@ class Fork:
         # default datadir on Unix
         self.processor.replace_recursively("/.bitcoin", "/.unit-e", match_before="")
         # all other cases
-        self.processor.apply_recursively(self.processor.substitute_bitcoin_identifier_in_file, ['git', 'grep', '-il', 'bitcoin', '.'])
+        self.processor.substitute_bitcoin_identifiers_recursively()
         self.commit('Rename occurences of "bitcoin" to "unit-e"')
 
     def adjust_code(self):
-        self.processor.apply_recursively(self.processor.substitute_any(self.config.other_substitutions))
+        self.processor.substitute_any_recursively(self.config.other_substitutions)
         self.commit('Apply adjustments to tests and constants for name changes')
 
-    def replace_unit_names(self):
-        msg = 'Change unit identifier\n\n'
-        self.processor.replace_recursively("COIN", "UNIT")
-        msg += '* Change identifier COIN to UNIT\n'
-
-        self.processor.replace_recursively("CENT", "EEES")
-        msg += '* Change identifier CENT to EEES\n'
-
-        self.commit(msg)
-
     def remove_trailing_whitespace(self):
         self.processor.remove_trailing_whitespace('*.md')
         self.processor.remove_trailing_whitespace('*.py')
         self.commit('Remove trailing whitespace')
 
+    def read_upstream_revision(self, branch):
+        """
+        Return the upstream revision recorded in the commits of a fork.
+        """
+        result = subprocess.run(['git', 'log', '-1', '--format=%B', '--grep=^Upstream-revision: ', branch],
+                                stdout=subprocess.PIPE)
+        match = re.search(r'^Upstream-revision: ([0-9a-f]+)$', result.stdout.decode('utf-8'), re.MULTILINE)
+        if not match:
+            sys.exit(f"fatal: no upstream revision recorded on branch '{branch}'")
+        return match.group(1)
+
+    def select_unchanged_files(self):
+        """
+        Exclude the files which haven't changed upstream since the previous
+        fork from processing, so they can be carried over from it.
+        """
+        previous_revision = self.read_upstream_revision(self.previous_fork)
+        result = subprocess.run(['git', 'diff', '--name-only', '--no-renames', '-z', previous_revision, 'HEAD'],
+                                stdout=subprocess.PIPE, check=True)
+        changed = set(result.stdout.decode('utf8').split('\0'))
+        unchanged = set(self.processor.files().paths()) - changed
+        print(f"Incremental fork of changes since {previous_revision}: "
+              f"{len(changed - {''})} files changed, {len(unchanged)} carried over", flush=True)
+        self.processor.unchanged_paths = unchanged
+
+    def carry_over_files(self):
+        source_revision = self.processor.carry_over_files(self.previous_fork)
+        self.commit(f'Carry over files unchanged upstream from previous fork\n\nSource revision: {source_revision}\n')
+
     def appropriate_files(self):
         source_revision = self.processor.appropriate_files(self.unit_e_branch)
         self.commit(f'Appropriate files from unit-e\n\nSource revision: {source_revision}\n')
 
-    def run(self):
-        self.remove_files()
-        self.replace_ports()
-        self.replace_testnet3()
-        self.replace_currency_symbol()
-        self.adapt_executables()
-        self.move_paths()
-        self.adapt_urls()
-        self.replace_bitcoin_core_identifiers()
-        self.replace_bitcoin_identifiers()
-        self.adjust_code()
-        self.replace_unit_names()
-        self.remove_trailing_whitespace()
+    def steps(self):
+        """
+        Return the steps of the fork in the order in which they are run.
+        Steps are either methods or names of steps of substitution rules.
+        """
+        steps = []
+        if self.previous_fork:
+            steps.append(self.select_unchanged_files)
+        steps += [
+            self.remove_files,
+            "replace_ports",
+            "replace_testnet3",
+            "replace_currency_symbol",
+            self.adapt_executables,
+            self.move_paths,
+            "adapt_urls",
+            self.replace_bitcoin_core_identifiers,
+            self.replace_bitcoin_identifiers,
+            self.adjust_code,
+            "replace_unit_names",
+            self.remove_trailing_whitespace,
+        ]
+        if self.previous_fork:
+            steps.append(self.carry_over_files)
         if self.unit_e_branch:
-            self.appropriate_files()
+            steps.append(self.appropriate_files)
+        return steps
+
+    def show_plan(self):
+        """
+        Print the steps of the fork and how the substitution rules are
+        applied, without changing anything.
+        """
+        for step in self.steps():
+            if not isinstance(step, str):
+                print(f"{step.__name__}")
+                continue
+            rules = self.config.rule_steps[step].rules
+            passes = plan(rules)
+            print(f"{step}: {len(rules)} rules in {len(passes)} passes")
+            for line in format_plan(passes).splitlines():
+                print(f"  {line}")
+
+    def run_step(self, step):
+        if isinstance(step, str):
+            name = step
+            function = lambda: self.apply_rules(name)
+        else:
+            name = step.__name__
+            function = step
+        if self.processor.hits is not None:
+            self.processor.hits.step = name
+        if self.instrumentation is None:
+            function()
+            return
+        with self.instrumentation.measure("step", name):
+            function()
+
+    def run(self):
+        self.upstream_revision = GitObjectReader.shared().resolve('HEAD')
+        with self.processor.pipeline():
+            for step in self.steps():
+                self.run_step(step)
+
+    def convert(self, files):
+        """
+        Run all steps on the given files instead of the tree and return the
+        path each file is moved to in the fork and its contents there, by
+        the given paths. Files removed by the fork are left out. Nothing is
+        committed, progress is not shown and warnings are dropped, as most
+        files the steps refer to are not in the set.
+        """
+        tree = FileSetTree(files)
+        self.processor.warnings = []
+        try:
+            with contextlib.redirect_stdout(io.StringIO()), self.processor.pipeline(tree):
+                for step in self.steps():
+                    self.run_step(step)
+        finally:
+            self.processor.warnings = None
+        return {tree.origins[path]: (path, tree.contents[path]) for path in tree.paths()}
+
+    def plan(self):
+        """
+        Run all steps on a read-only view of the tree and return a report of
+        the files changed by each step and the occurrences found by each
+        substitution, see `HitCounts`.
+        """
+        self.processor.read_only = True
+        hits = self.processor.count_hits()
+        self.run()
+        steps = [step if isinstance(step, str) else step.__name__ for step in self.steps()]
+        report = hits.report(steps)
+        report["upstream_revision"] = self.upstream_revision
+        counts = self.processor.file_counts()
+        report["files"] = {"scanned": counts.scanned, "modified": counts.modified, "cached": counts.cached}
+        return report
@@ -3,21 +3,65 @@
 # Distributed under the MIT software license, see the accompanying
 # file COPYING or https://opensource.org/licenses/MIT.
 
+import multiprocessing
 import sys
+from typing import *
 
 from runner import Runner
 
-if len(sys.argv) < 2 or len(sys.argv) > 3:
-    sys.exit("Usage: create_reference_data.py <label> [bitcoin-branch]")
-label = sys.argv[1]
-bitcoin_branch = "0.17"
-if len(sys.argv) == 3:
-    bitcoin_branch = sys.argv[2]
-runner = Runner("unit-e")
-runner.checkout_unit_e_clone()
-if bitcoin_branch:
+USAGE = """Usage: create_reference_data.py <label> [bitcoin-branch]
+       create_reference_data.py --all
+
+Create the reference data of a fork of the given bitcoin branch under the
+given label, or regenerate the reference data of all labels which are created
+by the tests. Labels are created in parallel, each in a repository of its own.
+"""
+
+def create_fork(label, bitcoin_branch="0.17"):
+    runner = Runner("unit-e", f"reference-{label}")
+    runner.checkout_unit_e_clone()
+    runner.fetch_bitcoin(bitcoin_branch)
+    runner.run_clonemachine()
+    runner.write_diff(label, expected=True, verbose=True)
+
+def create_substitution(label, base_label, command):
+    runner = Runner("unit-e", f"reference-{label}")
+    runner.checkout_unit_e_clone()
+    runner.fetch_bitcoin()
+    runner.apply_diff(base_label)
+    runner.run_clonemachine(command)
+    runner.commit(f"Ran clonemachine.py {command}")
+    runner.write_diff(label, expected=True, verbose=True)
+
+# Labels by the order in which they have to be created, each stage is based
+# on the reference data of the previous ones
+STAGES: List[Dict[str, Tuple[Any, ...]]] = [
+    {
+        "latest": (create_fork, "0.17"),
+        "0.18": (create_fork, "0.18"),
+        "urls": (create_substitution, "naming", "substitute-unit-e-urls"),
+    },
+    {
+        "executables": (create_substitution, "urls", "substitute-unit-e-executables"),
+    },
+]
+
+def create_label(item):
+    label, (function, *arguments) = item
+    function(label, *arguments)
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--all"]:
+        for stage in STAGES:
+            with multiprocessing.Pool(len(stage)) as pool:
+                pool.map(create_label, stage.items())
+        sys.exit()
+    if len(sys.argv) < 2 or len(sys.argv) > 3:
+        sys.exit(USAGE)
+    label = sys.argv[1]
+    bitcoin_branch = "0.17"
+    if len(sys.argv) == 3:
+        bitcoin_branch = sys.argv[2]
     if not bitcoin_branch in ["0.17", "0.18"]:
-        sys.exit("Unrecognized bitcoin branch: '{bitcoin_branch}'")
-runner.fetch_bitcoin(bitcoin_branch)
-runner.run_clonemachine()
-runner.write_diff(label, expected=True, verbose=True)
+        sys.exit(f"Unrecognized bitcoin branch: '{bitcoin_branch}'")
+    create_fork(label, bitcoin_branch)
@@ -0,0 +1,200 @@
+# Copyright (c) 2019 The Unit-e developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or https://opensource.org/licenses/MIT.
+
+# Local fixture repositories for the functional tests
+#
+# The fixtures are small repositories which contain the kinds of files
+# clonemachine handles in the real ones: a "bitcoin" upstream and a "unit-e"
+# fork with a `.clonemachine` configuration, appropriated and removed files.
+# They are created without network access and cached as git bundles.
+
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+from pathlib import Path
+from typing import *
+
+# Files of the upstream revision unit-e was forked from
+BITCOIN_FILES = {
+    "README.md": "Bitcoin Core integration/staging tree\n"
+                 "=====================================\n\n"
+                 "https://bitcoincore.org\n",
+    "CONTRIBUTING.md": "Contributing to Bitcoin Core\n"
+                       "============================\n\n"
+                       "The Bitcoin Core project operates an open contributor model.\n",
+    "doc/developer-notes.md": "Developer Notes\n===============\n\nRun bitcoind with -debug.\n",
+    "contrib/devtools/copyright_header.py": "# Copyright (c) 2016-2018 The Bitcoin Core developers\n"
+                                            "HOLDER = 'The Bitcoin Core developers'\n",
+    "contrib/devtools/README.md": "Clone with `git clone https://github.com/bitcoin/bitcoin`.\n"
+                                 "Check out bitcoin/bitcoin#1234.\n",
+    ".github/ISSUE_TEMPLATE.md": "Describe the issue with Bitcoin Core\n",
+    "contrib/verify-commits/trusted-keys": "71A3B16735405025D447E8F274810B012346C9A6\n",
+    "configure.ac": "AC_INIT([Bitcoin Core],[0.17.0],[https://github.com/bitcoin/bitcoin/issues],[bitcoin])\n"
+                    "AC_DEFINE(COPYRIGHT_HOLDERS_SUBSTITUTION,[[Bitcoin Core]])\n"
+                    "BITCOIN_DAEMON_NAME=bitcoind\n"
+                    "BITCOIN_CLI_NAME=bitcoin-cli\n",
+    "src/amount.h": "static const CAmount COIN = 100000000;\n"
+                    "static const CAmount CENT = 1000000;\n"
+                    "static const CAmount MAX_MONEY = 21000000 * COIN;\n",
+    "src/chainparamsbase.cpp": "return MakeUnique<CBaseChainParams>(\"\", 8332);\n"
+                               "return MakeUnique<CBaseChainParams>(\"testnet3\", 18332);\n"
+                               "return MakeUnique<CBaseChainParams>(\"regtest\", 18443);\n",
+    "src/chainparams.cpp": "nDefaultPort = 8333;\n"
+                           "nDefaultPort = 18333;\n"
+                           "nDefaultPort = 18444;\n"
+                           "// A BTC is worth 100000000 satoshis\n",
+    "src/bitcoind.cpp": "// Bitcoin Core daemon\n"
+                        "#include <bitcoin-config.h>\n"
+                        "const char * const BITCOIN_CONF_FILENAME = \"bitcoin.conf\";\n"
+                        "// Start bitcoind with the default datadir ~/.bitcoin\n",
+    "src/util.cpp": "if (copyright_devs.find(\"Bitcoin Core\") == std::string::npos) {\n"
+                    "    strCopyrightHolders += \"\\n\" + strPrefix + \"The Bitcoin Core developers\";\n"
+                    "}\n",
+    "src/protocol.h": "/** See https://bitcoin.org/en/developer-reference#version */\n"
+                      "extern const char *VERSION;\n",
+    "src/clientversion.cpp": "const std::string CLIENT_NAME(\"Satoshi\");\n",
+    "src/validation.cpp": "// Validation of blocks\nint64_t nMaxTipAge = 24 * 60 * 60;\n",
+    "src/test/fs_tests.cpp": "const std::string test1 = \"fs_tests_₿_🏃\";\n",
+    "src/leveldb/db/db_impl.cc": "// Used by bitcoin, must not be changed\n",
+    "src/qt/bitcoin.cpp": "// Bitcoin Qt GUI, the directory is removed in unit-e\n",
+    "doc/zmq.md": "Bitcoind appends the transaction hash to the notification.   \n",
+    "doc/README_windows.txt": "Bitcoin Core for Windows\r\n\r\nRun bitcoin-qt.exe.\r\n",
+    "test/functional/wallet_labels.py": "# Each label gets 50 Bitcoins\n"
+                                        "assert_equal(node.getbalance(), 50)    \n",
+    "test/functional/test_runner.py": "TEST_EXIT_PASSED = 0\n"
+                                      "GREEN = ('\\033[0m', '\\033[0;32m')\n"
+                                      "TICK = '✓ '\n"
+                                      "# Unicode is supported, as in ₿\n",
+    "test/functional/interface_bitcoin_cli.py": "\"\"\"Test bitcoin-cli\"\"\"\n"
+                                                "self.nodes[0].cli('-getinfo').send_cli()\n",
+    "test/functional/test_framework/test_framework.py": "binary = self.options.bitcoind\n"
+                                                        "cli = self.options.bitcoincli\n",
+}
+
+# Executable files of upstream
+BITCOIN_EXECUTABLES = {
+    "contrib/bitcoin-qt.pro.sh": "#!/bin/sh\n# Build bitcoin-qt\n",
+}
+
+# Binary files of upstream, with a name which is moved
+BITCOIN_BINARIES = {
+    "share/pixmaps/bitcoin.ico": b"\0\0\1\0bitcoin\0\xff\xfe",
+}
+
+# Changes of upstream after unit-e was forked, to appropriated, removed and
+# other files, and a new file
+BITCOIN_UPDATE = {
+    "CONTRIBUTING.md": BITCOIN_FILES["CONTRIBUTING.md"] + "\nSquash your commits before the merge.\n",
+    ".github/ISSUE_TEMPLATE.md": "Describe the issue with Bitcoin Core and how to reproduce it\n",
+    "src/amount.h": BITCOIN_FILES["src/amount.h"] + "static const CAmount DUST = CENT / 100;\n",
+    "src/validation.cpp": BITCOIN_FILES["src/validation.cpp"] + "// Set it with bitcoind -maxtipage\n",
+    "src/bitcoind-wallet.cpp": "// Wallet of bitcoind\n",
+}
+
+# Files of unit-e which differ from upstream
+UNIT_E_FILES = {
+    ".clonemachine": "appropriated_files:\n"
+                     "  - doc/unit-e.md\n"
+                     "removed_files:\n"
+                     "  - contrib/verify-commits/trusted-keys\n",
+    "README.md": "Unit-e\n======\n\nhttps://unit-e.io\n",
+    "CONTRIBUTING.md": "Contributing to unit-e\n======================\n\nSee our code of conduct.\n",
+    "doc/developer-notes.md": "Developer Notes\n===============\n\nRun unit-e with -debug=all.\n",
+    "contrib/devtools/copyright_header.py": "# Copyright (c) 2018-2019 The Unit-e developers\n"
+                                            "HOLDER = 'The Unit-e developers'\n",
+    # Written with the naming of an older version of clonemachine
+    "doc/unit-e.md": "UnitE Core\n==========\n\n"
+                     "UnitE is a digital currency. See www.unite.org and the BIPs at\n"
+                     "https://github.com/unite/bips.\n",
+}
+
+# Date of all commits, so the revisions of the fixtures are always the same
+COMMIT_DATE = "2019-05-01T12:00:00+00:00"
+
+class Fixtures(NamedTuple):
+    bitcoin: Path
+    unit_e: Path
+
+def git(arguments: List[str], cwd: Path):
+    env = dict(os.environ,
+               GIT_AUTHOR_NAME="clonemachine", GIT_AUTHOR_EMAIL="clonemachine@example.com",
+               GIT_COMMITTER_NAME="clonemachine", GIT_COMMITTER_EMAIL="clonemachine@example.com",
+               GIT_AUTHOR_DATE=COMMIT_DATE, GIT_COMMITTER_DATE=COMMIT_DATE)
+    subprocess.run(["git"] + arguments, cwd=cwd, env=env, stdout=subprocess.DEVNULL, check=True)
+
+def write_files(path: Path, files: Mapping[str, Union[str, bytes]], executable: bool = False):
+    for name, contents in files.items():
+        file_name = path / name
+        file_name.parent.mkdir(parents=True, exist_ok=True)
+        with file_name.open("wb") as file:
+            file.write(contents.encode("utf-8") if isinstance(contents, str) else contents)
+        if executable:
+            file_name.chmod(0o755)
+
+def create_bitcoin_repo(path: Path):
+    """
+    Create the upstream repository. The branch `0.17` is the revision unit-e
+    was forked from, `master` has some more changes.
+    """
+    git(["init", "-q", str(path)], path.parent)
+    git(["symbolic-ref", "HEAD", "refs/heads/master"], path)
+    write_files(path, BITCOIN_FILES)
+    write_files(path, BITCOIN_EXECUTABLES, executable=True)
+    write_files(path, BITCOIN_BINARIES)
+    git(["add", "."], path)
+    git(["commit", "-q", "-m", "Bitcoin 0.17"], path)
+    git(["branch", "0.17"], path)
+    write_files(path, BITCOIN_UPDATE)
+    git(["add", "."], path)
+    git(["commit", "-q", "-m", "Update upstream"], path)
+
+def create_unit_e_repo(path: Path, bitcoin: Path):
+    """
+    Create the unit-e repository, whose `master` branch is forked from the
+    `0.17` branch of upstream.
+    """
+    git(["clone", "-q", "--branch", "0.17", str(bitcoin), str(path)], path.parent)
+    git(["checkout", "-q", "-b", "master"], path)
+    git(["branch", "-q", "-D", "0.17"], path)
+    git(["remote", "remove", "origin"], path)
+    write_files(path, UNIT_E_FILES)
+    git(["add", "."], path)
+    git(["commit", "-q", "-m", "Unit-e"], path)
+
+def fixtures_key() -> str:
+    """
+    Return a key of the contents of the fixtures, which changes when this
+    file is changed.
+    """
+    return hashlib.sha1(Path(__file__).read_bytes()).hexdigest()[:12]
+
+def build(cache_path: Path) -> Fixtures:
+    """
+    Return the bundles of the fixture repositories, which are created in the
+    cache directory if they don't exist yet.
+    """
+    path = cache_path / fixtures_key()
+    fixtures = Fixtures(path / "bitcoin.bundle", path / "unit-e.bundle")
+    if path.exists():
+        return fixtures
+    cache_path.mkdir(parents=True, exist_ok=True)
+    for stale in cache_path.glob("[0-9a-f]" * 12):
+        shutil.rmtree(stale, ignore_errors=True)
+    with tempfile.TemporaryDirectory(dir=cache_path) as tmp_dir:
+        build_path = Path(tmp_dir)
+        create_bitcoin_repo(build_path / "bitcoin")
+        create_unit_e_repo(build_path / "unit-e", build_path / "bitcoin")
+        bundles = build_path / "bundles"
+        bundles.mkdir()
+        git(["bundle", "create", str(bundles / "bitcoin.bundle"), "HEAD", "--branches"], build_path / "bitcoin")
+        git(["bundle", "create", str(bundles / "unit-e.bundle"), "HEAD", "--branches"], build_path / "unit-e")
+        try:
+            bundles.rename(path)
+        except OSError:
+            # Built at the same time by another process
+            if not path.exists():
+                raise
+    return fixtures
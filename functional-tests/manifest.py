@@ -0,0 +1,149 @@
+# Copyright (c) 2019 The Unit-e developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or https://opensource.org/licenses/MIT.
+
+# Reference data of the regression tests
+#
+# The expected result of a fork is stored as a manifest, which lists every
+# file changed compared to upstream with the blob hash of its expected
+# contents, and a zip file with the diff of each of these files. A check
+# compares the manifest with `git diff --raw` and only diffs the files
+# whose hashes differ.
+
+import difflib
+import zipfile
+from typing import *
+
+# Hash git uses for the contents of removed files
+ZERO_HASH = "0" * 40
+
+# Hash in a manifest of renamed files which are unchanged
+SAME_AS_SOURCE = "="
+
+class RawEntry(NamedTuple):
+    """
+    A file in the output of `git diff --raw`.
+    """
+    status: str
+    old_hash: str
+    new_hash: str
+    path: str
+    source: Optional[str] = None
+
+class ManifestEntry(NamedTuple):
+    """
+    A changed file in the manifest. The blob hash may be abbreviated. Renamed
+    files have the path they are renamed from as source.
+    """
+    path: str
+    blob_hash: str
+    source: Optional[str] = None
+
+    def matches(self, actual: RawEntry) -> bool:
+        if self.source != actual.source:
+            return False
+        if self.blob_hash == SAME_AS_SOURCE:
+            return actual.old_hash == actual.new_hash
+        return actual.new_hash.startswith(self.blob_hash)
+
+    @classmethod
+    def from_raw(cls, entry: RawEntry) -> 'ManifestEntry':
+        return cls(entry.path, entry.new_hash, entry.source)
+
+def parse_raw_diff(output: bytes) -> List[RawEntry]:
+    """
+    Parse the output of `git diff --raw -z --no-abbrev`.
+    """
+    entries = []
+    fields = output.decode("utf-8").split("\0")
+    index = 0
+    while index < len(fields) - 1:
+        old_mode, new_mode, old_hash, new_hash, status = fields[index].lstrip(":").split(" ")
+        if status[0] in "RC":
+            entries.append(RawEntry(status, old_hash, new_hash, fields[index + 2], fields[index + 1]))
+            index += 3
+        else:
+            entries.append(RawEntry(status, old_hash, new_hash, fields[index + 1]))
+            index += 2
+    return entries
+
+def read_manifest(path) -> Iterator[ManifestEntry]:
+    with open(path) as file:
+        for line in file:
+            if line.startswith("#") or not line.strip():
+                continue
+            fields = line.rstrip("\n").split("\t")
+            yield ManifestEntry(fields[1], fields[0], fields[2] if len(fields) > 2 else None)
+
+def write_manifest(path, entries: Iterable[ManifestEntry], header: str = ""):
+    with open(path, "w") as file:
+        file.write(header)
+        for entry in entries:
+            fields = [entry.blob_hash, entry.path] + ([entry.source] if entry.source else [])
+            file.write("\t".join(fields) + "\n")
+
+def split_diff(lines: Iterable[bytes]) -> Iterator[bytes]:
+    """
+    Split a diff into the diffs of the files it changes.
+    """
+    section: List[bytes] = []
+    for line in lines:
+        if line.startswith(b"diff --git ") and section:
+            yield b"".join(section)
+            section = []
+        section.append(line)
+    if section:
+        yield b"".join(section)
+
+def write_hunks(path, entries: Sequence[ManifestEntry], lines: Iterable[bytes]):
+    """
+    Store the diffs of the files of a manifest in a zip file under the paths
+    of the files. The diffs have to be in the order of the manifest.
+    """
+    count = 0
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as hunks:
+        for entry, section in zip(entries, split_diff(lines)):
+            hunks.writestr(entry.path, section)
+            count += 1
+    if count != len(entries):
+        raise RuntimeError(f"Diff has {count} files, manifest has {len(entries)}")
+
+def read_patch(manifest_path, hunks_path) -> bytes:
+    """
+    Return the diff of all files of a manifest as one patch.
+    """
+    with zipfile.ZipFile(hunks_path) as hunks:
+        return b"".join(hunks.read(entry.path) for entry in read_manifest(manifest_path))
+
+class Mismatch(NamedTuple):
+    path: str
+    expected: Optional[ManifestEntry]
+    actual: Optional[RawEntry]
+
+    def summary(self) -> str:
+        if self.actual is None:
+            return f"{self.path}: expected change is missing"
+        if self.expected is None:
+            return f"{self.path}: unexpected change"
+        if self.expected.source != self.actual.source:
+            return f"{self.path}: expected to be renamed from {self.expected.source}, got {self.actual.source}"
+        return f"{self.path}: expected blob {self.expected.blob_hash}, got {self.actual.new_hash[:9]}"
+
+def compare(expected: Iterable[ManifestEntry], actual: Sequence[RawEntry]) -> List[Mismatch]:
+    """
+    Return the files whose actual change doesn't match the manifest, in the
+    order of the manifest followed by unexpected files.
+    """
+    remaining = {entry.path: entry for entry in actual}
+    mismatches = []
+    for entry in expected:
+        actual_entry = remaining.pop(entry.path, None)
+        if actual_entry is None or not entry.matches(actual_entry):
+            mismatches.append(Mismatch(entry.path, entry, actual_entry))
+    mismatches += [Mismatch(path, None, entry) for path, entry in remaining.items()]
+    return mismatches
+
+def diff_hunks(path: str, expected: bytes, actual: bytes) -> str:
+    return "".join(difflib.unified_diff(expected.decode("utf-8", "replace").splitlines(keepends=True),
+                                        actual.decode("utf-8", "replace").splitlines(keepends=True),
+                                        f"expected/{path}", f"actual/{path}"))
@@ -6,25 +6,49 @@ import subprocess
 from pathlib import Path
 import os
 import datetime
+import fcntl
+import shutil
+from contextlib import contextmanager
+import zipfile
 import yaml
 
 import sys
 from os.path import dirname, abspath
 sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from cache import git_blob_hash
+from commands import run_commands
 from fork import ForkConfig
+import fixtures
+from manifest import (ManifestEntry, ZERO_HASH, parse_raw_diff, read_manifest, write_manifest,
+                      write_hunks, read_patch, compare, diff_hunks)
 from processor import Processor
 
 class Runner:
-    def __init__(self, git_dir):
+    """Runs clonemachine and git on a repository of its own, so tests can run
+    in parallel. The repository is created in `tmp/isolated/<shared_dir>/<name>`
+    and borrows the objects of the clone in `tmp/<shared_dir>` through git
+    alternates, so it takes no time and space to create. The shared clone is
+    only changed while holding a lock.
+    """
+    def __init__(self, shared_dir, name="default"):
         self.base_path = Path(os.path.dirname(__file__))
         self.tmp_path = self.base_path / "tmp"
         self.tmp_path.mkdir(exist_ok=True)
-        self.git_dir = self.tmp_path / git_dir
+        self.shared_dir = self.tmp_path / shared_dir
+        self.git_dir = self.tmp_path / "isolated" / shared_dir / name
+        self.name = name
         self.test_data_path = self.base_path / "test_data"
         self.clonemachine = (self.base_path / "../clonemachine.py").resolve()
         self.bitcoin_branch = "0.17"
         self.unite_git_revision_known = "cc3bb51638a2e3dc756412f055aae92ae305a467"
 
+    @classmethod
+    def for_test(cls, shared_dir, request):
+        """Return a runner with a repository of its own for the test of the
+        given pytest request.
+        """
+        return cls(shared_dir, f"{request.module.__name__}.{request.node.name}")
+
     def run_git(self, arguments, cwd=None):
         if not cwd:
             cwd = self.git_dir
@@ -32,45 +56,102 @@ class Runner:
         output = result.stdout.rstrip().decode("utf-8")
         return output
 
+    def run_git_concurrently(self, commands, cwd=None):
+        """Run independent git commands at the same time and return their
+        outputs in the order of the commands.
+        """
+        if not cwd:
+            cwd = self.git_dir
+        results = run_commands([["git"] + arguments for arguments in commands], cwd=cwd, check=True)
+        return [result.stdout.rstrip().decode("utf-8") for result in results]
+
     def run_git_clone(self, remote, shallow=False, branch=None):
         args = ["clone"]
         if shallow:
             args += ["--depth", "1"]
         if branch:
             args += ["--branch", branch]
-        args.append(remote)
+        args += [remote, str(self.shared_dir)]
         self.run_git(args, cwd=self.tmp_path)
 
+    @contextmanager
+    def shared_clone_lock(self):
+        """Hold an exclusive lock on the shared clone, so it's set up only
+        once when tests run in several processes.
+        """
+        with open(str(self.shared_dir) + ".lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def create_isolated_repo(self):
+        """Create an empty repository in `git_dir` which uses the objects of
+        the shared clone.
+        """
+        if os.path.exists(self.git_dir):
+            shutil.rmtree(self.git_dir)
+        self.git_dir.mkdir(parents=True)
+        self.run_git(["init", "-q"])
+        shared_git_dir = self.shared_dir / ".git"
+        with (self.git_dir / ".git" / "objects" / "info" / "alternates").open("w") as file:
+            file.write(str((shared_git_dir / "objects").resolve()) + "\n")
+        if (shared_git_dir / "shallow").exists():
+            shutil.copy(str(shared_git_dir / "shallow"), str(self.git_dir / ".git" / "shallow"))
+
     def checkout_unit_e_clone(self, label=None):
-        if not os.path.exists(self.git_dir):
-            self.run_git_clone("git@github.com:dtr-org/unit-e")
+        with self.shared_clone_lock():
+            if not os.path.exists(self.shared_dir):
+                self.run_git_clone("git@github.com:dtr-org/unit-e")
         if label:
-            meta_file = self.test_data_path / f"clonemachine-{label}-expected.diff.meta"
+            meta_file = self.test_data_path / f"clonemachine-{label}-expected.meta"
             with meta_file.open() as file:
                 meta_data = yaml.safe_load(file)
             unit_e_revision = meta_data["unit_e_git_revision"]
         else:
             unit_e_revision = self.unite_git_revision_known
-        self.run_git(["checkout", "master"])
-        self.run_git(["reset", "--hard", unit_e_revision])
+        self.create_isolated_repo()
+        self.run_git(["checkout", "-q", "-B", "master", unit_e_revision])
 
     def checkout_shallow_bitcoin_clone(self):
         bitcoin_revision_file = self.tmp_path / "bitcoin-revision"
 
-        if os.path.exists(self.git_dir):
-            with open(bitcoin_revision_file, "r") as file:
-                self.bitcoin_git_revision = file.read()
-        else:
-            self.run_git_clone("https://github.com/bitcoin/bitcoin",
-                    shallow=True, branch=self.bitcoin_branch)
-            self.bitcoin_git_revision = self.get_git_revision()
-            with open(bitcoin_revision_file, "w") as file:
-                file.write(self.bitcoin_git_revision)
+        with self.shared_clone_lock():
+            if os.path.exists(self.shared_dir):
+                with open(bitcoin_revision_file, "r") as file:
+                    self.bitcoin_git_revision = file.read()
+            else:
+                self.run_git_clone("https://github.com/bitcoin/bitcoin",
+                        shallow=True, branch=self.bitcoin_branch)
+                self.bitcoin_git_revision = self.get_git_revision(cwd=self.shared_dir)
+                with open(bitcoin_revision_file, "w") as file:
+                    file.write(self.bitcoin_git_revision)
+        self.create_isolated_repo()
         self.run_git(["checkout", self.bitcoin_git_revision])
         git_revision = self.get_git_revision()
         if git_revision != self.bitcoin_git_revision:
             raise RuntimeError(f"Expected git revision '{self.bitcoin_git_revision}', got '{git_revision}'")
 
+    def checkout_fixture(self):
+        """Set up a clone of the local unit-e fixture repository with the
+        bitcoin fixture as remote `upstream` and check out upstream master.
+        It's recreated every time, which takes less than a second and needs
+        no network access.
+        """
+        with self.shared_clone_lock():
+            bundles = fixtures.build(self.tmp_path / "fixtures")
+        if os.path.exists(self.git_dir):
+            shutil.rmtree(self.git_dir)
+        self.run_git(["clone", "-q", str(bundles.unit_e), str(self.git_dir)], cwd=self.tmp_path)
+        self.run_git(["config", "user.name", "clonemachine"])
+        self.run_git(["config", "user.email", "clonemachine@example.com"])
+        self.run_git(["remote", "add", "upstream", str(bundles.bitcoin)])
+        self.run_git(["fetch", "-q", "upstream"])
+        self.bitcoin_branch = "upstream/master"
+        self.bitcoin_git_revision = self.get_git_revision(self.bitcoin_branch)
+        self.checkout_bitcoin()
+
     def add_clonemachine_config(self, config):
         with Path(self.git_dir, ".clonemachine").open("w") as file:
             file.write(config)
@@ -86,10 +167,11 @@ class Runner:
             raise Exception("Unrecognized bitcoin branch: '{self.bitcoin_branch}'")
         self.bitcoin_branch = branch
 
-        remotes = self.run_git(["remote"])
-        if remotes == "origin":
-            self.run_git(["remote", "add", "upstream", "https://github.com/bitcoin/bitcoin"])
-            self.run_git(["fetch", "upstream"])
+        with self.shared_clone_lock():
+            remotes = self.run_git(["remote"], cwd=self.shared_dir)
+            if remotes == "origin":
+                self.run_git(["remote", "add", "upstream", "https://github.com/bitcoin/bitcoin"], cwd=self.shared_dir)
+                self.run_git(["fetch", "upstream"], cwd=self.shared_dir)
         self.checkout_bitcoin()
 
     def checkout_bitcoin(self):
@@ -98,10 +180,10 @@ class Runner:
         if git_revision != self.bitcoin_git_revision:
             raise RuntimeError(f"Expected git revision '{self.bitcoin_git_revision}', got '{git_revision}'")
 
-    def run_clonemachine(self, cmd="fork", cwd=None):
+    def run_clonemachine(self, cmd="fork", cwd=None, options=[]):
         if cwd is None:
             cwd = self.git_dir
-        cmd = [self.clonemachine, cmd]
+        cmd = [self.clonemachine, cmd] + options
         return subprocess.run(cmd, cwd = cwd, stdout=subprocess.PIPE, check=True)
 
     def get_commit_date(self, git_revision, git_dir=None):
@@ -117,11 +199,31 @@ class Runner:
             cwd = self.git_dir
         return self.run_git(["rev-parse", rev], cwd=cwd)
 
-    def write_diff(self, label, expected=False, verbose=False):
+    def diff_options(self):
+        """Return the options of `git diff` which compare the fork with
+        upstream, leaving out appropriated and removed files.
+        """
         config = ForkConfig()
         config.read_from_branch("master", self.git_dir)
         exclude_files = config.appropriated_files + config.removed_files
+        return ["-M", self.bitcoin_git_revision] + [f":(exclude){filename}" for filename in exclude_files]
+
+    def changed_files(self):
+        """Return the files which differ from upstream as entries of
+        `git diff --raw`.
+        """
+        result = subprocess.run(["git", "diff", "--raw", "-z", "--no-abbrev"] + self.diff_options(),
+                                cwd=self.git_dir, stdout=subprocess.PIPE, check=True)
+        entries = []
+        for entry in parse_raw_diff(result.stdout):
+            if entry.new_hash == ZERO_HASH and entry.status != "D":
+                # Files which are not up to date in the index have no hash yet
+                with open(self.git_dir / entry.path, "rb") as file:
+                    entry = entry._replace(new_hash=git_blob_hash(file.read()))
+            entries.append(entry)
+        return entries
 
+    def write_diff(self, label, expected=False, verbose=False):
         if verbose:
             print(f"Writing diff '{label}' ...")
 
@@ -129,18 +231,26 @@ class Runner:
             suffix = "expected"
         else:
             suffix = "actual"
-        clonemachine_filename = f"clonemachine-{label}-{suffix}.diff"
-        diff_file = self.test_data_path / clonemachine_filename
-
-        exclude_options = [f":(exclude){filename}" for filename in exclude_files]
-        diff = self.run_git(["diff", self.bitcoin_git_revision] + exclude_options)
+        clonemachine_filename = f"clonemachine-{label}-{suffix}"
+        manifest_file = self.test_data_path / (clonemachine_filename + ".manifest")
 
-        with diff_file.open("w") as file:
-            file.write(diff)
-            file.write("\n")
+        entries = [ManifestEntry.from_raw(entry) for entry in self.changed_files()]
+        write_manifest(manifest_file, entries,
+                       f"# Files changed by clonemachine compared to bitcoin {self.bitcoin_git_revision}\n")
+        if expected:
+            # The diffs are only needed to show how a mismatching file differs
+            # and to apply the expected changes
+            with subprocess.Popen(["git", "diff"] + self.diff_options(), cwd=self.git_dir,
+                                  stdout=subprocess.PIPE) as process:
+                write_hunks(self.test_data_path / (clonemachine_filename + ".hunks.zip"), entries, process.stdout)
+            if process.returncode != 0:
+                raise subprocess.CalledProcessError(process.returncode, process.args)
 
-        clonemachine_git_revision = self.get_git_revision(cwd=".")
-        if self.run_git(["diff-index", "HEAD"], "."):
+        clonemachine_git_revision, clonemachine_changes = self.run_git_concurrently([
+            ["rev-parse", "HEAD"],
+            ["diff-index", "HEAD"],
+        ], ".")
+        if clonemachine_changes:
             clonemachine_git_revision += "+changes"
 
         unite_git_revision_master = self.get_git_revision("master")
@@ -164,7 +274,9 @@ class Runner:
             print(meta_output)
 
     def apply_diff(self, label):
-        self.run_git(["apply", self.test_data_path / f"clonemachine-{label}-expected.diff"])
+        patch = read_patch(self.test_data_path / f"clonemachine-{label}-expected.manifest",
+                           self.test_data_path / f"clonemachine-{label}-expected.hunks.zip")
+        subprocess.run(["git", "apply"], cwd=self.git_dir, input=patch, check=True)
         self.commit(f"Apply diff {label}")
 
     def commit(self, message):
@@ -172,11 +284,31 @@ class Runner:
         self.run_git(["commit", "-m", message])
 
     def compare_latest_diffs(self, label):
-        expected_file = self.test_data_path / f"clonemachine-{label}-expected.diff"
-        actual_file = self.test_data_path / f"clonemachine-{label}-actual.diff"
-        result = subprocess.run(["diff", "-u", expected_file, actual_file], stdout=subprocess.PIPE)
-        diff = result.stdout.decode("utf-8")
-        if diff:
-            with Path(self.base_path / "tmp" / "diff.diff").open("w") as file:
-                file.write(diff)
+        """Compare the files changed by clonemachine with the expected ones of
+        the given label. Return a summary of the files which don't match,
+        together with a diff of their expected and actual changes, or an
+        empty string if all files match.
+        """
+        mismatches = compare(read_manifest(self.test_data_path / f"clonemachine-{label}-expected.manifest"),
+                             self.changed_files())
+        if not mismatches:
+            return ""
+
+        commands = []
+        for mismatch in mismatches:
+            paths = {mismatch.path}
+            for entry in [mismatch.expected, mismatch.actual]:
+                if entry is not None and entry.source is not None:
+                    paths.add(entry.source)
+            commands.append(["git", "diff", "-M", self.bitcoin_git_revision, "--"] + sorted(paths))
+        actual_hunks = run_commands(commands, cwd=self.git_dir, check=True)
+
+        report = [mismatch.summary() + "\n" for mismatch in mismatches]
+        with zipfile.ZipFile(self.test_data_path / f"clonemachine-{label}-expected.hunks.zip") as hunks:
+            for mismatch, actual in zip(mismatches, actual_hunks):
+                expected = hunks.read(mismatch.path) if mismatch.expected is not None else b""
+                report.append(diff_hunks(mismatch.path, expected, actual.stdout))
+        diff = "".join(report)
+        with Path(self.base_path / "tmp" / f"diff-{label}.diff").open("w") as file:
+            file.write(diff)
         return diff
@@ -0,0 +1,150 @@
+# Copyright (c) 2019 The Unit-e developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or https://opensource.org/licenses/MIT.
+
+# Functional tests for clonemachine on local fixture repositories, which
+# don't need network access
+#
+# Run it with `pytest -v test_fixtures.py`
+
+import pytest
+import os
+import subprocess
+
+from runner import Runner
+
+@pytest.fixture
+def runner(request):
+    """Set up a clone of the fixture repositories and return a runner to run
+    operations on it.
+    """
+    runner = Runner.for_test("fixture-unit-e", request)
+    runner.checkout_fixture()
+    return runner
+
+def test_fork(runner):
+    runner.run_clonemachine()
+
+    with open(runner.git_dir / "src/amount.h") as file:
+        assert "static const CAmount UNIT = 100000000;\n" in file.read()
+    assert os.path.isfile(runner.git_dir / "src/unit-e.cpp")
+    assert not os.path.exists(runner.git_dir / "src/bitcoind.cpp")
+    assert os.access(runner.git_dir / "contrib/unite-qt.pro.sh", os.X_OK)
+    # Excluded paths are left alone
+    assert runner.run_git(["diff", runner.bitcoin_git_revision, "--", "src/leveldb", "src/qt"]) == ""
+
+    # Every commit records the upstream revision
+    messages = runner.run_git(["log", "--format=%B%x00", f"{runner.bitcoin_git_revision}..HEAD"]).split("\0")[:-1]
+    assert len(messages) == 13
+    for message in messages:
+        assert f"\nUpstream-revision: {runner.bitcoin_git_revision}\n" in message
+    assert runner.run_git(["status", "--porcelain"]) == ""
+
+@pytest.mark.parametrize("options", [["--jobs=4"], ["--incremental=previous"], ["--in-memory"]])
+def test_fork_options(runner, options):
+    # Options which change how the fork is done give the same result
+    def fork(branch, options, upstream="upstream/master"):
+        runner.run_git(["checkout", "-q", "-b", branch, upstream])
+        runner.run_clonemachine(options=["--no-cache"] + options)
+        return runner.get_git_revision("HEAD^{tree}")
+
+    # Fork of the upstream revision before, for incremental forks
+    fork("previous", [], "upstream/0.17")
+    assert fork("with-options", options) == fork("default", [])
+
+def test_appropriation(runner):
+    runner.run_clonemachine()
+
+    assert runner.run_git(["diff", "master", "--", "CONTRIBUTING.md", "README.md", "doc/unit-e.md"]) == ""
+    appropriated_files = runner.run_git(["diff-tree", "--name-only", "--no-commit-id", "-r", "HEAD"])
+    assert appropriated_files.splitlines() == [
+        "CONTRIBUTING.md",
+        "README.md",
+        "contrib/devtools/copyright_header.py",
+        "doc/developer-notes.md",
+        "doc/unit-e.md",
+    ]
+    commit_msg = runner.run_git(["log", "-1", "--pretty=%B"])
+    assert "revision: " + runner.get_git_revision("master") in commit_msg
+
+def test_remove_files(runner):
+    files_to_be_removed = [".github/ISSUE_TEMPLATE.md", "contrib/verify-commits/trusted-keys"]
+    for file in files_to_be_removed:
+        assert os.path.isfile(runner.git_dir / file)
+
+    runner.run_clonemachine()
+    for file in files_to_be_removed:
+        assert not os.path.exists(runner.git_dir / file)
+
+def test_idempotence(runner):
+    runner.run_clonemachine()
+    git_revision = runner.get_git_revision()
+    runner.run_clonemachine()
+    assert runner.get_git_revision() == git_revision
+
+def test_show_upstream_diff(runner):
+    runner.run_git(["checkout", "master"])
+    result = runner.run_clonemachine("show-upstream-diff", options=["--bitcoin-branch=upstream/master"])
+    output = result.stdout.decode("utf-8")
+
+    appropriated, removed = output.split("Changes of removed files since last merge:\n")
+    assert appropriated.startswith("Changes of appropriated files since last merge:\n")
+    assert "+Squash your commits before the merge.\n" in appropriated
+    assert "+Describe the issue with Bitcoin Core and how to reproduce it\n" in removed
+    assert "DUST" not in output
+
+def test_substitute_unit_e_naming(runner):
+    runner.run_git(["checkout", "master"])
+    runner.run_clonemachine("substitute-unit-e-naming")
+    runner.run_clonemachine("substitute-unit-e-urls")
+
+    with open(runner.git_dir / "doc/unit-e.md") as file:
+        assert file.read() == ("unit-e\n==========\n\n"
+                               "Unit-e is a digital currency. See unit-e.io and the BIPs at\n"
+                               "https://github.com/bitcoin/bips.\n")
+
+def test_merge_driver(runner):
+    # Fork the upstream revision unit-e is based on and merge it, as it's done
+    # without the merge driver
+    runner.run_git(["checkout", "-q", "-b", "integration", "upstream/0.17"])
+    runner.run_clonemachine()
+    runner.run_git(["checkout", "-q", "master"])
+    runner.run_git(["merge", "-q", "--no-edit", "integration"])
+
+    runner.run_git(["config", "merge.clonemachine.driver",
+                    f"{runner.clonemachine} merge-driver --marker-size=%L %O %A %B %P"])
+    with open(runner.git_dir / ".git/info/attributes", "w") as file:
+        file.write("* merge=clonemachine\n")
+    result = subprocess.run(["git", "merge", "--no-edit", "upstream/master"], cwd=runner.git_dir,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    assert result.returncode == 1
+    # Files removed by the fork conflict with upstream changes, as without the
+    # merge driver, everything else is merged cleanly
+    assert runner.run_git(["diff", "--name-only", "--diff-filter=U"]) == ".github/ISSUE_TEMPLATE.md"
+    # Files git has taken over from upstream are converted afterwards
+    with open(runner.git_dir / "src/validation.cpp") as file:
+        assert file.read().endswith("// Set it with bitcoind -maxtipage\n")
+    assert os.path.isfile(runner.git_dir / "src/bitcoind-wallet.cpp")
+    runner.run_clonemachine("convert-merge")
+    assert runner.run_git(["diff", "--name-only", "--diff-filter=U"]) == ""
+    runner.run_git(["commit", "-q", "--no-edit"])
+    # The upstream change is converted before it's merged
+    with open(runner.git_dir / "src/amount.h") as file:
+        assert file.read().endswith("static const CAmount DUST = EEES / 100;\n")
+    # Files which have only changed upstream or are new are converted and
+    # moved
+    with open(runner.git_dir / "src/validation.cpp") as file:
+        assert file.read().endswith("// Set it with unit-e -maxtipage\n")
+    with open(runner.git_dir / "src/unit-e-wallet.cpp") as file:
+        assert file.read() == "// Wallet of unit-e\n"
+    assert not os.path.exists(runner.git_dir / "src/bitcoind-wallet.cpp")
+    assert not os.path.exists(runner.git_dir / ".github/ISSUE_TEMPLATE.md")
+    assert runner.run_git(["status", "--porcelain"]) == ""
+
+    # The result is the same as merging a fork of upstream
+    runner.run_git(["checkout", "-q", "-b", "expected", "upstream/master"])
+    runner.run_clonemachine()
+    runner.run_git(["checkout", "-q", "master"])
+    os.remove(runner.git_dir / ".git/info/attributes")
+    runner.run_git(["merge", "-q", "--no-edit", "expected"])
+    assert runner.run_git(["diff", "--stat", "HEAD^", "HEAD"]) == ""
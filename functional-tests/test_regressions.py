@@ -11,11 +11,11 @@ import pytest
 from runner import Runner
 
 @pytest.fixture
-def runner():
+def runner(request):
     """Set up git checkout for test and return a runner to run operations
     on it.
     """
-    runner = Runner("unit-e")
+    runner = Runner.for_test("unit-e", request)
     runner.checkout_unit_e_clone(label="urls")
     return runner
 
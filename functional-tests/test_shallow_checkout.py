@@ -21,11 +21,11 @@ def find_files_with_trailing_whitespace(target_dir, file_pattern):
     return result.stdout.rstrip().decode("utf-8")
 
 @pytest.fixture
-def runner():
+def runner(request):
     """Set up git checkout for test and return a runner to run operations
     on it.
     """
-    runner = Runner("bitcoin")
+    runner = Runner.for_test("bitcoin", request)
     runner.checkout_shallow_bitcoin_clone()
     return runner
 
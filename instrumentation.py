@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# vim: ts=2 sw=2 sts=2 expandtab
+# Copyright (c) 2019 The Unit-e developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or https://opensource.org/licenses/MIT.
+
+import functools
+import json
+import os
+import subprocess
+import time
+from contextlib import contextmanager
+from typing import *
+
+class Counters:
+    """
+    Resources used by a step or method: wall time, CPU time of the process
+    itself and of its child processes (git, workers), number of
+    subprocesses started, bytes and files read and written by content
+    transformations, and number of calls.
+    """
+
+    FIELDS = ["wall", "cpu", "child_cpu", "subprocesses", "bytes_read", "bytes_written",
+              "files_scanned", "files_modified"]
+
+    def __init__(self, wall: float = 0, cpu: float = 0, child_cpu: float = 0, subprocesses: int = 0,
+                 bytes_read: int = 0, bytes_written: int = 0, files_scanned: int = 0, files_modified: int = 0):
+        self.wall = wall
+        self.cpu = cpu
+        self.child_cpu = child_cpu
+        self.subprocesses = subprocesses
+        self.bytes_read = bytes_read
+        self.bytes_written = bytes_written
+        self.files_scanned = files_scanned
+        self.files_modified = files_modified
+        self.calls = 0
+
+    def add(self, other: 'Counters'):
+        self.calls += 1
+        for field in self.FIELDS:
+            setattr(self, field, getattr(self, field) + getattr(other, field))
+
+    def diff(self, other: 'Counters') -> 'Counters':
+        return Counters(**{field: getattr(self, field) - getattr(other, field) for field in self.FIELDS})
+
+    def as_dict(self) -> Dict[str, Any]:
+        result: Dict[str, Any] = {field: getattr(self, field) for field in self.FIELDS}
+        result["calls"] = self.calls
+        return result
+
+class Instrumentation:
+    """
+    Records the resources used by the steps of a fork and by the methods of
+    the processor. Measurements can be nested, each one includes the
+    resources of the ones nested in it. Subprocesses are counted by
+    replacing `subprocess.Popen`, which `subprocess.run` and asyncio use as
+    well, while the instrumentation is active. Worker processes are counted
+    by the processor when it starts them, the subprocesses they start
+    themselves are not counted. File counts come from the `file_stats`
+    function, which has to return the cumulative `FileStats` of the
+    processor.
+    """
+
+    def __init__(self):
+        self.records: Dict[Tuple[str, str], Counters] = {}
+        self.events: List[Dict[str, Any]] = []
+        self.subprocesses = 0
+        self.file_stats: Optional[Callable[[], Any]] = None
+        self.start = time.perf_counter()
+        self.original_popen: Optional[Type[subprocess.Popen]] = None
+
+    def __enter__(self):
+        self.original_popen = subprocess.Popen
+        instrumentation = self
+
+        class Popen(subprocess.Popen):
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                instrumentation.subprocesses += 1
+
+        subprocess.Popen = Popen  # type: ignore
+        return self
+
+    def __exit__(self, *exc_info):
+        subprocess.Popen = self.original_popen  # type: ignore
+
+    def count_subprocesses(self, count: int):
+        """
+        Count processes which are not started with `subprocess.Popen`.
+        """
+        self.subprocesses += count
+
+    def snapshot(self) -> Counters:
+        times = os.times()
+        counters = Counters(wall=time.perf_counter(), cpu=times.user + times.system,
+                            child_cpu=times.children_user + times.children_system,
+                            subprocesses=self.subprocesses)
+        if self.file_stats is not None:
+            stats = self.file_stats()
+            counters.bytes_read = stats.bytes_read
+            counters.bytes_written = stats.bytes_written
+            counters.files_scanned = stats.scanned
+            counters.files_modified = stats.modified
+        return counters
+
+    @contextmanager
+    def measure(self, category: str, name: str):
+        start = self.snapshot()
+        try:
+            yield
+        finally:
+            used = self.snapshot().diff(start)
+            self.records.setdefault((category, name), Counters()).add(used)
+            self.events.append({
+                "name": name, "cat": category, "ph": "X", "pid": os.getpid(), "tid": 0,
+                "ts": round((start.wall - self.start) * 1e6), "dur": round(used.wall * 1e6),
+                "args": {field: getattr(used, field) for field in Counters.FIELDS[1:]},
+            })
+
+    def summary(self) -> str:
+        """
+        Return a table of the recorded resources by category and name.
+        """
+        header = (f"{'':<56} {'calls':>6} {'wall':>8} {'cpu':>8} {'child':>8} {'procs':>6} "
+                  f"{'read':>9} {'written':>9} {'scanned':>8} {'modified':>8}")
+        lines = [header]
+        for category in sorted({category for category, name in self.records}):
+            for (record_category, name), counters in self.records.items():
+                if record_category != category:
+                    continue
+                lines.append(f"{category + ' ' + name:<56} {counters.calls:>6} {counters.wall:>7.2f}s "
+                             f"{counters.cpu:>7.2f}s {counters.child_cpu:>7.2f}s {counters.subprocesses:>6} "
+                             f"{format_bytes(counters.bytes_read):>9} {format_bytes(counters.bytes_written):>9} "
+                             f"{counters.files_scanned:>8} {counters.files_modified:>8}")
+        return "\n".join(lines)
+
+    def write_trace(self, path: str):
+        """
+        Write the measurements in the Chrome trace event format, which can be
+        viewed with `chrome://tracing` or https://ui.perfetto.dev.
+        """
+        with open(path, "w") as file:
+            json.dump({
+                "traceEvents": self.events,
+                "summary": [dict(category=category, name=name, **counters.as_dict())
+                            for (category, name), counters in self.records.items()],
+            }, file, indent=1)
+            file.write("\n")
+
+def format_bytes(size: int) -> str:
+    if size < 1024:
+        return f"{size}B"
+    value = float(size)
+    for unit in ["kB", "MB", "GB"]:
+        value /= 1024
+        if value < 1024:
+            break
+    return f"{value:.1f}{unit}"
+
+def instrumented(method):
+    """
+    Decorator for processor methods which records their resources if the
+    processor has an instrumentation.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.instrumentation is None:
+            return method(self, *args, **kwargs)
+        with self.instrumentation.measure("method", method.__name__):
+            return method(self, *args, **kwargs)
+    return wrapper
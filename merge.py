@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# vim: ts=2 sw=2 sts=2 expandtab
+# Copyright (c) 2019 The Unit-e developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or https://opensource.org/licenses/MIT.
+
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from typing import *
+
+from tree import FileInventory, GitObjectReader, chunk_paths
+
+# Labels of the versions in conflict markers
+LABELS = ["unit-e", "upstream base, converted", "upstream, converted"]
+
+def merge_file(fork, ancestor: str, current: str, other: str, path: str, marker_size: int = 7) -> bool:
+    """
+    Merge a file for git as merge driver. The common ancestor and the other
+    version of the file, which are upstream versions, are converted by all
+    steps of the fork, and then merged into the current version, the one of
+    unit-e, with `git merge-file`. The result is written to `current`.
+    Returns if the merge is clean. Use it with
+
+        git config merge.clonemachine.driver "clonemachine.py merge-driver --marker-size=%L %O %A %B %P"
+        echo "* merge=clonemachine" >> .git/info/attributes
+
+    Git doesn't call the driver for files which have only changed upstream,
+    see `convert_merge` for those.
+    """
+    versions = []
+    for name in [ancestor, other]:
+        converted = fork.convert({path: Path(name).read_bytes()})
+        if path not in converted:
+            # Removed by the fork, so it's only in unit-e
+            return True
+        # Paths might be moved by the fork, contents are what counts
+        versions.append(converted[path][1])
+    with tempfile.TemporaryDirectory(prefix="clonemachine-") as tmp_dir:
+        names = []
+        for index, data in enumerate(versions):
+            name = os.path.join(tmp_dir, str(index))
+            Path(name).write_bytes(data)
+            names.append(name)
+        result = subprocess.run(['git', 'merge-file', f'--marker-size={marker_size}',
+                                 '-L', LABELS[0], '-L', LABELS[1], '-L', LABELS[2], current] + names)
+    if result.returncode < 0 or result.returncode > 127:
+        sys.exit(f"fatal: can't merge '{path}'")
+    return result.returncode == 0
+
+def read_index() -> Dict[str, Dict[int, str]]:
+    """
+    Return the object names of the entries of the index by path and stage.
+    """
+    result = subprocess.run(['git', 'ls-files', '--stage', '-z'], stdout=subprocess.PIPE, check=True)
+    entries: Dict[str, Dict[int, str]] = {}
+    for line in result.stdout.decode('utf8').split('\0'):
+        if line:
+            info, path = line.split('\t', 1)
+            mode, sha, stage = info.split(' ')
+            entries.setdefault(path, {})[int(stage)] = sha
+    return entries
+
+def upstream_changes(base: str, upstream: str) -> List[Tuple[str, str]]:
+    """
+    Return the paths and object names of the files which have been added or
+    changed upstream since the base.
+    """
+    result = subprocess.run(['git', 'diff', '--raw', '-z', '--no-abbrev', '--no-renames', '--diff-filter=AMT',
+                             base, upstream], stdout=subprocess.PIPE, check=True)
+    fields = result.stdout.decode('utf8').split('\0')
+    return [(fields[index + 1], fields[index].split(' ')[3]) for index in range(0, len(fields) - 1, 2)]
+
+def convert_merge(fork) -> int:
+    """
+    Convert the files which git has taken over from upstream as they are in
+    the merge in progress, because they have only changed upstream, so that
+    they are as in a merge of a fork of upstream. They are converted by all
+    steps of the fork, moved and removed like in the fork, and the changes
+    are added to the index. Files which have been merged by `merge_file`
+    or have conflicts are left alone, except for conflicts of files removed
+    by unit-e which the fork removes as well. Returns the number of files
+    which have been changed.
+    """
+    objects = GitObjectReader.shared()
+    upstream = objects.resolve('MERGE_HEAD')
+    if upstream is None:
+        sys.exit("fatal: there is no merge in progress")
+    result = subprocess.run(['git', 'merge-base', 'HEAD', upstream], stdout=subprocess.PIPE, check=True)
+    base = result.stdout.decode('utf8').strip()
+    index = read_index()
+    # Files might have been taken over under the path unit-e has moved them to
+    merged = {entries[0] for entries in index.values() if 0 in entries}
+    changes = {}
+    files = {}
+    for path, sha in upstream_changes(base, upstream):
+        entries = index.get(path, {})
+        if sha in merged or (3 in entries and 2 not in entries):
+            changes[path] = sha
+            files[path] = cast(Tuple[str, bytes], objects.read(sha))[1]
+    converted = fork.convert(files)
+
+    moves = []
+    writes = {}
+    removals = []
+    restores = []
+    for path, sha in changes.items():
+        entries = index.get(path, {})
+        if path not in converted:
+            # Removed by the fork, so the file is as in unit-e
+            if entries.get(0) != sha and not (3 in entries and 2 not in entries):
+                continue
+            if objects.info(f"HEAD:{path}") is not None:
+                restores.append(path)
+            else:
+                removals.append(path)
+            continue
+        target, contents = converted[path]
+        if entries.get(0) == sha:
+            location = path
+        elif index.get(target, {}).get(0) == sha:
+            location = target
+        else:
+            continue
+        if location != target:
+            if target in index:
+                print(f"WARNING: Can't move '{location}' to '{target}', which exists", file=sys.stderr)
+                continue
+            moves.append((location, target))
+        if location != target or contents != files[path]:
+            writes[target] = contents
+
+    inventory = FileInventory()
+    inventory.move_files(moves)
+    for path, contents in writes.items():
+        inventory.write(path, contents)
+    for chunk in chunk_paths(list(writes)):
+        subprocess.run(['git', '--literal-pathspecs', 'add', '--'] + chunk, check=True)
+    for chunk in chunk_paths(removals):
+        subprocess.run(['git', '--literal-pathspecs', 'rm', '-q', '--'] + chunk, check=True)
+    inventory.checkout('HEAD', restores)
+    changed = len(writes) + len(removals) + len(restores)
+    if changed:
+        print(f"Converted files taken over from upstream: {len(writes)} changed, {len(moves)} of them moved, "
+              f"{len(removals)} removed, {len(restores)} restored")
+    return changed
@@ -6,21 +6,530 @@
 
 import subprocess
 import re
+import bisect
+import multiprocessing
+import fnmatch
+import functools
+import hashlib
+import json
+from contextlib import contextmanager
 import sys
 import os
 from typing import *
 from pathlib import Path
 import yaml
 
+from cache import ResultCache
+from instrumentation import Instrumentation, instrumented
+from rules import Rule, plan, DEFAULT_CONTEXT
+from tree import FileInventory, MemoryTree, ReadOnlyTree, GitObjectReader, FileContents, read_file, release, contains
+
+LOWER_CASE_TABLE = str.maketrans(
+    'ABCDEFGHIJKLMNOPQRSTUVWXYZ',
+    'abcdefghijklmnopqrstuvwxyz'
+)
+
+@functools.lru_cache(maxsize=None)
+def code_fingerprint() -> bytes:
+    """
+    Return a digest of the code of the processor, which is part of the keys
+    of cache entries. It's computed once per process.
+    """
+    return hashlib.sha256(Path(__file__).read_bytes()).digest()
+
+def to_lower(s: str) -> str:
+    return s.translate(LOWER_CASE_TABLE)
+
+class Substitution(NamedTuple):
+    """
+    A needle to be substituted. The replacement is either a string or a
+    function which gets the matched text and returns its replacement.
+    """
+    needle: str
+    replacement: Union[str, Callable[[str], str]]
+    match_before: str = ""
+    match_after: str = ""
+    case_sensitive: bool = True
+
+    def __str__(self):
+        if isinstance(self.replacement, str):
+            result = f"{self.needle!r} -> {self.replacement!r}"
+        else:
+            result = f"{self.needle!r} -> {self.replacement.__name__}()"
+        if self.match_before not in ["", DEFAULT_CONTEXT]:
+            result += f", before {self.match_before!r}"
+        if self.match_after not in ["", DEFAULT_CONTEXT]:
+            result += f", after {self.match_after!r}"
+        if not self.case_sensitive:
+            result += ", ignoring case"
+        return result
+
+class PrefixTrie:
+    """
+    Set of prefixes stored as a trie of characters, so checking if a string
+    starts with one of them takes one walk over the beginning of the string,
+    independent of the number of prefixes.
+    """
+
+    # Key marking the end of a prefix in a node
+    END = ""
+
+    def __init__(self, prefixes: Iterable[str]):
+        self.root: Dict[str, Any] = {}
+        for prefix in prefixes:
+            node = self.root
+            for char in prefix:
+                node = node.setdefault(char, {})
+            node[self.END] = True
+
+    def matches(self, string: str) -> bool:
+        node = self.root
+        for char in string:
+            if self.END in node:
+                return True
+            if char not in node:
+                return False
+            node = node[char]
+        return self.END in node
+
+class BlacklistIndex:
+    """
+    Index of the blacklist by needle. For each needle and case mode it holds
+    the blacklist entries containing the needle together with the offsets of
+    the needle in the entry, so checking an occurrence of the needle only
+    needs a comparison per pair. The blacklist must not be changed once the
+    index is in use.
+    """
+
+    def __init__(self, blacklist: Sequence[str]):
+        self.blacklist = blacklist
+        self.index: Dict[Tuple[str, bool], List[Tuple[int, str]]] = {}
+
+    def contexts(self, needle: str, case_sensitive: bool = True) -> List[Tuple[int, str]]:
+        key = (needle, case_sensitive)
+        if key not in self.index:
+            contexts = []
+            for item in self.blacklist:
+                item_haystack = item if case_sensitive else to_lower(item)
+                item_ix = item_haystack.find(needle)
+                while item_ix >= 0:
+                    contexts.append((item_ix, item))
+                    item_ix = item_haystack.find(needle, item_ix + len(needle))
+            self.index[key] = contexts
+        return self.index[key]
+
+class SubstitutionEngine:
+    """
+    Apply a list of substitutions to a string, scanning it only once.
+
+    All needles are combined into one regular expression which is used to
+    collect the occurrences of all needles in a single scan. The
+    substitutions are then decided one after the other in the order in
+    which they were given, looking at the text as it has been changed by the
+    previous substitutions. So the result is the same as with one call of
+    `Processor.substitute` per substitution, provided that replacements
+    don't create new occurrences of needles of later substitutions.
+    """
+
+    # Counts of what happened to the occurrences of needles, collected while
+    # a fork is planned, see `Processor.count_hits`
+    hits: Optional['HitCounts'] = None
+
+    def __init__(self, substitutions: Sequence[Substitution], blacklist: Optional[BlacklistIndex] = None):
+        self.substitutions = list(substitutions)
+        if blacklist is None:
+            blacklist = BlacklistIndex([])
+        self.blacklist_contexts = [blacklist.contexts(s.needle, s.case_sensitive) for s in self.substitutions]
+        alternatives = []
+        for substitution in self.substitutions:
+            needle = re.escape(substitution.needle)
+            alternatives.append(needle if substitution.case_sensitive else f"(?i:{needle})")
+        self.pattern = re.compile("|".join(alternatives), re.ASCII)
+        self.match_before = [re.compile(s.match_before) for s in self.substitutions]
+        self.match_after = [re.compile(s.match_after) for s in self.substitutions]
+
+    def is_blacklisted(self, context: Callable[[int, int], str], index: int) -> bool:
+        """
+        Check if an occurrence of the needle of the substitution with the
+        given index is part of a blacklisted context. `context(offset,
+        length)` returns `length` characters of the text starting `offset`
+        characters before the occurrence.
+        """
+        for offset, item in self.blacklist_contexts[index]:
+            if context(offset, len(item)) == item:
+                return True
+        return False
+
+    def find_occurrences(self, string: str) -> List[List[int]]:
+        """
+        Return the offsets of the occurrences of each needle.
+        """
+        occurrences: List[List[int]] = [[] for _ in self.substitutions]
+        found = self.pattern.search(string)
+        while found:
+            begin_offset = found.start()
+            for i, substitution in enumerate(self.substitutions):
+                needle = substitution.needle
+                match = string[begin_offset: begin_offset + len(needle)]
+                if (match if substitution.case_sensitive else to_lower(match)) == needle:
+                    occurrences[i].append(begin_offset)
+            found = self.pattern.search(string, begin_offset + 1)
+        return occurrences
+
+    def apply(self, string: str) -> str:
+        hits = SubstitutionEngine.hits
+        # Replacements as (begin offset, end offset, replacement), sorted by offset
+        replacements = Replacements(string)
+        for i, offsets in enumerate(self.find_occurrences(string)):
+            substitution = self.substitutions[i]
+            needle = substitution.needle
+            ix = 0
+            # Replacements of this substitution are added after all of its
+            # occurrences have been decided, as they are checked against the
+            # text before it was applied
+            pending = []
+            for begin_offset in offsets:
+                end_offset = begin_offset + len(needle)
+                if begin_offset < ix or replacements.overlaps(begin_offset, end_offset):
+                    continue
+                ix = end_offset
+
+                def context(offset: int, length: int) -> str:
+                    return replacements.text(begin_offset, -offset, length - offset)
+
+                if self.is_blacklisted(context, i):
+                    if hits is not None:
+                        hits.count(substitution, "blacklisted")
+                    continue
+                if (not self.match_before[i].match(context(1, 1)) or
+                        not self.match_after[i].match(context(-len(needle), 1))):
+                    if hits is not None:
+                        hits.count(substitution, "context")
+                    continue
+                if hits is not None:
+                    hits.count(substitution, "replaced")
+                match = string[begin_offset: end_offset]
+                replacement = substitution.replacement
+                pending.append((begin_offset, end_offset,
+                                replacement if isinstance(replacement, str) else replacement(match)))
+            for begin_offset, end_offset, replacement in pending:
+                replacements.add(begin_offset, end_offset, replacement)
+        return replacements.apply()
+
+class Replacements:
+    """
+    Non-overlapping replacements of ranges of a string. Gives access to the
+    text as it looks with the replacements added so far.
+    """
+
+    def __init__(self, string: str):
+        self.string = string
+        self.begin_offsets: List[int] = []
+        self.end_offsets: List[int] = []
+        self.replacements: List[str] = []
+
+    def add(self, begin_offset: int, end_offset: int, replacement: str):
+        ix = bisect.bisect(self.begin_offsets, begin_offset)
+        self.begin_offsets.insert(ix, begin_offset)
+        self.end_offsets.insert(ix, end_offset)
+        self.replacements.insert(ix, replacement)
+
+    def overlaps(self, begin_offset: int, end_offset: int) -> bool:
+        ix = bisect.bisect(self.begin_offsets, begin_offset)
+        if ix > 0 and self.end_offsets[ix - 1] > begin_offset:
+            return True
+        return ix < len(self.begin_offsets) and self.begin_offsets[ix] < end_offset
+
+    def text(self, offset: int, begin: int, end: int) -> str:
+        """
+        Return the slice `[begin:end]` relative to the given offset of the
+        replaced text. The offset must not be inside of a replacement.
+        """
+        ix = bisect.bisect(self.begin_offsets, offset)
+        if not self.begin_offsets:
+            return self.string[offset + begin: offset + end]
+        if ((ix == 0 or self.end_offsets[ix - 1] <= offset + begin) and
+                (ix == len(self.begin_offsets) or self.begin_offsets[ix] >= offset + end) and
+                offset + begin >= 0):
+            return self.string[offset + begin: offset + end]
+        # Collect the text from `start` characters before the offset up to
+        # `stop` characters after it and take the slice from that
+        start = min(begin, 0)
+        stop = max(end, 0)
+        pieces = []
+        # Collect text before the offset
+        length = -start
+        position = offset
+        jx = ix
+        while length > 0 and jx > 0 and self.end_offsets[jx - 1] > position - length:
+            jx -= 1
+            gap = self.string[self.end_offsets[jx]: position]
+            replacement = self.replacements[jx]
+            pieces.append(gap)
+            length -= len(gap)
+            pieces.append(replacement[max(0, len(replacement) - length):])
+            length -= len(replacement)
+            position = self.begin_offsets[jx]
+        if length > 0:
+            if position < length:
+                # Beginning of the slice is before the beginning of the text
+                # so mimic slicing with a negative index.
+                offset = len(self.apply(offset))
+                return self.apply()[offset + begin: offset + end]
+            pieces.append(self.string[position - length: position])
+        pieces.reverse()
+        # Collect text after the offset
+        length = stop
+        position = offset
+        jx = ix
+        while length > 0 and jx < len(self.begin_offsets) and self.begin_offsets[jx] < position + length:
+            gap = self.string[position: self.begin_offsets[jx]]
+            replacement = self.replacements[jx]
+            pieces.append(gap)
+            length -= len(gap)
+            pieces.append(replacement[:max(0, length)])
+            length -= len(replacement)
+            position = self.end_offsets[jx]
+            jx += 1
+        if length > 0:
+            pieces.append(self.string[position: position + length])
+        return "".join(pieces)[begin - start: end - start]
+
+    def apply(self, end_offset: Optional[int] = None) -> str:
+        """
+        Return the replaced text, up to the given offset of the original
+        text if one is given.
+        """
+        if end_offset is None:
+            end_offset = len(self.string)
+        out = []
+        ix = 0
+        for begin, end, replacement in zip(self.begin_offsets, self.end_offsets, self.replacements):
+            if begin >= end_offset:
+                break
+            out.append(self.string[ix: begin])
+            out.append(replacement)
+            ix = end
+        out.append(self.string[ix: end_offset])
+        return "".join(out)
+
+class ContentTransform(NamedTuple):
+    """
+    A transformation of the contents of files. It is applied to the given
+    paths, or if no paths are given to all files which are not in excluded
+    paths and have one of the given base names, if there are any. If a
+    needle is given, it's only applied to files containing the needle, or
+    one of the needles if a tuple of needles is given.
+    The key describes what the function does. Results of transformations
+    with a key are stored in the result cache.
+    """
+    function: Callable[[str], str]
+    needle: Union[None, str, Tuple[str, ...]] = None
+    case_sensitive: bool = True
+    paths: Optional[Collection[str]] = None
+    basenames: Optional[Collection[str]] = None
+    key: Optional[str] = None
+
+    def is_triggered_by(self, contents: Union[str, FileContents]) -> bool:
+        if self.needle is None:
+            return True
+        if not isinstance(contents, str):
+            return contains(contents, self.needle, self.case_sensitive)
+        needles = [self.needle] if isinstance(self.needle, str) else self.needle
+        if self.case_sensitive:
+            return any(needle in contents for needle in needles)
+        lower_contents = to_lower(contents)
+        return any(to_lower(needle) in lower_contents for needle in needles)
+
+# Whitespace at the end of lines, not including the CR of CRLF line endings
+TRAILING_WHITESPACE = re.compile(r'[ \t\v\f]+(?=\r?$)', re.MULTILINE)
+
+def remove_trailing_whitespace(contents: str) -> str:
+    return TRAILING_WHITESPACE.sub('', contents)
+
+# Number of bytes at the beginning of a file which are checked for NUL
+# bytes to detect binary files, the same as git uses
+BINARY_DETECTION_SIZE = 8000
+
+def is_binary(data: FileContents) -> bool:
+    return data.find(b'\0', 0, BINARY_DETECTION_SIZE) >= 0
+
+def decode_text(data: FileContents) -> str:
+    """
+    Decode file contents so that encoding them again results in exactly the
+    same bytes. Line endings are kept as they are. Bytes which aren't valid
+    UTF-8 are mapped to lone surrogates, which don't match any substitution.
+    """
+    return str(data, 'utf-8', 'surrogateescape')
+
+def encode_text(contents: str) -> bytes:
+    return contents.encode('utf-8', 'surrogateescape')
+
+class FileStats:
+    """
+    Counts of files and bytes read and written by content transformations.
+    """
+
+    def __init__(self):
+        self.scanned = 0
+        self.modified = 0
+        self.cached = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def add(self, other: 'FileStats'):
+        self.scanned += other.scanned
+        self.modified += other.modified
+        self.cached += other.cached
+        self.bytes_read += other.bytes_read
+        self.bytes_written += other.bytes_written
+
+    def __str__(self):
+        result = (f"{self.scanned} files scanned, {self.modified} modified, "
+                  f"{self.scanned - self.modified} unchanged and skipped")
+        if self.cached:
+            result += f", {self.cached} results taken from cache"
+        return result
+
+class HitCounts:
+    """
+    What a fork would do, collected while running it on a read-only tree:
+    for each step the files it changes and for each file how many
+    occurrences of the needle of each substitution are replaced, or not
+    replaced because they are blacklisted or don't match the context.
+    """
+
+    OUTCOMES = ["replaced", "blacklisted", "context"]
+
+    def __init__(self):
+        self.step = ""
+        # Counts by step, path and substitution
+        self.counts: Dict[str, Dict[str, Dict[str, Dict[str, int]]]] = {}
+        # Changes of files by step and path
+        self.changes: Dict[str, Dict[str, str]] = {}
+        # Counts of the file which is being transformed
+        self.file_counts: Dict[str, Dict[str, int]] = {}
+
+    def count(self, substitution: Substitution, outcome: str):
+        counts = self.file_counts.setdefault(str(substitution), dict.fromkeys(self.OUTCOMES, 0))
+        counts[outcome] += 1
+
+    def add_file(self, path: str, counts: Dict[str, Dict[str, int]]):
+        if not counts:
+            return
+        file_counts = self.counts.setdefault(self.step, {}).setdefault(path, {})
+        for substitution, outcomes in counts.items():
+            total = file_counts.setdefault(substitution, dict.fromkeys(self.OUTCOMES, 0))
+            for outcome, count in outcomes.items():
+                total[outcome] += count
+
+    def change(self, path: str, change: str):
+        self.changes.setdefault(self.step, {})[path] = change
+
+    def add(self, other: 'HitCounts'):
+        step = self.step
+        for self.step, counts in other.counts.items():
+            for path, file_counts in counts.items():
+                self.add_file(path, file_counts)
+        self.step = step
+        for step, changes in other.changes.items():
+            self.changes.setdefault(step, {}).update(changes)
+
+    def report(self, steps: Sequence[str]) -> Dict[str, Any]:
+        """
+        Return the counts of the given steps by substitution and by file.
+        """
+        report: Dict[str, Any] = {"steps": []}
+        for step in steps:
+            counts = self.counts.get(step, {})
+            changes = self.changes.get(step, {})
+            substitutions: Dict[str, Dict[str, int]] = {}
+            files = []
+            for path in sorted(set(counts) | set(changes)):
+                file_report: Dict[str, Any] = {"path": path, "change": changes.get(path)}
+                file_report.update(dict.fromkeys(self.OUTCOMES, 0))
+                for substitution, outcomes in counts.get(path, {}).items():
+                    total = substitutions.setdefault(substitution, dict.fromkeys(self.OUTCOMES + ["files"], 0))
+                    total["files"] += 1
+                    for outcome, count in outcomes.items():
+                        total[outcome] += count
+                        file_report[outcome] += count
+                files.append(file_report)
+            report["steps"].append({
+                "name": step,
+                "changed_files": len(changes),
+                "substitutions": [dict(substitution=substitution, **totals)
+                                  for substitution, totals in substitutions.items()],
+                "files": files,
+            })
+        return report
+
 class Processor:
-    def __init__(self, config):
+    def __init__(self, config, jobs: int = 1, cache: Optional[ResultCache] = None,
+                 instrumentation: Optional[Instrumentation] = None, in_memory: bool = False):
         self.config = config
+        # Number of processes used to transform files
+        self.jobs = jobs
+        # Cache of the results of content transformations
+        self.cache = cache
+        # Identifies the code and configuration in the keys of cache entries
+        self.cache_fingerprint = b""
+        if self.cache is not None:
+            # Digested once, so cache keys don't hash the whole code again
+            digest = hashlib.sha256(code_fingerprint())
+            digest.update(self.config.fingerprint().encode('utf8'))
+            self.cache_fingerprint = digest.digest()
+        # Content transformations collected by an active pipeline
+        self.pending: Optional[List[ContentTransform]] = None
+        # Moves of files collected by an active pipeline as (source, target)
+        self.pending_moves: List[Tuple[str, str]] = []
+        # Files of the working tree, kept while a pipeline is active
+        self.inventory: Optional[FileInventory] = None
+        # Work on a `MemoryTree` instead of the working tree in pipelines
+        self.in_memory = in_memory
+        # Work on a `ReadOnlyTree` in pipelines, so nothing is changed
+        self.read_only = False
+        # Counts of occurrences and changes of files, see `count_hits`
+        self.hits: Optional[HitCounts] = None
+        # Files which are not transformed because they are carried over from
+        # a previous fork, see `carry_over_files`
+        self.unchanged_paths: Set[str] = set()
+        # Warnings collected while transforming files in a worker process
+        self.warnings: Optional[List[str]] = None
+        self.stats = FileStats()
+        # File counts before the last call of `reset_stats`
+        self.previous_stats = FileStats()
+        self.instrumentation = instrumentation
+        if self.instrumentation is not None:
+            self.instrumentation.file_stats = self.file_counts
+        # Substitutions in the order of their precedence
+        self.bitcoin_identifier_engine = SubstitutionEngine([
+            Substitution("BITCOIND", "UNITED"),
+            Substitution("BITCOINCLI", "UNITECLI"),
+            Substitution("BITCOINTX", "UNITETX"),
+            Substitution("BITCOINQT", "UNITEQT"),
+            Substitution("BITCOIN", "UNITE", match_after="[_C]"),
+            Substitution("bitcoin address", "Unit-e address"),
+            Substitution("bitcoin transaction", "Unit-e transaction"),
+            Substitution("Bitcoin", "UnitE", match_after="[A-CE-Z]"),
+            Substitution("bitcoin", self.replace_bitcoin_identifier, case_sensitive=False),
+        ], self.config.blacklist_index)
+        self.bitcoin_core_identifier_engine = SubstitutionEngine([
+            Substitution("bitcoin core", self.replace_bitcoin_core_identifier, case_sensitive=False),
+        ], self.config.blacklist_index)
+        # Transformations of single files done by the `file`, `batch` and
+        # `filter-process` commands, see `convert_contents`
+        self.file_transforms = [
+            ContentTransform(self.bitcoin_core_identifier_engine.apply, "bitcoin core", case_sensitive=False,
+                             key="bitcoin_core_identifiers"),
+            ContentTransform(self.bitcoin_identifier_engine.apply, "bitcoin", case_sensitive=False,
+                             key="bitcoin_identifiers"),
+            ContentTransform(SubstitutionEngine([Substitution("BTC", "UTE", "$|[^a-bd-ln-tv-zA-Z]", DEFAULT_CONTEXT)]).apply, "BTC",
+                             key=repr(("replace", "BTC", "UTE", "$|[^a-bd-ln-tv-zA-Z]", DEFAULT_CONTEXT))),
+        ]
 
     def to_lower(self, s: str) -> str:
-        return s.translate(str.maketrans(
-            'ABCDEFGHIJKLMNOPQRSTUVWXYZ',
-            'abcdefghijklmnopqrstuvwxyz'
-        ))
+        return to_lower(s)
 
     def substitute(self, string: str,
                 needle: str,
@@ -29,117 +538,427 @@ class Processor:
                 match_after: str = "",
                 case_sensitive: bool = True,
                 blacklist: Sequence[str] = []) -> str:
-        haystack = string if case_sensitive else self.to_lower(string)
-        out = []
-        needle_length = len(needle)
-        ix = 0
-        begin_offset = haystack.find(needle, ix)
-        while begin_offset >= 0:
-            end_offset = begin_offset + needle_length
-            before = string[begin_offset - 1: begin_offset]
-            after = string[end_offset: end_offset + 1]
-            match = string[begin_offset: end_offset]
-            blacklisted = False
-            for item in blacklist:
-                item_haystack = item if case_sensitive else self.to_lower(item)
-                item_ix = item_haystack.find(needle)
-                while item_ix >= 0:
-                    ctx_begin_offset = begin_offset - item_ix
-                    ctx_end_offset = ctx_begin_offset + len(item)
-                    context = string[ctx_begin_offset: ctx_end_offset]
-                    if context == item:
-                        blacklisted = True
-                        break
-                    else:
-                        item_ix = item_haystack.find(needle, item_ix + len(match))
-                if blacklisted:
-                    break
-            if not blacklisted and re.match(match_before, before) and re.match(match_after, after):
-                out.append(string[ix: begin_offset])
-                out.append(replacer(match))
-            else:
-                out.append(string[ix:end_offset])
-            ix = end_offset
-            begin_offset = haystack.find(needle, ix)
-        out.append(string[ix: len(string)])
-        return "".join(out)
+        substitution = Substitution(needle, replacer, match_before, match_after, case_sensitive)
+        return SubstitutionEngine([substitution], self.blacklist_index(blacklist)).apply(string)
+
+    def blacklist_index(self, blacklist: Sequence[str]) -> BlacklistIndex:
+        if blacklist is self.config.blacklist_index.blacklist:
+            return self.config.blacklist_index
+        return BlacklistIndex(blacklist)
 
+    @instrumented
     def replace_recursively(self, needle: str,
                             replacement: str,
                             match_before: str = "$|[^a-zA-Z0-9]",
                             match_after: str = "$|[^a-zA-Z0-9]"):
-        files = subprocess.run(["git", "grep", "-l", needle], stdout=subprocess.PIPE)
-        for f in files.stdout.splitlines():
-            path = f.decode('utf8')
-            if self.is_in_excluded_path(path):
-                continue
-            with open(path, 'r') as source_file:
-                contents = source_file.read()
-            out = self.substitute(contents, needle, lambda x: replacement, match_before, match_after)
-            with open(path, 'w') as source_file:
-                source_file.write(out)
+        engine = SubstitutionEngine([Substitution(needle, replacement, match_before, match_after)])
+        key = repr(("replace", needle, replacement, match_before, match_after))
+        self.transform(ContentTransform(engine.apply, needle, key=key))
 
+    @instrumented
     def replace_in_file(self, path: str,
                         needle: str,
                         replacement: str,
                         match_before: str = "$|[^a-zA-Z0-9]",
                         match_after: str = "$|[^a-zA-Z0-9]"):
-        if not os.path.exists(path):
-            print(f"WARNING: File '{path}' does not exist for replacement of '{needle}' by '{replacement}'",
-                  file=sys.stderr)
+        if not self.files().exists(path):
+            self.warn(f"File '{path}' does not exist for replacement of '{needle}' by '{replacement}'")
             return
-        with open(path, 'r') as source_file:
-            contents = source_file.read()
-        out = self.substitute(contents, needle, lambda x: replacement, match_before, match_after)
-        with open(path, 'w') as source_file:
-            source_file.write(out)
+        engine = SubstitutionEngine([Substitution(needle, replacement, match_before, match_after)])
+        key = repr(("replace", needle, replacement, match_before, match_after))
+        self.transform(ContentTransform(engine.apply, paths=[path], key=key))
 
+    @instrumented
+    def apply_rules(self, rules: Sequence[Rule]):
+        """
+        Apply substitution rules. The rules are compiled into passes, each of
+        which is carried out as one content transformation, see `plan`.
+        Rules for files which don't exist are skipped with a warning.
+        """
+        missing = set()
+        for rule in rules:
+            for path in rule.paths or []:
+                if not self.files().exists(path):
+                    self.warn(f"File '{path}' does not exist for replacement of '{rule.needle}' by '{rule.replacement}'")
+                    missing.add(path)
+        for rules_pass in plan(rules):
+            paths = rules_pass.paths
+            if paths is not None:
+                paths = tuple(path for path in paths if path not in missing)
+                if not paths:
+                    continue
+            key = repr(("rules", rules_pass.rules))
+            if rules_pass.regex:
+                rule = rules_pass.rules[0]
+                self.transform(ContentTransform(functools.partial(re.sub, rule.needle, rule.replacement),
+                                                paths=paths, key=key))
+                continue
+            engine = SubstitutionEngine([Substitution(rule.needle, rule.replacement, rule.match_before,
+                                                      rule.match_after, rule.case_sensitive)
+                                         for rule in rules_pass.rules])
+            needles = tuple(rule.needle for rule in rules_pass.rules)
+            case_sensitive = all(rule.case_sensitive for rule in rules_pass.rules)
+            self.transform(ContentTransform(engine.apply, needles, case_sensitive, paths=paths, key=key))
+
+    @instrumented
     def replace_in_file_regex(self, path: str, regex: str, replacement: str):
-        if not os.path.exists(path):
-            print(f"WARNING: File '{path}' does not exist for replacement of '{regex}' by '{replacement}'",
-                  file=sys.stderr)
+        if not self.files().exists(path):
+            self.warn(f"File '{path}' does not exist for replacement of '{regex}' by '{replacement}'")
+            return
+        self.transform(ContentTransform(lambda contents: re.sub(regex, replacement, contents), paths=[path],
+                                        key=repr(("replace_regex", regex, replacement))))
+
+    @contextmanager
+    def pipeline(self, inventory: Optional[FileInventory] = None):
+        """
+        Collect the content transformations done within the context and
+        apply them when leaving it or when `flush` is called. Each file is
+        read once, goes through all transformations applying to it in the
+        order in which they were requested, and is only written back if its
+        contents have changed. Operations which don't change file contents,
+        such as removing files, flush the pending transformations before they
+        are carried out. Moves of files are collected as well and done in
+        one batch. The tracked files and their contents are kept in a
+        `FileInventory` while the pipeline is active, or in a `MemoryTree`
+        if the processor works in memory, or in a `ReadOnlyTree` if it
+        mustn't change anything, or in the given inventory.
+        """
+        self.pending = []
+        if inventory is not None:
+            self.inventory = inventory
+        elif self.read_only:
+            self.inventory = ReadOnlyTree()
+        elif self.in_memory:
+            self.inventory = MemoryTree()
+        else:
+            self.inventory = FileInventory()
+        try:
+            yield
+            self.flush()
+            self.inventory.finish()
+        finally:
+            self.pending = None
+            self.pending_moves = []
+            self.inventory.close()
+            self.inventory = None
+
+    def count_hits(self) -> HitCounts:
+        """
+        Start counting the occurrences of needles found by substitutions and
+        the changes of files. The step the counts are attributed to is set in
+        `step` of the returned counts.
+        """
+        self.hits = HitCounts()
+        SubstitutionEngine.hits = self.hits
+        return self.hits
+
+    def files(self) -> FileInventory:
+        """
+        Return the inventory of the active pipeline or a new one.
+        """
+        return self.inventory if self.inventory is not None else FileInventory()
+
+    @instrumented
+    def commit(self, message: str):
+        """
+        Commit all changes done so far.
+        """
+        self.flush()
+        self.files().commit(message)
+
+    @instrumented
+    def flush(self):
+        """
+        Carry out pending moves and content transformations.
+        """
+        if self.pending_moves:
+            moves = self.pending_moves
+            self.pending_moves = []
+            self.move_files(moves)
+        if not self.pending:
+            return
+        transforms = self.pending
+        self.pending = []
+        explicit_paths: Set[str] = set()
+        for transform in transforms:
+            if transform.paths is not None:
+                explicit_paths.update(transform.paths)
+        tracked_paths = self.files().paths()
+        # Files in excluded paths are left out unless a transformation
+        # explicitly applies to them, so they are never read
+        paths = [path for path in tracked_paths if path not in self.unchanged_paths and
+                 (path in explicit_paths or not self.is_in_excluded_path(path))]
+        tracked = set(tracked_paths)
+        for transform in transforms:
+            if transform.paths is not None:
+                paths += [path for path in transform.paths if path not in tracked]
+        self.transform_files(paths, transforms)
+
+    @instrumented
+    def transform(self, transform: ContentTransform):
+        """
+        Apply a content transformation to all files it applies to, or add it
+        to the pending transformations if a pipeline is active.
+        """
+        if self.pending is not None:
+            if self.pending_moves:
+                self.flush()
+            self.pending.append(transform)
             return
-        with open(path, 'r') as source_file:
-            contents = source_file.read()
-        out = re.sub(regex, replacement, contents)
-        with open(path, 'w') as source_file:
-            source_file.write(out)
+        if transform.paths is not None:
+            paths = transform.paths
+        elif transform.needle is not None:
+            paths = self.files().containing(transform.needle, transform.case_sensitive, self.is_in_excluded_path)
+        else:
+            paths = self.files().paths()
+        self.transform_files(paths, [transform])
+
+    @instrumented
+    def transform_files(self, paths: Sequence[str], transforms: Sequence[ContentTransform]):
+        """
+        Apply content transformations to the given files. If more than one
+        job is configured, the files are distributed over a pool of worker
+        processes. Warnings are printed in the order of the files.
+        """
+        if self.jobs <= 1 or len(paths) <= 1:
+            for path in paths:
+                self.transform_file(path, transforms)
+            return
+        if self.inventory is not None:
+            self.inventory.preload([path for path in paths
+                                    if any(self.applies_to(transform, path) for transform in transforms)])
+        global worker_task
+        worker_task = (self, transforms)
+        try:
+            # Worker processes inherit the transformations when forked
+            with multiprocessing.get_context('fork').Pool(self.jobs) as pool:
+                if self.instrumentation is not None:
+                    self.instrumentation.count_subprocesses(self.jobs)
+                chunksize = len(paths) // (self.jobs * 4) + 1
+                for path, (stats, warnings, data, hits) in zip(paths, pool.imap(transform_file_in_worker, paths,
+                                                                                chunksize)):
+                    self.stats.add(stats)
+                    if hits is not None:
+                        cast(HitCounts, self.hits).add(hits)
+                    for warning in warnings:
+                        self.warn(warning)
+                    if data is not None and self.inventory is not None:
+                        self.inventory.cache_contents(path, data, stats.modified > 0)
+        finally:
+            worker_task = None
+
+    def warn(self, message: str):
+        if self.warnings is not None:
+            self.warnings.append(message)
+        else:
+            print(f"WARNING: {message}", file=sys.stderr)
+
+    def applies_to(self, transform: ContentTransform, path: str) -> bool:
+        if path in self.unchanged_paths:
+            return False
+        if transform.paths is not None:
+            return path in transform.paths
+        if self.is_in_excluded_path(path):
+            return False
+        return transform.basenames is None or path.split('/')[-1] in transform.basenames
+
+    def transform_file(self, path: str, transforms: Sequence[ContentTransform]) -> bool:
+        """
+        Apply the given content transformations to a file and write it back
+        if it has changed. Returns if the file was written. The file is
+        counted in `stats` if it was read.
+        """
+        transforms = [transform for transform in transforms if self.applies_to(transform, path)]
+        if not transforms:
+            return False
+        data = self.read_file(path)
+        if data is None:
+            return False
+        self.stats.scanned += 1
+        if self.hits is not None:
+            self.hits.file_counts = {}
+        try:
+            altered = self.transform_contents(data, transforms)
+        finally:
+            # Mapped files have to be released before they are written
+            release(data)
+        if self.hits is not None:
+            self.hits.add_file(path, self.hits.file_counts)
+            if altered is not None:
+                self.hits.change(path, "modified")
+        if altered is None:
+            return False
+        self.write_file(path, altered)
+        self.stats.modified += 1
+        return True
+
+    def convert_file(self, path: str) -> bool:
+        """
+        Convert a file with the transformations of single files. Returns if
+        the file was changed. Files in excluded paths are left alone.
+        """
+        return self.transform_file(path, self.file_transforms)
+
+    def convert_contents(self, path: str, data: bytes) -> bytes:
+        """
+        Return the contents of the file with the given path converted with the
+        transformations of single files. Contents of files in excluded paths
+        and binary files are returned as they are.
+        """
+        transforms = [transform for transform in self.file_transforms if self.applies_to(transform, path)]
+        if not transforms:
+            return data
+        self.stats.scanned += 1
+        self.stats.bytes_read += len(data)
+        altered = self.transform_contents(data, transforms)
+        if altered is None:
+            return data
+        self.stats.modified += 1
+        self.stats.bytes_written += len(altered)
+        return altered
+
+    def transform_contents(self, data: FileContents, transforms: Sequence[ContentTransform]) -> Optional[bytes]:
+        """
+        Return the contents of a file with the given transformations applied
+        or None if they don't change it. Binary files are not changed.
+        """
+        if is_binary(data):
+            return None
+        if not any(transform.is_triggered_by(data) for transform in transforms):
+            return None
+        # Only results of transformations with a key can be cached
+        cache = self.cache
+        if any(transform.key is None for transform in transforms):
+            cache = None
+        cache_key = hits_key = ""
+        if cache:
+            key_parts = [self.cache_fingerprint] + [str(transform.key) for transform in transforms]
+            cache_key = cache.key(data, key_parts)
+            hits_key = cache.key(data, key_parts + ["hits"])
+        altered = cache.get(cache_key) if cache else None
+        if altered is not None and self.hits is not None:
+            # Cached results can only be used if the hit counts are cached too
+            hits = cast(ResultCache, cache).get(hits_key)
+            if hits is None:
+                altered = None
+            else:
+                self.hits.file_counts = json.loads(hits.decode('utf8'))
+        if altered is not None:
+            self.stats.cached += 1
+        else:
+            contents = decode_text(data)
+            for transform in transforms:
+                if transform.is_triggered_by(contents):
+                    contents = transform.function(contents)
+            altered = encode_text(contents)
+            if cache:
+                cache.put(cache_key, altered)
+                if self.hits is not None:
+                    cache.put(hits_key, json.dumps(self.hits.file_counts).encode('utf8'))
+        if len(altered) == len(data):
+            with memoryview(data) as view:
+                if view == altered:
+                    return None
+        return altered
+
+    def read_file(self, path: str) -> Optional[FileContents]:
+        """
+        Return the contents of a file or None if it's not a regular file.
+        Large files are memory-mapped.
+        """
+        if self.inventory is not None:
+            if path in self.inventory.contents:
+                return self.inventory.contents[path]
+            data = self.inventory.read(path)
+        else:
+            data = read_file(path)
+        if data is not None:
+            self.stats.bytes_read += len(data)
+        return data
+
+    def write_file(self, path: str, data: bytes):
+        self.stats.bytes_written += len(data)
+        if self.inventory is not None:
+            self.inventory.write(path, data)
+            return
+        with open(path, 'wb') as target_file:
+            target_file.write(data)
+
+    def reset_stats(self) -> FileStats:
+        """
+        Return the file counts collected so far and start new ones.
+        """
+        stats = self.stats
+        self.stats = FileStats()
+        self.previous_stats.add(stats)
+        return stats
+
+    def file_counts(self) -> FileStats:
+        """
+        Return the file counts collected since the processor was created.
+        """
+        counts = FileStats()
+        counts.add(self.previous_stats)
+        counts.add(self.stats)
+        return counts
 
     def is_in_excluded_path(self, path):
-        normalized = "/".join(filter(lambda x: x != '.' and len(x) > 0, path.split('/')))
-        for excl in self.config.excluded_paths:
-            if normalized.startswith(excl):
-                return True
-        return False
+        if path.startswith('./') or '//' in path or '/./' in path or path.endswith('/.'):
+            path = "/".join(filter(lambda x: x != '.' and len(x) > 0, path.split('/')))
+        return self.config.excluded_paths_index.matches(path)
 
-    def apply_recursively(self, func, command=['git', 'ls-tree', '-r', 'HEAD', '--name-only']):
-        files = subprocess.run(command, stdout=subprocess.PIPE)
-        for f in files.stdout.splitlines():
-            path = f.decode('utf8')
+    @instrumented
+    def apply_recursively(self, func, command=None):
+        """
+        Call `func` for each file which is not in an excluded path. The files
+        are the ones in HEAD, or the ones listed by `command` if given.
+        """
+        if command is None:
+            paths = self.files().committed_paths()
+        else:
+            files = subprocess.run(command, stdout=subprocess.PIPE)
+            paths = [f.decode('utf8') for f in files.stdout.splitlines()]
+        for path in paths:
             if self.is_in_excluded_path(path):
                 continue
             func(path)
 
+    @instrumented
     def remove_trailing_whitespace(self, file_pattern):
-        if sys.platform == "linux":
-            sed = "sed"
-        elif sys.platform == "darwin":
-            sed = "gsed"
-        else:
-            raise RuntimeError(f"Unsupported platform: '{sys.platform}'")
-        subprocess.run(['find', '.', '-type', 'f', '-name', file_pattern,
-        '-exec', sed, '--in-place', r's/[[:space:]]\+$//', '{}', '+'])
+        """
+        Remove whitespace at the end of lines in all tracked files with names
+        matching the pattern, including files in excluded paths.
+        """
+        if self.pending_moves:
+            self.flush()
+        paths = {path for path in self.files().paths() if fnmatch.fnmatchcase(path.split('/')[-1], file_pattern)}
+        self.transform(ContentTransform(remove_trailing_whitespace, paths=paths,
+                                        key=repr(("remove_trailing_whitespace", file_pattern))))
 
     def git_move_file(self, path, needle, replacement):
         target = path.replace(needle, replacement)
-        if target == path or not os.path.exists(path):
+        if target == path:
+            return
+        if self.pending is None:
+            self.move_files([(path, target)])
             return
-        target_parent = '/'.join(target.split('/')[:-1])
-        if target_parent:
-            subprocess.run(['mkdir', '-p', target_parent])
-        result = subprocess.run(["git", "mv", path, target])
-        if result.returncode != 0:
-            exit(result.returncode)
+        if self.pending:
+            self.flush()
+        self.pending_moves.append((path, target))
+
+    @instrumented
+    def move_files(self, moves: Sequence[Tuple[str, str]]):
+        """
+        Move files like `git mv` does, but with a single update of the index
+        for all moves. Moves are done in the given order, sources which don't
+        exist (anymore) are skipped.
+        """
+        for path, target in self.files().move_files(moves):
+            if self.hits is not None:
+                self.hits.change(path, f"moved to {target}")
+            if path in self.unchanged_paths:
+                self.unchanged_paths.remove(path)
+                self.unchanged_paths.add(target)
 
     def replace_bitcoin_identifier(self, occurence: str):
         if occurence == 'bitcoin':
@@ -156,65 +975,126 @@ class Processor:
         raise Exception(f"Don't know how to handle {occurence}")
 
     def substitute_bitcoin_identifier_in_file(self, path):
-        with open(path, 'r') as source_file:
-            contents = source_file.read()
-        # Substitutions in the form [needle, match_after, replacement_string]
-        substitutions = [
-            ["BITCOIND", "", "UNITED"],
-            ["BITCOINCLI", "", "UNITECLI"],
-            ["BITCOINTX", "", "UNITETX"],
-            ["BITCOINQT", "", "UNITEQT"],
-            ["BITCOIN", "[_C]", "UNITE"],
-            ["bitcoin address", "", "Unit-e address"],
-            ["bitcoin transaction", "", "Unit-e transaction"],
-            ["Bitcoin", "[A-CE-Z]", "UnitE"],
-        ]
-        for substitution in substitutions:
-            contents = self.substitute(string = contents,
-                                needle = substitution[0],
-                                match_after = substitution[1],
-                                replacer = lambda occurence: substitution[2],
-                                case_sensitive=True,
-                                blacklist = self.config.substitution_blacklist)
-        altered = self.substitute(string = contents,
-                            needle = "bitcoin",
-                            replacer = self.replace_bitcoin_identifier,
-                            case_sensitive=False,
-                            blacklist=self.config.substitution_blacklist)
-        with open(path, 'w') as target_file:
-            target_file.write(altered)
+        self.transform_file(path, [ContentTransform(self.bitcoin_identifier_engine.apply, paths=[path],
+                                                    key="bitcoin_identifiers")])
 
     def substitute_bitcoin_core_identifier_in_file(self, path):
-        with open(path, 'r') as source_file:
-            contents = source_file.read()
-        altered = self.substitute(string = contents,
-                            needle = "bitcoin core",
-                            replacer = self.replace_bitcoin_core_identifier,
-                            case_sensitive=False,
-                            blacklist=self.config.substitution_blacklist)
-        with open(path, 'w') as target_file:
-            target_file.write(altered)
+        self.transform_file(path, [ContentTransform(self.bitcoin_core_identifier_engine.apply, paths=[path],
+                                                    key="bitcoin_core_identifiers")])
+
+    @instrumented
+    def substitute_bitcoin_identifiers_recursively(self):
+        self.transform(ContentTransform(self.bitcoin_identifier_engine.apply, "bitcoin", case_sensitive=False,
+                                        key="bitcoin_identifiers"))
+
+    @instrumented
+    def substitute_bitcoin_core_identifiers_recursively(self):
+        self.transform(ContentTransform(self.bitcoin_core_identifier_engine.apply, "bitcoin core", case_sensitive=False,
+                                        key="bitcoin_core_identifiers"))
+
+    @instrumented
+    def substitute_any_recursively(self, substitutions):
+        """
+        Replace strings in files with the given names. `substitutions` maps
+        file names to a dict of needles and their replacements.
+        """
+        def subst(basename):
+            def replace(contents):
+                for needle, replacement in substitutions[basename].items():
+                    contents = contents.replace(needle, replacement)
+                return contents
+            return replace
+
+        for basename in substitutions:
+            self.transform(ContentTransform(subst(basename), basenames=[basename],
+                                            key=repr(("substitute_any", substitutions[basename]))))
 
     def substitute_any(self, substitutions):
         def subst(path):
             basename = path.split('/')[-1]
             if basename in substitutions:
-                with open(path, 'r') as source_file:
-                    contents = source_file.read()
-                for needle, replacement in substitutions[basename].items():
-                    contents = contents.replace(needle, replacement)
-                with open(path, 'w') as target_file:
-                    target_file.write(contents)
+                def replace(contents):
+                    for needle, replacement in substitutions[basename].items():
+                        contents = contents.replace(needle, replacement)
+                    return contents
+                self.transform_file(path, [ContentTransform(replace, paths=[path])])
 
         return subst
 
+    @instrumented
     def appropriate_files(self, branch):
+        self.flush()
+        objects = GitObjectReader.shared()
+        files = []
         for file in self.config.appropriated_files:
-            subprocess.run(['git', 'checkout', branch, file])
-        result = subprocess.run(['git', 'rev-parse', branch], stdout=subprocess.PIPE)
-        return result.stdout.decode('utf-8').rstrip()
+            if objects.info(f"{branch}:{file.rstrip('/')}") is not None:
+                files.append(file)
+            else:
+                self.warn(f"File '{file}' does not exist on branch '{branch}'")
+        self.checkout(branch, files)
+        return objects.resolve(branch) or ""
 
+    @instrumented
     def remove_files(self, branch):
-        for file in self.config.removed_files:
-            if os.path.exists(file):
-                subprocess.run(['git', 'rm', file])
+        self.flush()
+        inventory = self.files()
+        files = [file for file in self.config.removed_files if inventory.exists(file)]
+        if files:
+            for path in inventory.remove_files(files):
+                if self.hits is not None:
+                    self.hits.change(path, "removed")
+                self.unchanged_paths.discard(path)
+
+    def checkout(self, branch: str, files: Sequence[str]):
+        if not files:
+            return
+        self.files().checkout(branch, files)
+        if self.hits is not None:
+            for file in files:
+                self.hits.change(file, f"checked out from {branch}")
+
+    @instrumented
+    def carry_over_files(self, branch):
+        """
+        Check out the files in `unchanged_paths` from the given branch, which
+        has to be the result of a previous fork of an upstream revision in
+        which these files had the same contents. Files which don't exist on
+        the branch are left as they are. Returns the revision of the branch.
+        """
+        self.flush()
+        result = subprocess.run(['git', 'ls-tree', '-r', '--name-only', '-z', branch], stdout=subprocess.PIPE)
+        existing = set(result.stdout.decode('utf8').split('\0'))
+        files = []
+        for path in sorted(self.unchanged_paths):
+            if path in existing:
+                files.append(path)
+            else:
+                self.warn(f"File '{path}' does not exist on branch '{branch}' and is not carried over")
+        self.checkout(branch, files)
+        self.unchanged_paths = set()
+        return GitObjectReader.shared().resolve(branch) or ""
+
+# Processor and transformations used by `transform_file_in_worker`, set by
+# `Processor.transform_files` before forking the worker processes
+worker_task: Optional[Tuple[Processor, Sequence[ContentTransform]]] = None
+
+def transform_file_in_worker(path: str) -> Tuple[FileStats, List[str], Optional[bytes], Optional[HitCounts]]:
+    """
+    Transform a file in a worker process. Returns the file counts, the
+    warnings, the contents of the file if they have been read or changed,
+    so the inventory of the main process can be updated, and the hit counts
+    if they are counted.
+    """
+    assert worker_task is not None
+    processor, transforms = worker_task
+    processor.warnings = []
+    processor.stats = FileStats()
+    if processor.hits is not None:
+        step = processor.hits.step
+        processor.count_hits().step = step
+    cached = processor.inventory is not None and path in processor.inventory.contents
+    modified = processor.transform_file(path, transforms)
+    data = None
+    if processor.inventory is not None and (modified or not cached):
+        data = processor.inventory.contents.get(path)
+    return processor.stats, processor.warnings, data, processor.hits
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# vim: ts=2 sw=2 sts=2 expandtab
+# Copyright (c) 2019 The Unit-e developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or https://opensource.org/licenses/MIT.
+
+import re
+from pathlib import Path
+from typing import *
+import yaml
+
+# Default context of needles: they are only replaced if they are not part of
+# a longer word or number
+DEFAULT_CONTEXT = "$|[^a-zA-Z0-9]"
+
+# File with the predefined substitution rules
+RULES_FILE = Path(__file__).parent / "rules.yaml"
+
+class Rule(NamedTuple):
+    """
+    A substitution declared in a rule file. The needle is replaced if the
+    text before and after it matches the given regular expressions. If
+    `regex` is set, the needle is a regular expression and the replacement
+    may refer to its groups. Rules apply to the given paths, or if no paths
+    are given to all files which are not in excluded paths. The description
+    is used as an item of the commit message.
+    """
+    needle: str
+    replacement: str
+    match_before: str = DEFAULT_CONTEXT
+    match_after: str = DEFAULT_CONTEXT
+    case_sensitive: bool = True
+    regex: bool = False
+    paths: Optional[Tuple[str, ...]] = None
+    description: Optional[str] = None
+
+    def __str__(self):
+        result = f"{self.needle!r} -> {self.replacement!r}"
+        if self.regex:
+            result = "regex " + result
+        if self.match_before != DEFAULT_CONTEXT:
+            result += f", before {self.match_before!r}"
+        if self.match_after != DEFAULT_CONTEXT:
+            result += f", after {self.match_after!r}"
+        if not self.case_sensitive:
+            result += ", ignoring case"
+        return result
+
+class Step(NamedTuple):
+    """
+    Rules which are applied together and committed with the given message.
+    """
+    name: str
+    rules: List[Rule]
+    message: str = ""
+
+    def commit_message(self) -> str:
+        """
+        Return the commit message with a list of the descriptions of the
+        rules, if they have any.
+        """
+        items = "".join(f"* {rule.description}\n" for rule in self.rules if rule.description)
+        return f"{self.message}\n\n{items}" if items else self.message
+
+class Pass(NamedTuple):
+    """
+    Rules which are applied in one scan of the files they apply to. All rules
+    of a pass have the same paths. A pass with a regular expression rule has
+    no other rules.
+    """
+    rules: List[Rule]
+
+    @property
+    def paths(self) -> Optional[Tuple[str, ...]]:
+        return self.rules[0].paths
+
+    @property
+    def regex(self) -> bool:
+        return self.rules[0].regex
+
+def parse_rule(data: Dict[str, Any]) -> Rule:
+    unknown = set(data) - set(Rule._fields)
+    if unknown:
+        raise ValueError(f"Unknown fields in substitution rule: {', '.join(sorted(unknown))}")
+    if "needle" not in data or "replacement" not in data:
+        raise ValueError(f"Substitution rule without needle or replacement: {data}")
+    fields = dict(data)
+    if fields.get("paths") is not None:
+        paths = fields["paths"]
+        fields["paths"] = (paths,) if isinstance(paths, str) else tuple(paths)
+    return Rule(**fields)
+
+def parse_rules(text: str) -> Dict[str, Step]:
+    """
+    Parse a YAML rule file. It maps the names of steps to their commit
+    message and the list of their rules, each of which is a mapping of the
+    fields of `Rule`.
+    """
+    steps = {}
+    for name, data in (yaml.safe_load(text) or {}).items():
+        rules = [parse_rule(rule) for rule in data.get("rules") or []]
+        steps[name] = Step(name, rules, data.get("message", ""))
+    return steps
+
+def load_rules(path: Path = RULES_FILE) -> Dict[str, Step]:
+    return parse_rules(path.read_text())
+
+def can_overlap(needle: str, text: str, case_sensitive: bool = True,
+                match_before: Optional[str] = None, match_after: Optional[str] = None) -> bool:
+    """
+    Check if an occurrence of the needle can overlap with the text in a
+    string containing it, so that changing the text to this one can create
+    a new occurrence of the needle. Occurrences where the character before
+    or after the needle is part of the text and doesn't match the given
+    context are not counted.
+    """
+    folded_needle = needle if case_sensitive else needle.lower()
+    folded_text = text if case_sensitive else text.lower()
+    for shift in range(1 - len(needle), len(text)):
+        begin = max(0, shift)
+        end = min(len(text), shift + len(needle))
+        if folded_text[begin: end] != folded_needle[begin - shift: end - shift]:
+            continue
+        if match_before is not None and shift > 0 and not re.match(match_before, text[shift - 1]):
+            continue
+        if match_after is not None and end < len(text) and not re.match(match_after, text[end]):
+            continue
+        return True
+    return False
+
+def can_touch(needle: str, match_before: str, match_after: str, text: str, replacement: str,
+              case_sensitive: bool = True) -> bool:
+    """
+    Check if replacing an occurrence of the text right before or after an
+    occurrence of the needle can change whether the character before or
+    after the needle matches the given context.
+    """
+    if not replacement:
+        # The character next to the needle is then one which isn't known
+        return True
+    variants = (lambda char: {char}) if case_sensitive else (lambda char: {char.lower(), char.upper()})
+    for context, char, replaced in [(match_before, text[-1], replacement[-1]),
+                                    (match_after, text[0], replacement[0])]:
+        matches = bool(re.match(context, replaced))
+        if any(bool(re.match(context, variant)) != matches for variant in variants(char)):
+            return True
+    return False
+
+def scopes_overlap(rule: Rule, other: Rule) -> bool:
+    if rule.paths is None or other.paths is None:
+        return True
+    return not set(rule.paths).isdisjoint(other.paths)
+
+def depends_on(rule: Rule, earlier: Rule) -> bool:
+    """
+    Check if a rule has to see the result of an earlier rule, because the
+    earlier rule can create occurrences of its needle. Regular expressions
+    are not analyzed, they always depend on each other.
+    """
+    if not scopes_overlap(rule, earlier):
+        return False
+    if rule.regex or earlier.regex:
+        return True
+    return can_overlap(rule.needle, earlier.replacement, rule.case_sensitive, rule.match_before, rule.match_after)
+
+def interferes_with(rule: Rule, earlier: Rule) -> bool:
+    """
+    Check if a rule can't be moved before an earlier rule, because their
+    needles can overlap, the rule can create occurrences of the needle of
+    the earlier rule, or one of them can change the context of the needle
+    of the other one by replacing text next to it.
+    """
+    if not scopes_overlap(rule, earlier):
+        return False
+    case_sensitive = rule.case_sensitive and earlier.case_sensitive
+    return (can_overlap(rule.needle, earlier.needle, case_sensitive, rule.match_before, rule.match_after) or
+            can_overlap(earlier.needle, rule.needle, case_sensitive, earlier.match_before, earlier.match_after) or
+            can_overlap(earlier.needle, rule.replacement, earlier.case_sensitive,
+                        earlier.match_before, earlier.match_after) or
+            can_touch(earlier.needle, earlier.match_before, earlier.match_after, rule.needle, rule.replacement,
+                      rule.case_sensitive) or
+            can_touch(rule.needle, rule.match_before, rule.match_after, earlier.needle, earlier.replacement,
+                      earlier.case_sensitive))
+
+def plan(rules: Sequence[Rule]) -> List[Pass]:
+    """
+    Compile rules into passes. Rules are added to the earliest pass which
+    is run after all rules they depend on and not before any rule they
+    interfere with. Within a pass rules keep their order. Applying the
+    passes one after the other, each with one `SubstitutionEngine`, gives
+    the same result as applying the rules one after the other.
+    """
+    passes: List[Pass] = []
+    for rule in rules:
+        earliest = 0
+        for index, existing in enumerate(passes):
+            for earlier in existing.rules:
+                if depends_on(rule, earlier):
+                    earliest = max(earliest, index + 1)
+                elif interferes_with(rule, earlier):
+                    earliest = max(earliest, index)
+        for existing in passes[earliest:]:
+            if not rule.regex and not existing.regex and existing.paths == rule.paths:
+                existing.rules.append(rule)
+                break
+        else:
+            passes.append(Pass([rule]))
+    return passes
+
+def format_plan(passes: Sequence[Pass]) -> str:
+    lines = []
+    for number, rules_pass in enumerate(passes, 1):
+        scope = ", ".join(rules_pass.paths) if rules_pass.paths is not None else "all files"
+        lines.append(f"pass {number} on {scope}:")
+        lines += [f"  {rule}" for rule in rules_pass.rules]
+    return "\n".join(lines)
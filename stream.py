@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# vim: ts=2 sw=2 sts=2 expandtab
+# Copyright (c) 2019 The Unit-e developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or https://opensource.org/licenses/MIT.
+
+import os
+import sys
+from typing import *
+
+# Maximum size of the data of a pkt-line
+MAX_PACKET_DATA = 65516
+
+def read_packet(stream: BinaryIO) -> Optional[bytes]:
+    """
+    Read a pkt-line and return its data, or None for a flush packet.
+    Raises EOFError at the end of the stream.
+    """
+    header = stream.read(4)
+    if not header:
+        raise EOFError()
+    length = int(header, 16)
+    if length == 0:
+        return None
+    data = stream.read(length - 4)
+    if len(data) != length - 4:
+        raise EOFError()
+    return data
+
+def read_text_packets(stream: BinaryIO) -> List[str]:
+    """
+    Read text pkt-lines up to the next flush packet.
+    """
+    lines: List[str] = []
+    while True:
+        data = read_packet(stream)
+        if data is None:
+            return lines
+        lines.append(data.decode('utf-8').rstrip('\n'))
+
+def read_data_packets(stream: BinaryIO) -> bytes:
+    """
+    Read binary pkt-lines up to the next flush packet and join their data.
+    """
+    chunks: List[bytes] = []
+    while True:
+        data = read_packet(stream)
+        if data is None:
+            return b"".join(chunks)
+        chunks.append(data)
+
+def write_packet(stream: BinaryIO, data: bytes):
+    stream.write(b"%04x" % (len(data) + 4) + data)
+
+def write_text_packets(stream: BinaryIO, lines: Sequence[str]):
+    for line in lines:
+        write_packet(stream, line.encode('utf-8') + b"\n")
+    write_flush(stream)
+
+def write_data_packets(stream: BinaryIO, data: bytes):
+    for start in range(0, len(data), MAX_PACKET_DATA):
+        write_packet(stream, data[start:start + MAX_PACKET_DATA])
+    write_flush(stream)
+
+def write_flush(stream: BinaryIO):
+    stream.write(b"0000")
+
+class FilterProcess:
+    """
+    A filter which speaks the protocol of git's long-running filter
+    processes, see `gitattributes(5)`. It converts the contents of files
+    when git checks them out (smudge) with `Processor.convert_contents` and
+    doesn't change them when they are added (clean). Use it with
+
+        git config filter.clonemachine.process "clonemachine.py filter-process"
+        echo "* filter=clonemachine" >> .git/info/attributes
+    """
+
+    CAPABILITIES = ["clean", "smudge"]
+
+    def __init__(self, processor, input: BinaryIO, output: BinaryIO):
+        self.processor = processor
+        self.input = input
+        self.output = output
+
+    def run(self):
+        """
+        Handle commands until git closes the input.
+        """
+        self.handshake()
+        while True:
+            try:
+                metadata = read_text_packets(self.input)
+            except EOFError:
+                return
+            command = dict(line.split('=', 1) for line in metadata)
+            data = read_data_packets(self.input)
+            self.handle(command, data)
+
+    def handshake(self):
+        if read_text_packets(self.input) != ["git-filter-client", "version=2"]:
+            raise ValueError("Not a git filter client with protocol version 2")
+        write_text_packets(self.output, ["git-filter-server", "version=2"])
+        capabilities = [line.split('=', 1)[1] for line in read_text_packets(self.input)]
+        write_text_packets(self.output, [f"capability={capability}" for capability in self.CAPABILITIES
+                                         if capability in capabilities])
+        self.output.flush()
+
+    def handle(self, command: Dict[str, str], data: bytes):
+        try:
+            if command["command"] == "smudge":
+                data = self.processor.convert_contents(command["pathname"], data)
+            elif command["command"] != "clean":
+                raise ValueError(f"Unknown command '{command['command']}'")
+        except Exception as error:
+            print(f"fatal: can't filter '{command.get('pathname')}': {error}", file=sys.stderr)
+            write_text_packets(self.output, ["status=error"])
+        else:
+            write_text_packets(self.output, ["status=success"])
+            write_data_packets(self.output, data)
+            # Empty list, the status stays the same
+            write_flush(self.output)
+        self.output.flush()
+
+def read_records(stream: BinaryIO, delimiter: bytes) -> Iterator[bytes]:
+    """
+    Yield the records of a stream separated by the delimiter as soon as they
+    have been read.
+    """
+    rest = b""
+    while True:
+        chunk = stream.readline() if delimiter == b"\n" else stream.read1(65536)  # type: ignore
+        if not chunk:
+            break
+        records = (rest + chunk).split(delimiter)
+        rest = records.pop()
+        yield from records
+    if rest:
+        yield rest
+
+def run_batch(processor, input: BinaryIO, output: BinaryIO, delimiter: bytes = b"\n"):
+    """
+    Convert the files whose paths are read from the input, separated by
+    newlines or NUL bytes, and write a line with the outcome and the path of
+    each file as soon as it's done: `modified`, `unchanged` or `missing`.
+    """
+    for record in read_records(input, delimiter):
+        if not record:
+            continue
+        path = os.fsdecode(record)
+        if not os.path.isfile(path):
+            outcome = "missing"
+        elif processor.convert_file(path):
+            outcome = "modified"
+        else:
+            outcome = "unchanged"
+        output.write(f"{outcome} ".encode('utf-8') + record + delimiter)
+        output.flush()
@@ -7,11 +7,24 @@
 # Run them with `pytest -v test_fork.py`
 
 import tempfile
+import re
+import string as string_module
+from random import Random
+import io
 import os
+import subprocess
 from pathlib import Path
+import pytest
 
-from processor import Processor
-from fork import ForkConfig
+from processor import (Processor, BlacklistIndex, PrefixTrie, ContentTransform, Substitution,
+                       SubstitutionEngine, remove_trailing_whitespace)
+from tree import FileInventory, MemoryTree, GitObjectReader, LARGE_FILE_SIZE, chunk_paths
+from cache import ResultCache, git_blob_hash
+from commands import run_commands
+from stream import FilterProcess, run_batch, read_text_packets, read_data_packets, write_text_packets, write_data_packets
+from instrumentation import Instrumentation
+from fork import Fork, ForkConfig
+from rules import DEFAULT_CONTEXT, Rule, format_plan, load_rules, parse_rules, plan
 
 class TestSubstituteBitcoinIdentifier:
     def run_and_test_substitution(self, original, expected_result):
@@ -46,22 +59,30 @@ FALLBACK_DOWNLOAD_PATH ?= https://bitcoincore.org/depends-sources
         self.run_and_test_substitution(original, original)
 
 def test_remove_trailing_whitespace(tmp_path):
-    original = "one \ntwo  two  \nno\n"
-    expected_result = "one\ntwo  two\nno\n"
+    original = "one \ntwo  two  \nno\n\t\nlast\t"
+    expected_result = "one\ntwo  two\nno\n\nlast"
 
-    file_name = tmp_path / "test.py"
-    with file_name.open("w") as file:
-        file.write(original)
+    create_git_repo(tmp_path, {
+        "test.py": original,
+        "src/leveldb/test.py": original,
+        "test.md": original,
+    })
+    untracked_file_name = tmp_path / "build" / "generated.py"
+    untracked_file_name.parent.mkdir()
+    untracked_file_name.write_text(original)
+    unchanged_mtime = os.stat(tmp_path / "test.md").st_mtime_ns
 
     old_dir = os.getcwd()
     os.chdir(tmp_path)
     Processor(ForkConfig()).remove_trailing_whitespace("*.py")
     os.chdir(old_dir)
 
-    with file_name.open() as result_file:
-        result = result_file.read()
-
-    assert result == expected_result
+    assert (tmp_path / "test.py").read_text() == expected_result
+    # Excluded paths are not excluded from removing trailing whitespace
+    assert (tmp_path / "src/leveldb/test.py").read_text() == expected_result
+    assert (tmp_path / "test.md").read_text() == original
+    assert os.stat(tmp_path / "test.md").st_mtime_ns == unchanged_mtime
+    assert untracked_file_name.read_text() == original
 
 def test_substitute_bitcoin_identifier_in_file(tmp_path):
     original = """
@@ -137,3 +158,758 @@ def test_replace_in_file_regex(tmp_path):
         result = result_file.read()
 
     assert result == expected_result
+
+def substitute_sequentially(string, substitution, blacklist=[]):
+    """
+    Apply one substitution by scanning the string for its needle, the way
+    substitutions were done before they were combined into engines. Used as
+    reference for `SubstitutionEngine`.
+    """
+    needle = substitution.needle
+    replacement = substitution.replacement
+    lower = lambda s: s.translate(str.maketrans(string_module.ascii_uppercase, string_module.ascii_lowercase))
+    haystack = string if substitution.case_sensitive else lower(string)
+    out = []
+    ix = 0
+    begin_offset = haystack.find(needle, ix)
+    while begin_offset >= 0:
+        end_offset = begin_offset + len(needle)
+        before = string[begin_offset - 1: begin_offset]
+        after = string[end_offset: end_offset + 1]
+        match = string[begin_offset: end_offset]
+        blacklisted = False
+        for item in blacklist:
+            item_haystack = item if substitution.case_sensitive else lower(item)
+            item_ix = item_haystack.find(needle)
+            while item_ix >= 0 and not blacklisted:
+                context_begin = begin_offset - item_ix
+                blacklisted = string[context_begin: context_begin + len(item)] == item
+                item_ix = item_haystack.find(needle, item_ix + len(needle))
+            if blacklisted:
+                break
+        if (not blacklisted and re.match(substitution.match_before, before) and
+                re.match(substitution.match_after, after)):
+            out.append(string[ix: begin_offset])
+            out.append(replacement if isinstance(replacement, str) else replacement(match))
+        else:
+            out.append(string[ix: end_offset])
+        ix = end_offset
+        begin_offset = haystack.find(needle, ix)
+    out.append(string[ix:])
+    return "".join(out)
+
+def test_substitution_engine_is_equivalent_to_sequential_substitution():
+    original = """
+BITCOIND=${BITCOIND:-$BINDIR/bitcoind} # see github.com/bitcoin/bitcoin
+BITCOINS and BitcoinBITCOIND, Bitcoin Core Developers
+sudo add-apt-repository ppa:bitcoin/bitcoin address
+bitcoin transaction on bitcoincore.org
+"""
+    expected_result = """
+UNITED=${UNITED:-$BINDIR/united} # see github.com/bitcoin/bitcoin
+UNIT-ES and UnitEUNITED, Bitcoin Core Developers
+sudo add-apt-repository ppa:unite/Unit-e address
+Unit-e transaction on bitcoincore.org
+"""
+    processor = Processor(ForkConfig())
+    engine = processor.bitcoin_identifier_engine
+
+    sequential_result = original
+    for substitution in engine.substitutions:
+        sequential_result = substitute_sequentially(sequential_result, substitution,
+                                                    processor.config.substitution_blacklist)
+
+    assert sequential_result == expected_result
+    assert engine.apply(original) == expected_result
+
+def test_substitution_engine_checks_context_of_replaced_text():
+    # The context of the second substitution has been replaced by the first one
+    context = "$|[^a-zA-Z0-9]"
+    engine = SubstitutionEngine([Substitution(".cd", ".Y", context, context),
+                                 Substitution("ab;", "X", context, context)])
+    assert engine.apply("ab;.cd") == "X.Y"
+    engine = SubstitutionEngine([Substitution("ab;", "Xa", context, context),
+                                 Substitution(".cd", "Y", context, context)])
+    assert engine.apply("ab;.cd") == "Xa.cd"
+
+def test_substitution_engine_is_equivalent_to_sequential_substitution_on_random_inputs():
+    # Replacements only consist of characters which aren't in any needle, so
+    # they can't create occurrences of needles
+    contexts = ["", "$|[^a-zA-Z0-9]", "[;. ]", "$|[^X]"]
+    needles = ["ab;", ".cd", "ab", "b;.", "cd", "a", ";", "d.a"]
+    blacklist = ["ab;.", ".cdab", "Xab"]
+    pieces = needles + ["A", "B", " ", ".", ";", "c"]
+    random = Random(17)
+    for _ in range(2000):
+        substitutions = [Substitution(needle, random.choice(["X", "YY", "Z ", " X", "XZ"]), random.choice(contexts),
+                                      random.choice(contexts), random.random() < 0.7)
+                         for needle in random.sample(needles, random.randint(1, 4))]
+        string = "".join(random.choice(pieces) for _ in range(random.randint(0, 12)))
+        expected = string
+        for substitution in substitutions:
+            expected = substitute_sequentially(expected, substitution, blacklist)
+        assert SubstitutionEngine(substitutions, BlacklistIndex(blacklist)).apply(string) == expected, \
+            (string, substitutions)
+
+def test_blacklist_index():
+    index = BlacklistIndex(["ppa:bitcoin/bitcoin", "The Bitcoin Core developers", "bitcoincore.org"])
+
+    assert index.contexts("bitcoin") == [(4, "ppa:bitcoin/bitcoin"), (12, "ppa:bitcoin/bitcoin"), (0, "bitcoincore.org")]
+    assert index.contexts("bitcoin", case_sensitive=False) == [(4, "ppa:bitcoin/bitcoin"), (12, "ppa:bitcoin/bitcoin"),
+        (4, "The Bitcoin Core developers"), (0, "bitcoincore.org")]
+    assert index.contexts("bitcoin core", case_sensitive=False) == [(4, "The Bitcoin Core developers")]
+    assert index.contexts("BITCOIN") == []
+
+def test_parse_rules():
+    steps = parse_rules("""
+replace_ports:
+  message: Change ports
+  rules:
+    - needle: "8333"
+      replacement: "7182"
+      description: Change mainnet port
+    - needle: "port 8333"
+      replacement: "port 7182"
+      paths: doc/ports.md
+""")
+    step = steps["replace_ports"]
+    assert step.rules == [Rule("8333", "7182", description="Change mainnet port"),
+                          Rule("port 8333", "port 7182", paths=("doc/ports.md",))]
+    assert step.commit_message() == "Change ports\n\n* Change mainnet port\n"
+    with pytest.raises(ValueError):
+        parse_rules("step:\n  rules:\n    - needle: a\n      replacement: b\n      path: c\n")
+
+def test_plan():
+    rules = [
+        Rule("8332", "7181"),
+        Rule("18332", "17181"),
+        Rule(r"https://bitcoin.org/(\w+)", r"https://unit-e.io/\1", regex=True, paths=("src/protocol.h",)),
+        Rule("bitcoin", "unite", match_after="[-]"),
+        Rule("unite-cli", "unit-e-cli"),
+        Rule("testnet3", "testnet"),
+    ]
+    passes = plan(rules)
+    # Regular expressions are applied on their own and are not reordered with
+    # rules for the same files. `unite-cli` can be created by the rule before
+    # it, `testnet3` can be replaced together with the rules before that.
+    assert [rules_pass.rules for rules_pass in passes] == [
+        [rules[0], rules[1]],
+        [rules[2]],
+        [rules[3], rules[5]],
+        [rules[4]],
+    ]
+
+def apply_rules_sequentially(string, rules):
+    for rule in rules:
+        if rule.regex:
+            string = re.sub(rule.needle, rule.replacement, string)
+        else:
+            string = substitute_sequentially(string, Substitution(rule.needle, rule.replacement, rule.match_before,
+                                                                  rule.match_after, rule.case_sensitive))
+    return string
+
+def apply_passes(string, passes, path):
+    for rules_pass in passes:
+        if rules_pass.paths is not None and path not in rules_pass.paths:
+            continue
+        if rules_pass.regex:
+            string = apply_rules_sequentially(string, rules_pass.rules)
+            continue
+        string = SubstitutionEngine([Substitution(rule.needle, rule.replacement, rule.match_before,
+                                                  rule.match_after, rule.case_sensitive)
+                                     for rule in rules_pass.rules]).apply(string)
+    return string
+
+def test_plan_of_rule_steps_is_equivalent_to_sequential_replacement():
+    # Inputs of each file are built from the needles and replacements of the
+    # rules applying to it, so that occurrences are adjacent and overlap
+    random = Random(17)
+    for step in load_rules().values():
+        passes = plan(step.rules)
+        scopes = {None} | {path for rule in step.rules for path in rule.paths or []}
+        for path in scopes:
+            applies = lambda paths: paths is None or path in paths
+            rules = [rule for rule in step.rules if applies(rule.paths)]
+            needles = []
+            pieces = [" ", ".", ";", "\n", "a", "1", "-", "_"]
+            for rule in rules:
+                if rule.regex:
+                    continue
+                needles.append(rule.needle)
+                if not rule.case_sensitive:
+                    needles += [rule.needle.upper(), rule.needle.title()]
+                pieces.append(rule.replacement)
+            pieces += [piece[:len(piece) // 2] for piece in needles + pieces]
+            pieces += [piece[len(piece) // 2:] for piece in needles + pieces]
+            for _ in range(500):
+                string = "".join(random.choice(needles if random.random() < 0.5 else pieces)
+                                 for _ in range(random.randint(1, 6)))
+                expected = apply_rules_sequentially(string, rules)
+                assert apply_passes(string, passes, path) == expected, (step.name, path, string)
+
+def test_plan_keeps_rules_apart_which_change_context_of_each_other():
+    rules = [
+        Rule("zzz", "q", paths=("p",)),
+        Rule("aaa", "fo"),
+        Rule("foo", "X", paths=("p",)),
+        Rule("bar", "-", match_before="", paths=("p",)),
+    ]
+    assert apply_rules_sequentially("foobar", rules) == "foo-"
+    assert apply_passes("foobar", plan(rules), "p") == "foo-"
+
+    # Random rules with contexts on a small alphabet, so that occurrences of
+    # needles are next to each other
+    random = Random(23)
+    contexts = [DEFAULT_CONTEXT, "", "[^a]", "$|[^b-]", "[a-c]"]
+    word = lambda: "".join(random.choice("abc-") for _ in range(random.randint(1, 2)))
+    for _ in range(300):
+        rules = [Rule(word(), random.choice(["", word()]), random.choice(contexts), random.choice(contexts),
+                      random.random() < 0.8, paths=random.choice([None, ("p",)]))
+                 for _ in range(random.randint(2, 5))]
+        passes = plan(rules)
+        for _ in range(20):
+            string = "".join(random.choice("abcAB- ") for _ in range(random.randint(1, 8)))
+            for path in [None, "p"]:
+                scoped = [rule for rule in rules if rule.paths is None or path in rule.paths]
+                assert apply_passes(string, passes, path) == apply_rules_sequentially(string, scoped), \
+                    (format_plan(passes), string, path)
+
+def test_apply_rules_is_equivalent_to_sequential_replacement(tmp_path):
+    original = "bitcoin-cli 8332 18332 8332bitcoin testnet3 bitcoin\n"
+    rules = [
+        Rule("8332", "7181"),
+        Rule("18332", "17181"),
+        Rule("bitcoin", "unite", match_after="[-]"),
+        Rule("unite-cli", "unit-e-cli"),
+        Rule("testnet3", "testnet"),
+    ]
+    file_name = tmp_path / "test.txt"
+
+    file_name.write_text(original)
+    processor = Processor(ForkConfig())
+    for rule in rules:
+        processor.replace_in_file(str(file_name), rule.needle, rule.replacement, rule.match_before, rule.match_after)
+    sequential_result = file_name.read_text()
+
+    file_name.write_text(original)
+    processor.apply_rules([rule._replace(paths=(str(file_name),)) for rule in rules])
+
+    assert sequential_result == "unit-e-cli 7181 17181 8332bitcoin testnet bitcoin\n"
+    assert file_name.read_text() == sequential_result
+
+def test_prefix_trie():
+    trie = PrefixTrie(["src/leveldb", "src/qt", "doc/README_windows.txt"])
+
+    assert trie.matches("src/leveldb/db/db_impl.cc")
+    assert trie.matches("src/qt")
+    # Excluded paths are prefixes of strings, not only of directories
+    assert trie.matches("src/qtfoo.cpp")
+    assert not trie.matches("src/q")
+    assert not trie.matches("src/wallet/wallet.cpp")
+    assert not trie.matches("doc/README.md")
+    assert PrefixTrie([""]).matches("anything")
+    assert not PrefixTrie([]).matches("anything")
+
+def test_excluded_paths_are_not_read(tmp_path):
+    create_git_repo(tmp_path, {
+        "src/init.cpp": "Port 8333\n",
+        "src/leveldb/db.cc": "Port 8333\n",
+        "src/univalue/lib.cpp": "Port 8333\n",
+    })
+
+    old_dir = os.getcwd()
+    os.chdir(tmp_path)
+    try:
+        processor = Processor(ForkConfig())
+        with processor.pipeline():
+            processor.replace_recursively("8333", "7182")
+        stats = processor.reset_stats()
+        processor.replace_recursively("7182", "8333")
+    finally:
+        os.chdir(old_dir)
+
+    assert stats.scanned == 1
+    assert processor.reset_stats().scanned == 1
+    assert (tmp_path / "src/init.cpp").read_text() == "Port 8333\n"
+    assert (tmp_path / "src/leveldb/db.cc").read_text() == "Port 8333\n"
+
+def set_git_identity(monkeypatch):
+    for variable in ["GIT_AUTHOR_NAME", "GIT_COMMITTER_NAME"]:
+        monkeypatch.setenv(variable, "test")
+    for variable in ["GIT_AUTHOR_EMAIL", "GIT_COMMITTER_EMAIL"]:
+        monkeypatch.setenv(variable, "test@example.com")
+
+def create_git_repo(path, files):
+    for name, contents in files.items():
+        file_name = path / name
+        file_name.parent.mkdir(parents=True, exist_ok=True)
+        with file_name.open("w") as file:
+            file.write(contents)
+    subprocess.run(["git", "init", "-q"], cwd=path, check=True)
+    subprocess.run(["git", "add", "."], cwd=path, check=True)
+    subprocess.run(["git", "-c", "user.name=test", "-c", "user.email=test@example.com",
+                    "commit", "-q", "-m", "Initial commit"], cwd=path, check=True)
+
+def test_command_line(tmp_path, monkeypatch):
+    set_git_identity(monkeypatch)
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    clonemachine = str(Path(__file__).parent / "clonemachine.py")
+    repo = tmp_path / "repo"
+    repo.mkdir()
+    create_git_repo(repo, {"src/bitcoind.cpp": "Start bitcoind on port 8332\n"})
+    subprocess.run([clonemachine, "fork", "--unit-e-branch=HEAD"], cwd=repo, stdout=subprocess.PIPE, check=True)
+    assert (repo / "src/unit-e.cpp").read_text() == "Start unit-e on port 7181\n"
+
+    (tmp_path / "file.md").write_text("Bitcoin Core uses BTC\n")
+    subprocess.run([clonemachine, "file", "file.md"], cwd=tmp_path, stdout=subprocess.PIPE, check=True)
+    assert (tmp_path / "file.md").read_text() == "unit-e uses UTE\n"
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_pipeline(tmp_path, jobs):
+    create_git_repo(tmp_path, {
+        "ports.md": "Ports 8332 and 8333\n",
+        "src/bitcoind.cpp": "bitcoind on port 8332\n",
+        "src/leveldb/db.cpp": "port 8332\n",
+        "unchanged.txt": "nothing to see here\n",
+    })
+    unchanged_mtime = os.stat(tmp_path / "unchanged.txt").st_mtime_ns
+
+    old_dir = os.getcwd()
+    os.chdir(tmp_path)
+    try:
+        processor = Processor(ForkConfig(), jobs)
+        with processor.pipeline():
+            processor.replace_recursively("8332", "7181")
+            processor.replace_recursively("8333", "7182")
+            processor.replace_in_file("src/bitcoind.cpp", "7181", "7181 (rpc)")
+            # Nothing has been written before leaving the pipeline
+            assert (tmp_path / "ports.md").read_text() == "Ports 8332 and 8333\n"
+    finally:
+        os.chdir(old_dir)
+
+    assert (tmp_path / "ports.md").read_text() == "Ports 7181 and 7182\n"
+    assert (tmp_path / "src/bitcoind.cpp").read_text() == "bitcoind on port 7181 (rpc)\n"
+    assert (tmp_path / "src/leveldb/db.cpp").read_text() == "port 8332\n"
+    assert os.stat(tmp_path / "unchanged.txt").st_mtime_ns == unchanged_mtime
+
+def test_move_files(tmp_path):
+    create_git_repo(tmp_path, {
+        "src/bitcoind.cpp": "int main() {}\n",
+        "src/bitcoin/bitcoind.h": "#define BITCOIND\n",
+        "src/bitcoin/util.h": "#define UTIL\n",
+        "doc/readme.md": "Nothing to move\n",
+    })
+
+    old_dir = os.getcwd()
+    os.chdir(tmp_path)
+    try:
+        processor = Processor(ForkConfig())
+        with processor.pipeline():
+            processor.apply_recursively(lambda path: processor.git_move_file(path, "bitcoind", "unit-e"))
+            processor.apply_recursively(lambda path: processor.git_move_file(path, "bitcoin", "unite"))
+        result = subprocess.run(["git", "status", "--porcelain"], stdout=subprocess.PIPE, check=True)
+    finally:
+        os.chdir(old_dir)
+
+    # Paths are listed from HEAD, so files moved before are not moved again
+    assert result.stdout.decode("utf-8").splitlines() == [
+        "R  src/bitcoin/bitcoind.h -> src/bitcoin/unit-e.h",
+        "R  src/bitcoind.cpp -> src/unit-e.cpp",
+        "R  src/bitcoin/util.h -> src/unite/util.h",
+    ]
+    assert (tmp_path / "src/bitcoin/unit-e.h").read_text() == "#define BITCOIND\n"
+
+def test_chunk_paths():
+    paths = ["a", "bb", "ccc", "d", "eeeeeeee"]
+    assert list(chunk_paths(paths, 6)) == [["a", "bb"], ["ccc", "d"], ["eeeeeeee"]]
+    assert list(chunk_paths(paths)) == [paths]
+    assert list(chunk_paths([])) == []
+
+def test_file_inventory(tmp_path, monkeypatch):
+    create_git_repo(tmp_path, {
+        "src/bitcoind.cpp": "Bitcoin daemon\n",
+        "doc/readme.md": "Nothing here\n",
+    })
+
+    old_dir = os.getcwd()
+    os.chdir(tmp_path)
+    try:
+        inventory = FileInventory()
+        assert inventory.paths() == ["doc/readme.md", "src/bitcoind.cpp"]
+        assert inventory.containing("bitcoin") == []
+        assert inventory.containing("bitcoin", case_sensitive=False) == ["src/bitcoind.cpp"]
+
+        # Contents are served from the cache once they have been read
+        (tmp_path / "src/bitcoind.cpp").write_text("Changed behind the back\n")
+        assert inventory.read("src/bitcoind.cpp") == b"Bitcoin daemon\n"
+        inventory.invalidate(["src/bitcoind.cpp"])
+        assert inventory.read("src/bitcoind.cpp") == b"Changed behind the back\n"
+
+        assert inventory.move_files([("src/bitcoind.cpp", "src/unit-e.cpp"), ("src/bitcoind.cpp", "src/united.cpp")]) == \
+            [("src/bitcoind.cpp", "src/unit-e.cpp")]
+        assert inventory.remove_files(["doc"]) == ["doc/readme.md"]
+        assert inventory.paths() == ["src/unit-e.cpp"]
+        assert inventory.committed_paths() == ["doc/readme.md", "src/bitcoind.cpp"]
+        set_git_identity(monkeypatch)
+        inventory.commit("Rename and remove")
+        assert inventory.committed_paths() == ["src/unit-e.cpp"]
+    finally:
+        os.chdir(old_dir)
+
+def test_file_inventory_removes_and_moves_paths_literally(tmp_path):
+    create_git_repo(tmp_path, {
+        "doc/readme.md": "Nothing here\n",
+        "doc/build/unix.md": "Build it\n",
+        "contrib/*.sh": "Some script\n",
+        "contrib/run.sh": "Another script\n",
+        "src/[a].cpp": "A\n",
+        "src/a.cpp": "Not a\n",
+        "README.md": "Read me\n",
+    })
+
+    old_dir = os.getcwd()
+    os.chdir(tmp_path)
+    try:
+        inventory = FileInventory()
+        # Directories and files are removed together
+        assert inventory.remove_files(["doc", "contrib/*.sh", "README.md"]) == \
+            ["README.md", "contrib/*.sh", "doc/build/unix.md", "doc/readme.md"]
+        assert inventory.move_files([("src/[a].cpp", "src/b.cpp")]) == [("src/[a].cpp", "src/b.cpp")]
+        assert inventory.paths() == ["contrib/run.sh", "src/a.cpp", "src/b.cpp"]
+        result = subprocess.run(["git", "ls-files"], stdout=subprocess.PIPE, check=True)
+        assert result.stdout.decode("utf-8").splitlines() == inventory.paths()
+        assert not (tmp_path / "doc").exists()
+        assert (tmp_path / "src/b.cpp").read_text() == "A\n"
+    finally:
+        os.chdir(old_dir)
+
+def test_inventories_skip_symlinks(tmp_path):
+    (tmp_path / "bitcoind.cpp").write_text("Bitcoin daemon\n")
+    os.symlink("bitcoind.cpp", tmp_path / "link.cpp")
+    create_git_repo(tmp_path, {})
+
+    old_dir = os.getcwd()
+    os.chdir(tmp_path)
+    try:
+        for inventory in [FileInventory(), MemoryTree()]:
+            assert inventory.paths() == ["bitcoind.cpp", "link.cpp"]
+            assert inventory.read("link.cpp") is None
+            assert inventory.containing("Bitcoin") == ["bitcoind.cpp"]
+    finally:
+        os.chdir(old_dir)
+
+def test_carry_over_files(tmp_path):
+    create_git_repo(tmp_path, {
+        "changed.md": "Port 8333\n",
+        "src/bitcoind.cpp": "Port 8333\n",
+    })
+    git = ["git", "-c", "user.name=test", "-c", "user.email=test@example.com"]
+    subprocess.run(git + ["checkout", "-q", "-b", "previous"], cwd=tmp_path, check=True)
+    subprocess.run(["git", "mv", "src/bitcoind.cpp", "src/unit-e.cpp"], cwd=tmp_path, check=True)
+    (tmp_path / "src/unit-e.cpp").write_text("Port 7182 from previous fork\n")
+    subprocess.run(git + ["commit", "-q", "-am", "Previous fork"], cwd=tmp_path, check=True)
+    subprocess.run(["git", "checkout", "-q", "-"], cwd=tmp_path, check=True)
+
+    old_dir = os.getcwd()
+    os.chdir(tmp_path)
+    try:
+        processor = Processor(ForkConfig())
+        processor.unchanged_paths = {"src/bitcoind.cpp"}
+        with processor.pipeline():
+            processor.replace_recursively("8333", "7182")
+            processor.apply_recursively(lambda path: processor.git_move_file(path, "bitcoind", "unit-e"))
+            processor.carry_over_files("previous")
+    finally:
+        os.chdir(old_dir)
+
+    assert (tmp_path / "changed.md").read_text() == "Port 7182\n"
+    assert (tmp_path / "src/unit-e.cpp").read_text() == "Port 7182 from previous fork\n"
+    assert processor.unchanged_paths == set()
+
+def test_result_cache(tmp_path):
+    result = subprocess.run(["git", "hash-object", "--stdin"], input=b"bitcoin\n", stdout=subprocess.PIPE, check=True)
+    assert git_blob_hash(b"bitcoin\n") == result.stdout.decode("utf-8").strip()
+
+    cache = ResultCache(tmp_path / "cache", max_size=10)
+    key = cache.key(b"bitcoin\n", ["replace bitcoin"])
+    assert key != cache.key(b"bitcoin\n", ["replace bitcoin by unit-e"])
+    assert cache.get(key) is None
+    cache.put(key, b"unit-e\n")
+    assert cache.get(key) == b"unit-e\n"
+
+    older_key = cache.key(b"bitcoind\n", ["replace bitcoin"])
+    cache.put(older_key, b"unit-ed\n")
+    os.utime(cache.entry_path(older_key), (0, 0))
+    cache.prune()
+    assert cache.get(older_key) is None
+    assert cache.get(key) == b"unit-e\n"
+
+def test_processor_uses_result_cache(tmp_path):
+    cache = ResultCache(tmp_path / "cache")
+    file_name = tmp_path / "test.txt"
+    file_name.write_text("Bitcoin rocks\n")
+    processor = Processor(ForkConfig(), cache=cache)
+    processor.substitute_bitcoin_identifier_in_file(str(file_name))
+    assert file_name.read_text() == "Unit-e rocks\n"
+    assert processor.reset_stats().cached == 0
+
+    file_name.write_text("Bitcoin rocks\n")
+    processor.substitute_bitcoin_identifier_in_file(str(file_name))
+    assert file_name.read_text() == "Unit-e rocks\n"
+    assert processor.reset_stats().cached == 1
+
+    # The code and configuration are only hashed once, keys hash their digest
+    assert len(processor.cache_fingerprint) == 32
+    config = ForkConfig()
+    config.excluded_paths = ["doc"]
+    assert Processor(config, cache=cache).cache_fingerprint != processor.cache_fingerprint
+
+def test_transform_preserves_bytes(tmp_path):
+    files = {
+        "crlf.txt": (b"Bitcoin  \r\nline\r\n", b"Unit-e\r\nline\r\n"),
+        "latin1.txt": (b"Bitcoin caf\xe9 \n", b"Unit-e caf\xe9\n"),
+        "binary.txt": (b"Bitcoin \0\xff\n", b"Bitcoin \0\xff\n"),
+    }
+    for name, (original, expected_result) in files.items():
+        (tmp_path / name).write_bytes(original)
+
+    processor = Processor(ForkConfig())
+    for name in files:
+        processor.substitute_bitcoin_identifier_in_file(str(tmp_path / name))
+        processor.transform(ContentTransform(remove_trailing_whitespace, paths=[str(tmp_path / name)]))
+
+    for name, (original, expected_result) in files.items():
+        assert (tmp_path / name).read_bytes() == expected_result
+
+def test_large_files(tmp_path):
+    filler = "block chain\r\n" * (LARGE_FILE_SIZE // 10)
+    create_git_repo(tmp_path, {
+        "large.json": filler + "Port 8333\r\n" + filler,
+        "large_unchanged.json": filler,
+        "small.txt": "Port 8333\n",
+    })
+
+    old_dir = os.getcwd()
+    os.chdir(tmp_path)
+    try:
+        processor = Processor(ForkConfig())
+        with processor.pipeline():
+            processor.replace_recursively("8333", "7182")
+            inventory = processor.inventory
+    finally:
+        os.chdir(old_dir)
+
+    assert (tmp_path / "large.json").read_bytes() == (filler + "Port 7182\r\n" + filler).encode()
+    assert (tmp_path / "large_unchanged.json").read_bytes() == filler.encode()
+    assert (tmp_path / "small.txt").read_text() == "Port 7182\n"
+    # Contents of large files are not kept in memory
+    assert set(inventory.contents) == {"small.txt"}
+
+def test_instrumentation(tmp_path):
+    create_git_repo(tmp_path, {
+        "ports.md": "Port 8333\n",
+        "doc/ports.md": "Port 8333\n",
+    })
+
+    old_dir = os.getcwd()
+    os.chdir(tmp_path)
+    try:
+        with Instrumentation() as instrumentation:
+            processor = Processor(ForkConfig(), instrumentation=instrumentation)
+            with instrumentation.measure("step", "replace_ports"):
+                with processor.pipeline():
+                    processor.replace_recursively("8333", "7182")
+            # Long-running subprocesses and worker processes are counted too
+            with instrumentation.measure("step", "start_processes"):
+                subprocess.Popen(["true"]).wait()
+                processor = Processor(ForkConfig(), 2, instrumentation=instrumentation)
+                with processor.pipeline():
+                    processor.replace_recursively("7182", "7181")
+        assert subprocess.Popen.__module__ == "subprocess"
+    finally:
+        os.chdir(old_dir)
+
+    assert instrumentation.records[("step", "start_processes")].subprocesses == 1 + 1 + 2
+
+    step = instrumentation.records[("step", "replace_ports")]
+    assert step.calls == 1
+    assert step.subprocesses == 1
+    assert step.files_scanned == 2
+    assert step.files_modified == 2
+    assert step.bytes_read == 2 * len("Port 8333\n")
+    assert instrumentation.records[("method", "replace_recursively")].calls == 2
+    assert "step replace_ports" in instrumentation.summary()
+
+def test_memory_tree(tmp_path, monkeypatch):
+    create_git_repo(tmp_path, {
+        "ports.md": "Port 8333  \n",
+        "src/bitcoind.cpp": "Port 8333\n",
+        "doc/removed.md": "Removed\n",
+    })
+    set_git_identity(monkeypatch)
+    head = subprocess.run(["git", "rev-parse", "HEAD"], cwd=tmp_path, stdout=subprocess.PIPE).stdout
+
+    old_dir = os.getcwd()
+    os.chdir(tmp_path)
+    try:
+        config = ForkConfig()
+        config.removed_files = ["doc"]
+        processor = Processor(config, in_memory=True)
+        with processor.pipeline():
+            assert isinstance(processor.inventory, MemoryTree)
+            processor.replace_recursively("8333", "7182")
+            processor.remove_trailing_whitespace("*.md")
+            processor.commit("Change ports")
+            processor.apply_recursively(lambda path: processor.git_move_file(path, "bitcoind", "unit-e"))
+            processor.remove_files("master")
+            processor.commit("Move and remove files")
+            # The working tree is only updated at the end
+            assert (tmp_path / "ports.md").read_text() == "Port 8333  \n"
+        result = subprocess.run(["git", "log", "--format=%s", head.decode("utf-8").strip() + "..HEAD"],
+                                stdout=subprocess.PIPE, check=True)
+        status = subprocess.run(["git", "status", "--porcelain"], stdout=subprocess.PIPE, check=True)
+    finally:
+        os.chdir(old_dir)
+
+    assert result.stdout.decode("utf-8").splitlines() == ["Move and remove files", "Change ports"]
+    assert status.stdout == b""
+    assert (tmp_path / "ports.md").read_text() == "Port 7182\n"
+    assert (tmp_path / "src/unit-e.cpp").read_text() == "Port 7182\n"
+    assert not (tmp_path / "src/bitcoind.cpp").exists()
+    assert not (tmp_path / "doc").exists()
+
+def test_count_hits(tmp_path, monkeypatch):
+    set_git_identity(monkeypatch)
+    create_git_repo(tmp_path, {
+        "ports.md": "Port 8333 and 18333\n",
+        "ppa.md": "Use ppa:bitcoin/bitcoin for bitcoin\n",
+        "bitcoin.md": "Nothing\n",
+    })
+    head = subprocess.run(["git", "rev-parse", "HEAD"], cwd=tmp_path, stdout=subprocess.PIPE).stdout
+
+    old_dir = os.getcwd()
+    os.chdir(tmp_path)
+    try:
+        processor = Processor(ForkConfig())
+        processor.read_only = True
+        hits = processor.count_hits()
+        with processor.pipeline():
+            hits.step = "ports"
+            processor.replace_recursively("8333", "7182")
+            processor.commit("Change ports")
+            hits.step = "bitcoin"
+            processor.git_move_file("bitcoin.md", "bitcoin", "unite")
+            processor.substitute_bitcoin_identifiers_recursively()
+            processor.commit("Rename bitcoin")
+    finally:
+        os.chdir(old_dir)
+
+    assert subprocess.run(["git", "rev-parse", "HEAD"], cwd=tmp_path, stdout=subprocess.PIPE).stdout == head
+    assert subprocess.run(["git", "status", "--porcelain"], cwd=tmp_path, stdout=subprocess.PIPE).stdout == b""
+    assert (tmp_path / "ports.md").read_text() == "Port 8333 and 18333\n"
+
+    report = hits.report(["ports", "bitcoin"])
+    ports, bitcoin = report["steps"]
+    assert ports["substitutions"] == [
+        {"substitution": "'8333' -> '7182'", "replaced": 1, "blacklisted": 0, "context": 1, "files": 1},
+    ]
+    assert ports["files"] == [
+        {"path": "ports.md", "change": "modified", "replaced": 1, "blacklisted": 0, "context": 1},
+    ]
+    assert bitcoin["substitutions"] == [
+        {"substitution": "'bitcoin' -> replace_bitcoin_identifier(), ignoring case",
+         "replaced": 1, "blacklisted": 2, "context": 0, "files": 1},
+    ]
+    assert [(file["path"], file["change"]) for file in bitcoin["files"]] == [
+        ("bitcoin.md", "moved to unite.md"),
+        ("ppa.md", "modified"),
+    ]
+
+def test_git_object_reader(tmp_path):
+    create_git_repo(tmp_path, {
+        "README.md": "Bitcoin\n",
+        "doc/file name.md": "With space\n",
+    })
+    reader = GitObjectReader(str(tmp_path))
+    try:
+        head = subprocess.run(["git", "rev-parse", "HEAD"], cwd=tmp_path, stdout=subprocess.PIPE).stdout
+        assert reader.resolve("HEAD") == head.decode("utf-8").strip()
+        assert reader.read("HEAD:README.md") == ("blob", b"Bitcoin\n")
+        assert reader.read("HEAD:doc/file name.md") == ("blob", b"With space\n")
+        assert reader.info("HEAD:doc")[1:] == ("tree", 40)
+        assert reader.read("HEAD:missing.md") is None
+        assert reader.info("no such branch") is None
+        assert reader.read("HEAD:README.md") == ("blob", b"Bitcoin\n")
+    finally:
+        reader.close()
+
+def test_run_commands(tmp_path):
+    # Later commands finish first, results are still in the order of the commands
+    commands = [["sh", "-c", f"sleep 0.{3 - i}; echo {i}"] for i in range(3)]
+    results = run_commands(commands, jobs=3)
+    assert [result.stdout for result in results] == [b"0\n", b"1\n", b"2\n"]
+    assert [result.args for result in results] == commands
+
+    results = run_commands([["pwd"], ["sh", "-c", "echo error >&2; exit 3"]], jobs=1, cwd=str(tmp_path))
+    assert results[0].stdout.decode("utf-8").strip() == str(tmp_path)
+    assert (results[1].returncode, results[1].stderr) == (3, b"error\n")
+    with pytest.raises(subprocess.CalledProcessError):
+        run_commands([["true"], ["false"]], check=True)
+    assert run_commands([]) == []
+
+def test_filter_process():
+    request = io.BytesIO()
+    write_text_packets(request, ["git-filter-client", "version=2"])
+    write_text_packets(request, ["capability=clean", "capability=smudge", "capability=delay"])
+    large = "Bitcoin Core\r\n" * 10000
+    for command, path, contents in [("smudge", "doc/README.md", large),
+                                    ("smudge", "src/leveldb/db.cc", "bitcoin\n"),
+                                    ("clean", "doc/README.md", "bitcoin\n")]:
+        write_text_packets(request, [f"command={command}", f"pathname={path}"])
+        write_data_packets(request, contents.encode("utf-8"))
+    request.seek(0)
+    response = io.BytesIO()
+    FilterProcess(Processor(ForkConfig()), request, response).run()
+
+    response.seek(0)
+    assert read_text_packets(response) == ["git-filter-server", "version=2"]
+    assert read_text_packets(response) == ["capability=clean", "capability=smudge"]
+    results = []
+    for _ in range(3):
+        assert read_text_packets(response) == ["status=success"]
+        results.append(read_data_packets(response).decode("utf-8"))
+        assert read_text_packets(response) == []
+    assert response.read() == b""
+    # The contents of excluded paths aren't changed when they are checked out
+    # and contents aren't changed when they are added
+    assert results == ["unit-e\r\n" * 10000, "bitcoin\n", "bitcoin\n"]
+
+def test_batch(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "src" / "leveldb").mkdir(parents=True)
+    (tmp_path / "a file.md").write_text("Bitcoin uses BTC\n")
+    (tmp_path / "b.md").write_text("nothing to do\n")
+    (tmp_path / "src" / "leveldb" / "db.cc").write_text("bitcoin\n")
+    processor = Processor(ForkConfig())
+
+    output = io.BytesIO()
+    run_batch(processor, io.BytesIO(b"a file.md\nb.md\nmissing.md\nsrc/leveldb/db.cc\n"), output)
+    assert output.getvalue().decode("utf-8").splitlines() == [
+        "modified a file.md", "unchanged b.md", "missing missing.md", "unchanged src/leveldb/db.cc"]
+    assert (tmp_path / "a file.md").read_text() == "Unit-e uses UTE\n"
+    assert (tmp_path / "src" / "leveldb" / "db.cc").read_text() == "bitcoin\n"
+
+    (tmp_path / "b.md").write_text("bitcoin\n")
+    output = io.BytesIO()
+    run_batch(processor, io.BytesIO(b"b.md\0a file.md"), output, b"\0")
+    assert output.getvalue() == b"modified b.md\0unchanged a file.md\0"
+
+def test_fork_convert(tmp_path, monkeypatch):
+    # Nothing is read from or written to the repository
+    monkeypatch.chdir(tmp_path)
+    fork = Fork()
+    converted = fork.convert({"src/bitcoind.cpp": b"// Start bitcoind   \nreturn 8332;\n"})
+    assert converted == {"src/bitcoind.cpp": ("src/unit-e.cpp", b"// Start unit-e   \nreturn 7181;\n")}
+    assert fork.convert({".github/ISSUE_TEMPLATE.md": b"Bitcoin\n"}) == {}
+    assert fork.convert({"src/leveldb/db.cc": b"bitcoin\n"}) == {"src/leveldb/db.cc": ("src/leveldb/db.cc", b"bitcoin\n")}
+    assert list(tmp_path.iterdir()) == []
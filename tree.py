@@ -0,0 +1,615 @@
+#!/usr/bin/env python3
+# vim: ts=2 sw=2 sts=2 expandtab
+# Copyright (c) 2019 The Unit-e developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or https://opensource.org/licenses/MIT.
+
+import atexit
+import hashlib
+import mmap
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import zlib
+from typing import *
+
+# Modes of tree entries which are regular files
+REGULAR_FILE_MODES = ["100644", "100755"]
+
+# Files of at least this size are memory-mapped instead of read and their
+# contents are not kept in memory
+LARGE_FILE_SIZE = 256 * 1024
+
+# Maximum total length of paths passed as arguments to one git command, which
+# stays well within the limits of all platforms
+MAX_ARGUMENTS_LENGTH = 32 * 1024
+
+# Contents of a file, memory-mapped if it's large
+FileContents = Union[bytes, mmap.mmap]
+
+def read_file(path: str) -> Optional[FileContents]:
+    """
+    Return the contents of a file or None if it's not a regular file. Large
+    files are memory-mapped, so they can be searched without reading them.
+    The caller has to close the mapping with `release` before writing the
+    file.
+    """
+    if os.path.islink(path) or not os.path.isfile(path):
+        return None
+    with open(path, 'rb') as source_file:
+        if os.fstat(source_file.fileno()).st_size < LARGE_FILE_SIZE:
+            return source_file.read()
+        return mmap.mmap(source_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+def release(data: Optional[FileContents]):
+    if isinstance(data, mmap.mmap):
+        data.close()
+
+def contains(data: FileContents, needle: Union[str, Tuple[str, ...]], case_sensitive: bool = True) -> bool:
+    """
+    Check if file contents contain the needle, or one of the needles if a
+    tuple is given, ignoring the case of ASCII letters if the search isn't
+    case sensitive. Mapped contents are searched without copying them.
+    """
+    needles = [needle] if isinstance(needle, str) else needle
+    encoded = [needle.encode('utf8') for needle in needles]
+    if case_sensitive:
+        return any(data.find(needle) >= 0 for needle in encoded)
+    if isinstance(data, mmap.mmap):
+        pattern = b"|".join(re.escape(needle) for needle in encoded)
+        return re.search(pattern, data, re.IGNORECASE) is not None
+    lower_data = data.lower()
+    return any(needle.lower() in lower_data for needle in encoded)
+
+class GitObjectReader:
+    """
+    Looks up objects in the object database through long-running
+    `git cat-file --batch` and `git cat-file --batch-check` processes, so a
+    lookup doesn't need a new process. Names can be anything git can resolve
+    to an object, such as `HEAD`, `master:README.md` or `HEAD^{tree}`. The
+    processes are started on first use and restarted in forked processes.
+    Use `shared` to get the reader of a repository which is used by all
+    parts of clonemachine.
+    """
+
+    readers: Dict[str, 'GitObjectReader'] = {}
+
+    def __init__(self, git_dir: str = "."):
+        self.git_dir = git_dir
+        self.processes: Dict[str, subprocess.Popen] = {}
+        self.pid = os.getpid()
+
+    @classmethod
+    def shared(cls, git_dir: str = ".") -> 'GitObjectReader':
+        key = os.path.abspath(git_dir)
+        if key not in cls.readers:
+            cls.readers[key] = GitObjectReader(git_dir)
+        return cls.readers[key]
+
+    def request(self, mode: str, name: str) -> Optional[Tuple[subprocess.Popen, List[str]]]:
+        """
+        Send a request to the cat-file process of the given mode and return
+        the process and the fields of the answer, or None if the object
+        doesn't exist.
+        """
+        if self.pid != os.getpid():
+            # Pipes inherited by a forked process belong to the parent
+            self.processes = {}
+            self.pid = os.getpid()
+        if mode not in self.processes:
+            self.processes[mode] = subprocess.Popen(['git', 'cat-file', mode], cwd=self.git_dir,
+                                                    stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        process = self.processes[mode]
+        assert process.stdin is not None and process.stdout is not None
+        process.stdin.write(name.encode('utf8') + b"\n")
+        process.stdin.flush()
+        header = process.stdout.readline().decode('utf8').rstrip('\n')
+        if not header or header.endswith(" missing") or header.endswith(" ambiguous"):
+            return None
+        return process, header.split(' ')
+
+    def read(self, name: str) -> Optional[Tuple[str, bytes]]:
+        """
+        Return the type and contents of an object or None if it doesn't
+        exist.
+        """
+        answer = self.request('--batch', name)
+        if answer is None:
+            return None
+        process, (sha, object_type, size) = answer
+        assert process.stdout is not None
+        data = process.stdout.read(int(size))
+        process.stdout.read(1)
+        return object_type, data
+
+    def info(self, name: str) -> Optional[Tuple[str, str, int]]:
+        """
+        Return the object name, type and size of an object or None if it
+        doesn't exist.
+        """
+        answer = self.request('--batch-check', name)
+        if answer is None:
+            return None
+        process, (sha, object_type, size) = answer
+        return sha, object_type, int(size)
+
+    def resolve(self, name: str) -> Optional[str]:
+        """
+        Return the full object name, like `git rev-parse` does.
+        """
+        info = self.info(name)
+        return info[0] if info is not None else None
+
+    def close(self):
+        for process in self.processes.values():
+            assert process.stdin is not None
+            process.stdin.close()
+            process.wait()
+        self.processes = {}
+
+def chunk_paths(paths: Sequence[str], max_length: int = MAX_ARGUMENTS_LENGTH) -> Iterator[List[str]]:
+    """
+    Split paths into chunks which can be passed as arguments of one command.
+    """
+    chunk: List[str] = []
+    length = 0
+    for path in paths:
+        if chunk and length + len(path) + 1 > max_length:
+            yield chunk
+            chunk = []
+            length = 0
+        chunk.append(path)
+        length += len(path) + 1
+    if chunk:
+        yield chunk
+
+@atexit.register
+def close_readers():
+    for reader in GitObjectReader.readers.values():
+        reader.close()
+
+class FileInventory:
+    """
+    Tracked files of the working tree and their contents, kept in memory for
+    the duration of a run. The list of files is read from git once and then
+    updated as files are moved, removed and checked out through the
+    inventory. File contents are cached when they are read or written, so
+    files only have to be read from disk once, except for large files, which
+    are memory-mapped on every read. Changes done to the working tree by
+    other means have to be announced with `invalidate`.
+    """
+
+    def __init__(self):
+        self.tracked: Optional[Dict[str, None]] = None
+        self.committed: Optional[List[str]] = None
+        self.contents: Dict[str, bytes] = {}
+
+    def paths(self) -> List[str]:
+        """
+        Return the paths of the files tracked in the index.
+        """
+        if self.tracked is None:
+            result = subprocess.run(['git', 'ls-files', '-z'], stdout=subprocess.PIPE)
+            self.tracked = dict.fromkeys(path for path in result.stdout.decode('utf8').split('\0') if path)
+        return list(self.tracked)
+
+    def committed_paths(self) -> List[str]:
+        """
+        Return the paths of the files in HEAD as of the last commit.
+        """
+        if self.committed is None:
+            result = subprocess.run(['git', 'ls-tree', '-r', 'HEAD', '--name-only', '-z'], stdout=subprocess.PIPE)
+            self.committed = [path for path in result.stdout.decode('utf8').split('\0') if path]
+        return self.committed
+
+    def exists(self, path: str) -> bool:
+        return os.path.exists(path)
+
+    def read(self, path: str) -> Optional[FileContents]:
+        """
+        Return the contents of a file or None if it's not a regular file.
+        """
+        if path in self.contents:
+            return self.contents[path]
+        data = read_file(path)
+        if isinstance(data, bytes):
+            self.contents[path] = data
+        return data
+
+    def write(self, path: str, data: bytes):
+        with open(path, 'wb') as target_file:
+            target_file.write(data)
+        if len(data) < LARGE_FILE_SIZE:
+            self.contents[path] = data
+        else:
+            self.contents.pop(path, None)
+
+    def preload(self, paths: Sequence[str]):
+        """
+        Prepare reading the given files in worker processes.
+        """
+        pass
+
+    def cache_contents(self, path: str, data: bytes, written: bool):
+        """
+        Take over contents of a file read or written in a worker process.
+        """
+        self.contents[path] = data
+
+    def containing(self, needle: Union[str, Tuple[str, ...]], case_sensitive: bool = True,
+                   skip: Optional[Callable[[str], bool]] = None) -> List[str]:
+        """
+        Return the tracked files containing the needle or one of the needles.
+        Files for which `skip` returns true are not read.
+        """
+        paths = []
+        for path in self.paths():
+            if skip is not None and skip(path):
+                continue
+            data = self.read(path)
+            if data is not None and contains(data, needle, case_sensitive):
+                paths.append(path)
+            release(data)
+        return paths
+
+    def move_files(self, moves: Sequence[Tuple[str, str]]) -> List[Tuple[str, str]]:
+        """
+        Move files in the working tree and the index like `git mv` does, but
+        with a single update of the index for all moves. Moves are done in
+        the given order, sources which don't exist (anymore) are skipped.
+        Returns the moves which have been done.
+        """
+        if not moves:
+            return []
+        entries = {}
+        for chunk in chunk_paths([path for path, target in moves]):
+            result = subprocess.run(['git', '--literal-pathspecs', 'ls-files', '--stage', '-z', '--'] + chunk,
+                                    stdout=subprocess.PIPE, check=True)
+            for line in result.stdout.decode('utf8').split('\0'):
+                if line:
+                    info, path = line.split('\t', 1)
+                    mode, sha, stage = info.split(' ')
+                    entries[path] = (mode, sha)
+        index_info = []
+        done = []
+        for path, target in moves:
+            if not os.path.exists(path):
+                continue
+            if path not in entries:
+                sys.exit(f"fatal: not under version control, source={path}, destination={target}")
+            if os.path.lexists(target):
+                sys.exit(f"fatal: destination exists, source={path}, destination={target}")
+            target_parent = os.path.dirname(target)
+            if target_parent:
+                os.makedirs(target_parent, exist_ok=True)
+            os.rename(path, target)
+            self.move(path, target)
+            done.append((path, target))
+            mode, sha = entries.pop(path)
+            entries[target] = (mode, sha)
+            index_info.append(f"0 {'0' * 40}\t{path}")
+            index_info.append(f"{mode} {sha}\t{target}")
+        if index_info:
+            subprocess.run(['git', 'update-index', '-z', '--index-info'],
+                           input=''.join(line + '\0' for line in index_info).encode('utf8'), check=True)
+        return done
+
+    def remove_files(self, files: Sequence[str]) -> List[str]:
+        """
+        Remove files and directories. Returns the paths of the removed files.
+        """
+        paths = self.paths()
+        removed = []
+        for chunk in chunk_paths(files):
+            subprocess.run(['git', '--literal-pathspecs', 'rm', '-r', '-q', '--'] + chunk, check=True)
+            done = [path for path in paths
+                    if any(path == file or path.startswith(file.rstrip('/') + '/') for file in chunk)]
+            for path in done:
+                self.remove(path)
+            removed += done
+            paths = list(set(paths).difference(done))
+        return sorted(removed)
+
+    def checkout(self, branch: str, paths: Sequence[str]):
+        """
+        Check out the given files and directories from a branch.
+        """
+        for chunk in chunk_paths(paths):
+            subprocess.run(['git', '--literal-pathspecs', 'checkout', branch, '--'] + chunk)
+        for path in paths:
+            if os.path.isdir(path):
+                # Files might have been added to the directory
+                self.tracked = None
+                prefix = path.rstrip('/') + '/'
+                self.invalidate([cached for cached in self.contents if cached.startswith(prefix)])
+            else:
+                self.add(path)
+
+    def commit(self, message: str):
+        subprocess.run(['git', 'commit', '-am', message])
+        self.committed = self.paths()
+
+    def finish(self):
+        """
+        Bring the working tree up to date with the last commit.
+        """
+        pass
+
+    def close(self):
+        pass
+
+    def move(self, path: str, target: str):
+        if self.tracked is not None:
+            self.tracked.pop(path, None)
+            self.tracked[target] = None
+        if path in self.contents:
+            self.contents[target] = self.contents.pop(path)
+
+    def add(self, path: str):
+        if self.tracked is not None:
+            self.tracked[path] = None
+        self.contents.pop(path, None)
+
+    def remove(self, path: str):
+        if self.tracked is not None:
+            self.tracked.pop(path, None)
+        self.contents.pop(path, None)
+
+    def invalidate(self, paths: Optional[Iterable[str]] = None):
+        """
+        Drop the cached contents of the given files, or of all files if no
+        paths are given.
+        """
+        if paths is None:
+            self.contents = {}
+            return
+        for path in paths:
+            self.contents.pop(path, None)
+
+def parse_tree_entries(output: bytes) -> Dict[str, Tuple[str, str]]:
+    """
+    Parse the output of `git ls-tree -r -z` into a dict of paths and their
+    modes and object names.
+    """
+    entries = {}
+    for line in output.decode('utf8').split('\0'):
+        if line:
+            info, path = line.split('\t', 1)
+            mode, object_type, sha = info.split(' ')
+            entries[path] = (mode, sha)
+    return entries
+
+class MemoryTree(FileInventory):
+    """
+    Inventory which keeps the tree in memory instead of working on the
+    working tree. File contents are read from the object database, changed
+    files are written as loose objects and commits are created with a
+    temporary index, `git write-tree` and `git commit-tree`. The working tree
+    is only updated by `finish`, and not at all in a bare repository.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.reader = GitObjectReader.shared()
+        self.head = cast(str, self.reader.resolve('HEAD'))
+        self.start = self.head
+        result = subprocess.run(['git', 'ls-tree', '-r', '-z', '--full-tree', 'HEAD'], stdout=subprocess.PIPE, check=True)
+        self.entries = parse_tree_entries(result.stdout)
+        self.committed = list(self.entries)
+        # Paths whose entries have changed since the last commit
+        self.changed: Set[str] = set()
+        # Paths whose contents have been written since the last commit
+        self.dirty: Set[str] = set()
+        self.objects_dir = self.git(['rev-parse', '--git-path', 'objects'])
+        self.index_dir = tempfile.mkdtemp(prefix="clonemachine-")
+        self.index_env = dict(os.environ, GIT_INDEX_FILE=os.path.join(self.index_dir, "index"))
+        subprocess.run(['git', 'read-tree', self.head], env=self.index_env, check=True)
+
+    def git(self, arguments: List[str], **kwargs) -> str:
+        result = subprocess.run(['git'] + arguments, stdout=subprocess.PIPE, check=True, **kwargs)
+        return result.stdout.decode('utf8').rstrip('\n')
+
+    def paths(self) -> List[str]:
+        return list(self.entries)
+
+    def committed_paths(self) -> List[str]:
+        return cast(List[str], self.committed)
+
+    def exists(self, path: str) -> bool:
+        prefix = path.rstrip('/') + '/'
+        return path in self.entries or any(entry.startswith(prefix) for entry in self.entries)
+
+    def read(self, path: str) -> Optional[FileContents]:
+        if path not in self.contents:
+            if path not in self.entries:
+                return None
+            mode, sha = self.entries[path]
+            if mode not in REGULAR_FILE_MODES:
+                return None
+            result = self.reader.read(sha)
+            if result is None:
+                return None
+            self.contents[path] = result[1]
+        return self.contents[path]
+
+    def write(self, path: str, data: bytes):
+        self.contents[path] = data
+        self.dirty.add(path)
+        self.changed.add(path)
+
+    def preload(self, paths: Sequence[str]):
+        # Worker processes can't share the reader
+        for path in paths:
+            self.read(path)
+
+    def cache_contents(self, path: str, data: bytes, written: bool):
+        if written:
+            self.write(path, data)
+        else:
+            self.contents[path] = data
+
+    def move_files(self, moves: Sequence[Tuple[str, str]]) -> List[Tuple[str, str]]:
+        done = []
+        for path, target in moves:
+            if path not in self.entries:
+                continue
+            if target in self.entries:
+                sys.exit(f"fatal: destination exists, source={path}, destination={target}")
+            self.entries[target] = self.entries.pop(path)
+            self.move(path, target)
+            if path in self.dirty:
+                self.dirty.remove(path)
+                self.dirty.add(target)
+            self.changed.update([path, target])
+            done.append((path, target))
+        return done
+
+    def remove_files(self, files: Sequence[str]) -> List[str]:
+        removed = [path for path in self.entries
+                   if any(path == file or path.startswith(file.rstrip('/') + '/') for file in files)]
+        for path in removed:
+            del self.entries[path]
+            self.remove(path)
+            self.dirty.discard(path)
+            self.changed.add(path)
+        return removed
+
+    def checkout(self, branch: str, paths: Sequence[str]):
+        result = subprocess.run(['git', 'ls-tree', '-r', '-z', '--full-tree', branch], stdout=subprocess.PIPE, check=True)
+        branch_entries = parse_tree_entries(result.stdout)
+        prefixes = tuple(path.rstrip('/') + '/' for path in paths)
+        selected = set(paths)
+        for path, entry in branch_entries.items():
+            if path in selected or path.startswith(prefixes):
+                self.entries[path] = entry
+                self.contents.pop(path, None)
+                self.dirty.discard(path)
+                self.changed.add(path)
+
+    def write_blob(self, data: bytes) -> str:
+        """
+        Write a blob to the object database as loose object.
+        """
+        header = f"blob {len(data)}\0".encode('utf8')
+        sha = hashlib.sha1(header + data).hexdigest()
+        object_path = os.path.join(self.objects_dir, sha[:2], sha[2:])
+        if not os.path.exists(object_path):
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            fd, tmp_name = tempfile.mkstemp(dir=os.path.dirname(object_path), prefix="tmp_obj_")
+            with os.fdopen(fd, 'wb') as object_file:
+                object_file.write(zlib.compress(header + data, 1))
+            os.chmod(tmp_name, 0o444)
+            os.replace(tmp_name, object_path)
+        return sha
+
+    def commit(self, message: str):
+        for path in self.dirty:
+            mode, sha = self.entries[path]
+            self.entries[path] = (mode, self.write_blob(self.contents[path]))
+        self.dirty = set()
+        index_info = []
+        for path in sorted(self.changed):
+            if path in self.entries:
+                mode, sha = self.entries[path]
+                index_info.append(f"{mode} {sha}\t{path}")
+            else:
+                index_info.append(f"0 {'0' * 40}\t{path}")
+        self.changed = set()
+        if index_info:
+            subprocess.run(['git', 'update-index', '-z', '--index-info'], env=self.index_env,
+                           input=''.join(line + '\0' for line in index_info).encode('utf8'), check=True)
+        tree = self.git(['write-tree'], env=self.index_env)
+        if tree == self.reader.resolve(self.head + '^{tree}'):
+            print("nothing to commit")
+        else:
+            commit = self.git(['commit-tree', tree, '-p', self.head, '-F', '-'], input=message.encode('utf8'))
+            self.git(['update-ref', '-m', 'clonemachine: ' + message.splitlines()[0], 'HEAD', commit, self.head])
+            self.head = commit
+            print(f"[{commit[:7]}] {message.splitlines()[0]}")
+        self.committed = self.paths()
+
+    def finish(self):
+        if self.head == self.start or self.git(['rev-parse', '--is-bare-repository']) == 'true':
+            return
+        subprocess.run(['git', 'read-tree', '-m', '-u', self.start, self.head], check=True)
+
+    def close(self):
+        shutil.rmtree(self.index_dir, ignore_errors=True)
+
+class ReadOnlyTree(MemoryTree):
+    """
+    Memory tree which doesn't write anything to the repository. Commits only
+    mark the changes done so far as committed and the working tree is not
+    updated at the end.
+    """
+
+    def commit(self, message: str):
+        self.dirty = set()
+        self.changed = set()
+        self.committed = self.paths()
+
+    def finish(self):
+        pass
+
+class FileSetTree(FileInventory):
+    """
+    Inventory of a given set of files which are kept in memory and not
+    tracked in the repository, such as the versions of a file git merges.
+    Files checked out from a branch are read from the object database, but
+    only if they are in the set. Nothing is written to the repository and
+    commits only mark the changes done so far as committed.
+    """
+
+    def __init__(self, files: Mapping[str, bytes]):
+        super().__init__()
+        self.tracked = dict.fromkeys(files)
+        self.committed = list(files)
+        self.contents = dict(files)
+        # Paths of the files in the given set, by the paths they are moved to
+        self.origins = {path: path for path in files}
+
+    def exists(self, path: str) -> bool:
+        prefix = path.rstrip('/') + '/'
+        return path in self.contents or any(entry.startswith(prefix) for entry in self.contents)
+
+    def read(self, path: str) -> Optional[FileContents]:
+        return self.contents.get(path)
+
+    def write(self, path: str, data: bytes):
+        self.contents[path] = data
+
+    def move_files(self, moves: Sequence[Tuple[str, str]]) -> List[Tuple[str, str]]:
+        done = []
+        for path, target in moves:
+            if path not in self.contents:
+                continue
+            if target in self.contents:
+                sys.exit(f"fatal: destination exists, source={path}, destination={target}")
+            self.move(path, target)
+            self.origins[target] = self.origins.pop(path)
+            done.append((path, target))
+        return done
+
+    def remove_files(self, files: Sequence[str]) -> List[str]:
+        removed = [path for path in self.contents
+                   if any(path == file or path.startswith(file.rstrip('/') + '/') for file in files)]
+        for path in removed:
+            self.remove(path)
+            del self.origins[path]
+        return removed
+
+    def checkout(self, branch: str, paths: Sequence[str]):
+        reader = GitObjectReader.shared()
+        prefixes = tuple(path.rstrip('/') + '/' for path in paths)
+        selected = set(paths)
+        for path in list(self.contents):
+            if path in selected or path.startswith(prefixes):
+                result = reader.read(f"{branch}:{path}")
+                if result is not None:
+                    self.contents[path] = result[1]
+
+    def commit(self, message: str):
+        self.committed = self.paths()